@@ -0,0 +1,74 @@
+
+import timeit
+import dateutil.parser
+from schemongo.schema_layer import schema_doc
+
+
+'''
+Datetime conversion on a datetime-heavy schema: enforce_datatypes() on documents with
+a list of 50 ISO 8601 timestamps plus a few single fields, with the ISO fast path and
+with every string sent through dateutil as before.
+
+Bulk coercion on flat records: enforce_datatypes() per document against
+enforce_datatypes_bulk() on batches of 1000 documents of 20 scalar fields.
+
+    python benchmark.py
+'''
+
+
+schema = {
+    "created": {"type": "datetime"},
+    "updated": {"type": "datetime"},
+    "due": {"type": "datetime"},
+    "events": {"type": "list", "schema": {"type": "datetime"}},
+}
+
+def incoming():
+    return {
+        "created": "2014-03-09T10:21:05Z",
+        "updated": "2014-03-09T10:21:05.123456-08:00",
+        "due": "2014-04-01",
+        "events": ["2014-03-%02dT%02d:15:00+01:00" % (x % 28 + 1, x % 24) for x in range(50)],
+    }
+
+
+def run(number):
+    return timeit.timeit(lambda: schema_doc.enforce_datatypes(schema, incoming()), number=number)
+
+
+flat_schema = dict(('f%i' % i, {'type': x}) for i, x in enumerate(['integer', 'float', 'string', 'boolean'] * 5))
+
+def flat_batch():
+    return [dict(('f%i' % i, [7, '1.5', u'abc', 1][i % 4]) for i in range(20)) for x in range(1000)]
+
+
+def run_flat(number, bulk):
+    if bulk:
+        convert = lambda: schema_doc.enforce_datatypes_bulk(flat_schema, flat_batch())
+    else:
+        convert = lambda: [schema_doc.enforce_datatypes(flat_schema, x) for x in flat_batch()]
+    return timeit.timeit(convert, number=number) - timeit.timeit(flat_batch, number=number)
+
+
+if __name__ == '__main__':
+    number = 200
+    fast = run(number)
+
+    parse_datetime = schema_doc.parse_datetime
+    schema_doc.parse_datetime = dateutil.parser.parse
+    try:
+        slow = run(number)
+    finally:
+        schema_doc.parse_datetime = parse_datetime
+
+    print 'dateutil:    %.1f ms/doc' % (slow * 1000 / number)
+    print 'fast path:   %.2f ms/doc' % (fast * 1000 / number)
+    print 'speedup:     %.1fx' % (slow / fast)
+
+    number = 20
+    single = run_flat(number, False)
+    bulk = run_flat(number, True)
+    print
+    print 'per document: %.1f ms/1000 docs' % (single * 1000 / number)
+    print 'bulk:         %.1f ms/1000 docs' % (bulk * 1000 / number)
+    print 'speedup:      %.1fx' % (single / bulk)
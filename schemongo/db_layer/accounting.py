@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import logging
+
+log = logging.getLogger('schemongo')
+log.addHandler(logging.NullHandler())
+
+
+'''
+Query accounting.  Every driver call goes through an AccountedCollection, which
+records it in each QueryLog active on the owning DatabaseWrapper.  A cursor counts
+as one query when iterated, plus one per indexed access or count(), which is what
+pymongo actually sends over the wire.
+
+Recorded entries are (collection, operation, kind, shape) tuples, where shape is the
+query spec with all values replaced by '?':
+
+    {'_id': 4}                  ->  "{'_id': ?}"
+    {'_id': {'$in': [1,2]}}     ->  "{'_id': {'$in': ?}}"
+'''
+
+
+_kinds = {
+    'find': 'read',
+    'find_one': 'read',
+    'aggregate': 'read',
+    'distinct': 'read',
+    'count': 'count',
+    'insert': 'write',
+    'update': 'write',
+    'remove': 'write',
+    'save': 'write',
+    'find_and_modify': 'write',
+    'initialize_unordered_bulk_op': 'write',
+    'insert_many': 'write',
+    'bulk_write': 'write',
+    'delete_many': 'write',
+}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryLog(object):
+    def __init__(self, warn_after=None):
+        self.queries = []
+        self.warn_after = warn_after
+        self.repeated = []
+        self._shapes = {}
+
+    def record(self, collection, operation, spec=None):
+        entry = (collection, operation, _kinds.get(operation, 'read'), query_shape(spec))
+        self.queries.append(entry)
+        key = (entry[0], entry[1], entry[3])
+        count = self._shapes[key] = self._shapes.get(key, 0) + 1
+        if self.warn_after is not None and count == self.warn_after + 1:
+            self.repeated.append(key)
+            log.warning("Query repeated more than %i times: %s.%s %s" % ((self.warn_after,) + key))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def by_kind(self):
+        result = {}
+        for entry in self.queries:
+            result[entry[2]] = result.get(entry[2], 0) + 1
+        return result
+
+    def by_shape(self):
+        return dict(self._shapes)
+
+    def summary(self):
+        lines = ['%ix %s.%s %s' % ((n,) + key) for key, n in self._shapes.items()]
+        return '\n'.join(sorted(lines, reverse=True))
+
+
+def query_shape(spec):
+    if spec is None:
+        return '{}'
+    if not isinstance(spec, dict):
+        return '{_id: ?}'
+    return _shape(spec)
+
+def _shape(val):
+    if isinstance(val, dict):
+        return '{%s}' % ', '.join('%r: %s' % (k, _shape(val[k])) for k in sorted(val.keys()))
+    if isinstance(val, list) and len(val) and isinstance(val[0], dict):
+        return '[%s]' % ', '.join(_shape(x) for x in val)
+    return '?'
+
+
+
+class AccountedDatabase(object):
+    def __init__(self, database, logs):
+        self._database = database
+        self._logs = logs
+
+    def __getitem__(self, key):
+        return AccountedCollection(self._database[key], self._logs)
+
+    def __getattr__(self, key):
+        return self[key]
+
+
+class AccountedCollection(object):
+    def __init__(self, collection, logs):
+        self._collection = collection
+        self._logs = logs
+
+    def __getattr__(self, key):
+        attr = getattr(self._collection, key)
+        if key not in _kinds or not self._logs:
+            return attr
+
+        def accounted(*args, **kwords):
+            result = attr(*args, **kwords)
+            first = args[0] if args else None
+            if key == 'find':
+                return AccountedCursor(result, self._collection.name, kwords.get('spec', first), self._logs)
+            spec = None
+            if key != 'insert':
+                spec = kwords.get('spec', kwords.get('spec_or_id', kwords.get('query', first)))
+            for query_log in self._logs:
+                query_log.record(self._collection.name, key, spec)
+            return result
+        return accounted
+
+
+class AccountedCursor(object):
+    def __init__(self, cursor, coll_name, spec, logs):
+        self._cursor = cursor
+        self._coll_name = coll_name
+        self._spec = spec
+        self._logs = logs
+
+    def _record(self, operation):
+        for query_log in self._logs:
+            query_log.record(self._coll_name, operation, self._spec)
+
+    def __getattr__(self, key):
+        return getattr(self._cursor, key)
+
+    def __iter__(self):
+        self._record('find')
+        return iter(self._cursor)
+
+    def __getitem__(self, index):
+        self._record('find')
+        return self._cursor[index]
+
+    def count(self, *args, **kwords):
+        self._record('count')
+        return self._cursor.count(*args, **kwords)
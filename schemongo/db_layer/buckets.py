@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+from itertools import islice
+from pymongo.errors import DuplicateKeyError
+
+
+'''
+Bucketed embedded lists.  After db.bucketing('orders', 'lines', 100) the objects of
+orders.lines are kept out of the orders themselves, in the overflow collection
+'orders.lines', as buckets of at most 100 items in list order:
+
+    {'parent': order _id, 'n': 0, 1, 2..., 'count': len(items), 'items': [...]}
+
+Every bucket but the last is full, so item i of the list is item i % 100 of bucket
+i / 100.  A unique index on (parent, n) keeps reads to the parent's own buckets and
+lets only one writer create each bucket.  CollectionWrapper reads the buckets back
+into the list, so find_one, merge and diff see an ordinary list; writes replace only
+the buckets from the first changed item on, so appending touches only the last one.
+'''
+
+
+def bucket_collection(db, name, key):
+    return db._db['%s.%s' % (name, key)]
+
+
+def load_buckets(coll, docs, key):
+    'Sets docs[i][key] to the list stored in the buckets of each doc, with one read'
+    if not docs:
+        return docs
+    items = {}
+    for bucket in coll.find({'parent': {'$in': [x['_id'] for x in docs]}}, sort=[('parent', 1), ('n', 1)]):
+        items.setdefault(bucket['parent'], []).extend(bucket['items'])
+    for doc in docs:
+        # A document without buckets may still hold its list from before it was bucketed
+        doc[key] = items.get(doc['_id'], doc.get(key) or [])
+    return docs
+
+
+def load_items(coll, parent, start=0):
+    'The list stored for parent, from bucket start on'
+    return [x for bucket in coll.find({'parent': parent, 'n': {'$gte': start}}, sort=[('n', 1)])
+            for x in bucket['items']]
+
+
+def first_change(new, old):
+    'Index of the first item that differs between the two lists'
+    for i, (x, y) in enumerate(zip(new, old)):
+        if x != y:
+            return i
+    return min(len(new), len(old))
+
+
+def write_buckets(coll, parent, items, size, old=None, first=0):
+    '''
+    Stores items as the list of parent, writing only the buckets that change.  old is
+    the stored list, if known; otherwise the buckets from the one holding item first
+    on are read to compare against.
+    '''
+    if old is not None:
+        first = first_change(items, old)
+    start = first // size
+    old = load_items(coll, parent, start) if old is None else old[start * size:]
+    write_tail(coll, parent, start, items[start * size:], old, size)
+
+
+def write_tail(coll, parent, start, items, old, size):
+    'Stores items as the list of parent from bucket start on, where old is stored now'
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    for n, chunk in enumerate(chunks, start):
+        offset = (n - start) * size
+        if chunk != old[offset:offset + size]:
+            coll.update({'parent': parent, 'n': n}, {'parent': parent, 'n': n, 'count': len(chunk), 'items': chunk}, upsert=True)
+    if len(old) > len(chunks) * size:
+        coll.remove({'parent': parent, 'n': {'$gte': start + len(chunks)}})
+
+
+def append_item(coll, parent, item, size, empty=None):
+    '''
+    Appends item to the last bucket of parent, or a new one if it is full.  empty is
+    called first if parent has no buckets yet; it returns True if it wrote some.
+    '''
+    while True:
+        last = next(iter(coll.find({'parent': parent}, fields=['n', 'count'], sort=[('n', -1)], limit=1)), None)
+        if last is None and empty and empty():
+            continue
+        if last and last['count'] < size:
+            result = coll.update({'parent': parent, 'n': last['n'], 'count': last['count']},
+                                 {'$push': {'items': item}, '$inc': {'count': 1}})
+            if result.get('n'):
+                return
+        else:
+            n = last and last['n'] + 1 or 0
+            try:
+                result = coll.update({'parent': parent, 'n': n}, {'$setOnInsert': {'count': 1, 'items': [item]}}, upsert=True)
+                if not result.get('updatedExisting'):
+                    return
+            except DuplicateKeyError:
+                pass
+        # Another writer filled or started that bucket first
+
+
+def find_item(coll, parent, item_id, size):
+    'Returns (index, item) for the object item_id of the list of parent, or None'
+    bucket = coll.find_one({'parent': parent, 'items._id': item_id})
+    for i, item in enumerate(bucket and bucket['items'] or []):
+        if item['_id'] == item_id:
+            return (bucket['n'] * size + i, item)
+
+
+def count_items(coll, parent):
+    return sum(x['count'] for x in coll.find({'parent': parent}, fields=['count']))
+
+
+def page_items(coll, parent, skip, limit, size):
+    'Returns (items, total) for a page of the list of parent, reading only the buckets it spans'
+    total = count_items(coll, parent)
+    end = limit and min(skip + limit, total) or total
+    if skip >= end:
+        return ([], total)
+    buckets = coll.find({'parent': parent, 'n': {'$gte': skip // size, '$lte': (end - 1) // size}}, sort=[('n', 1)])
+    items = [x for bucket in buckets for x in bucket['items']]
+    offset = skip % size
+    return (items[offset:offset + end - skip], total)
+
+
+class BucketCursor(object):
+    'A raw cursor whose documents get their bucketed lists, read a batch of documents at a time'
+    def __init__(self, cursor, buckets, batch_size=100):
+        self._cursor = cursor
+        self._buckets = buckets
+        self.batch_size = batch_size
+
+    def _load(self, docs):
+        for key, coll in self._buckets:
+            load_buckets(coll, docs, key)
+        return docs
+
+    def __getitem__(self, index):
+        return self._load([self._cursor[index]])[0]
+
+    def __iter__(self):
+        cursor = iter(self._cursor)
+        while True:
+            docs = list(islice(cursor, self.batch_size))
+            if not docs:
+                return
+            for doc in self._load(docs):
+                yield doc
+
+    def count(self):
+        return self._cursor.count()
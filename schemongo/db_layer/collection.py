@@ -1,14 +1,51 @@
 #!/usr/bin/env python
 
+import base64
+import random
+import time
 from copy import deepcopy
-from db_doc import DBDoc, enforce_ids, merge
+from bson import json_util
+from bson.son import SON
+from itertools import izip, islice
+from pymongo.errors import OperationFailure
+from db_doc import DBDoc, DBDocList, enforce_ids, merge, partial_paths, SEQ_KEY, VERSION_KEY
 from diff import diff_recursive
+import buckets
+
+
+class ConflictError(Exception):
+    'A versioned document changed between being read and being written back'
+
+
+class RetryPolicy(object):
+    '''
+    How often a write that hit a ConflictError is re-read and retried, waiting a random
+    time up to backoff seconds before each retry and doubling that up to max_backoff
+    '''
+    def __init__(self, attempts=5, backoff=0.01, max_backoff=1.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def run(self, func):
+        delay = self.backoff
+        for attempt in range(self.attempts):
+            try:
+                return func()
+            except ConflictError:
+                if attempt == self.attempts - 1:
+                    raise
+                time.sleep(random.uniform(0, delay))
+                delay = min(delay * 2, self.max_backoff)
+
 
 
 class CollectionWrapper(object):
     def __init__(self, collection, db):
         self._collection = collection
         self._db = db
+        self.retry = db.versioned.get(collection.name)
+        self.buckets = db.buckets.get(collection.name, {})
                 
     def find(self, spec=None, fields=None, skip=0, limit=0, sort=None):
         if sort and fields:
@@ -26,9 +63,18 @@ class CollectionWrapper(object):
             limit = limit,
             sort = sort
         )
+        if self.buckets:
+            raw_cursor = buckets.BucketCursor(raw_cursor, self._bucketed())
+            proj_cursor = proj_cursor and buckets.BucketCursor(proj_cursor, self._bucketed(fields))
         return CursorWrapper(raw_cursor, proj_cursor)    
 
-    def find_one(self, spec_or_id, fields=None, skip=0, sort=None):
+    def find_one(self, spec_or_id, fields=None, skip=0, sort=None, slices=None):
+        '''
+        slices: {key: (skip, limit[, spec])} reads those embedded lists one page at a time
+        with find_items instead of whole; they come back as partial lists.
+        '''
+        if slices:
+            return self._find_one_sliced(spec_or_id, fields, skip, sort, slices)
         raw = self._collection.find_one(
             spec_or_id = spec_or_id,
             skip = skip,
@@ -36,6 +82,9 @@ class CollectionWrapper(object):
         )
         if raw is None:
             return None
+        if self.buckets:
+            self._load_buckets([raw])
+            return DBDoc(raw, None, fields and project(raw, fields))
         proj = fields and self._collection.find_one(
             spec_or_id = spec_or_id,
             fields = fields,
@@ -43,6 +92,189 @@ class CollectionWrapper(object):
             sort = sort
         )
         return DBDoc(raw, None, proj)
+
+
+    def _find_one_sliced(self, spec_or_id, fields, skip, sort, slices):
+        raw = self._collection.find_one(
+            spec_or_id = spec_or_id,
+            fields = dict((x, False) for x in slices),
+            skip = skip,
+            sort = sort
+        )
+        if raw is None:
+            return None
+        self._load_buckets([raw], [x for x in self.buckets if x not in slices])
+        doc = DBDoc(raw)
+        for key, args in slices.items():
+            items = self.find_items(raw['_id'], key, *args).items
+            items._parent = doc
+            dict.__setitem__(doc, key, items)
+        doc._projection = fields and project(doc, fields)
+        return doc
+
+
+    def find_items(self, id, key, skip=0, limit=20, spec=None):
+        '''
+        One page of the embedded list at key, only the objects matching spec if given
+        (a query on their own fields), as a Page whose items are a partial list.  The
+        list is sliced by the server, never read whole.
+        '''
+        total = 0
+        if key in self.buckets and not spec:
+            items, total = buckets.page_items(self._bucket(key), id, skip, limit, self.buckets[key])
+        elif key in self.buckets:
+            head = [{'$match': {'parent': id}}, {'$sort': SON([('n', 1)])}]
+            items, total = _list_page(self._bucket(key), head, 'items', skip, limit, spec)
+        if not total:
+            # Not bucketed, or still stored inline from before it was
+            items, total = _list_page(self._collection, [{'$match': {'_id': id}}], key, skip, limit, spec)
+        items = DBDocList(items, None, (skip, total))
+        return Page(items, total, skip + len(items) < total, skip, limit)
+
+
+    def count_items(self, id, key):
+        'Length of the embedded list at key, counted by the server'
+        if key in self.buckets:
+            count = buckets.count_items(self._bucket(key), id)
+            if count:
+                return count
+        try:
+            found = self.aggregate([
+                {'$match': {'_id': id}},
+                {'$project': {'total': {'$size': {'$ifNull': ['$' + key, []]}}}},
+            ])
+            return found and found[0]['total'] or 0
+        except (NotImplementedError, OperationFailure):
+            return len(self.aggregate([{'$match': {'_id': id}}, {'$unwind': '$' + key}]))
+
+
+    def _bucket(self, key):
+        return buckets.bucket_collection(self._db, self._collection.name, key)
+
+    def _bucketed(self, fields=None):
+        'The (key, bucket collection) pairs to load, those fields includes if given'
+        keys = [x for x in self.buckets if fields is None or any(y.split('.')[0] == x for y in fields)]
+        return [(x, self._bucket(x)) for x in keys]
+
+    def _load_buckets(self, docs, keys=None):
+        for key in self.buckets if keys is None else keys:
+            buckets.load_buckets(self._bucket(key), docs, key)
+        return docs
+
+    def _read(self, id):
+        raw = self._collection.find_one(id)
+        return raw and self._load_buckets([raw])[0]
+
+    def _unbucketed(self, doc):
+        '''
+        What is stored in the document itself: doc without its bucketed lists, and with
+        their item counters kept ahead of the ids in them, as push_item cannot check
+        '''
+        if not self.buckets:
+            return doc
+        main = dict((k, v) for k, v in doc.items() if k not in self.buckets)
+        if doc.get(SEQ_KEY):
+            main[SEQ_KEY] = dict(doc[SEQ_KEY])
+            for key in self.buckets:
+                if key in main[SEQ_KEY]:
+                    main[SEQ_KEY][key] = max([main[SEQ_KEY][key]] + [x['_id'] for x in doc.get(key) or []])
+        return main
+
+    def _write_buckets(self, doc, old=None, inline=()):
+        'inline: keys whose list was still stored in the document, so has no buckets to compare with'
+        for key, size in self.buckets.items():
+            if key in inline:
+                old_items = []
+            else:
+                old_items = (old.get(key) or []) if old is not None else None
+            buckets.write_buckets(self._bucket(key), doc['_id'], doc.get(key) or [], size, old=old_items)
+
+    def _write_main(self, spec, update):
+        '''
+        Writes the document itself.  Returns the result and, for bucketed collections, the
+        keys it still held a list at from before they were bucketed, which the write drops.
+        '''
+        if not self.buckets:
+            return (self._collection.update(spec, update), [])
+        before = self._collection.find_and_modify(spec, update, fields=dict((x, True) for x in self.buckets))
+        return ({'ok': 1.0, 'n': before is not None and 1 or 0}, [x for x in self.buckets if before and x in before])
+
+    def _move_inline(self, id, key):
+        'Moves a list stored in document id from before key was bucketed into buckets; returns whether there was one'
+        raw = self._collection.find_one({'_id': id, key: {'$exists': True}}, fields=[key])
+        if raw is None:
+            return False
+        buckets.write_buckets(self._bucket(key), id, raw[key] or [], self.buckets[key], old=[])
+        self._collection.update({'_id': id}, {'$unset': {key: ''}})
+        return True
+
+
+    def paginate(self, spec=None, fields=None, limit=20, sort=None, after=None):
+        sort = list(sort or [])
+        if '_id' not in [x[0] for x in sort]:
+            sort.append(('_id', 1))
+        if fields and '_id' not in fields:
+            fields = list(fields) + ['_id']
+        if after:
+            range_spec = keyset_spec(sort, decode_keyset_token(after))
+            spec = spec and {'$and': [spec, range_spec]} or range_spec
+
+        items = [x for x in self.find(spec, fields, 0, limit + 1, sort)]
+        if len(items) <= limit:
+            return (items, None)
+        items = items[:limit]
+        return (items, encode_keyset_token([get_path(items[-1], x[0]) for x in sort]))
+
+
+    def find_page(self, spec=None, fields=None, skip=0, limit=20, sort=None, total='exact'):
+        '''
+        total:  'exact'     counted alongside the page
+                'cached'    counted, then reused for db.count_cache_ttl seconds
+                'estimate'  collection size from metadata for an empty spec, else as 'cached'
+                None        not counted
+        '''
+        count = None
+        if total == 'estimate' and not spec:
+            count = self._collection.count()
+        elif total in ['cached', 'estimate']:
+            count = self._db.get_cached_count(self._collection.name, spec)
+        want_count = total and count is None
+
+        try:
+            raws, counted = self._find_page_facet(spec, skip, limit, sort, want_count)
+            items = [DBDoc(x, None, fields and project(x, fields)) for x in self._load_buckets(raws)]
+        except (NotImplementedError, OperationFailure):
+            items = [x for x in self.find(spec, fields, skip, limit and limit + 1, sort)]
+            counted = want_count and self._collection.find(spec).count()
+
+        if want_count:
+            count = counted
+            if total != 'exact':
+                self._db.set_cached_count(self._collection.name, spec, count)
+
+        has_more = bool(limit) and len(items) > limit
+        return Page(items[:limit or None], count, has_more, skip, limit)
+
+
+    def _find_page_facet(self, spec, skip, limit, sort, want_count):
+        page = []
+        if sort:
+            page.append({'$sort': SON(sort)})
+        if skip:
+            page.append({'$skip': skip})
+        if limit:
+            page.append({'$limit': limit + 1})
+        facet = {'items': page}
+        if want_count:
+            facet['total'] = [{'$count': 'n'}]
+
+        result = self.aggregate([{'$match': spec or {}}, {'$facet': facet}])[0]
+        counted = want_count and (result['total'] and result['total'][0]['n'] or 0)
+        return (result['items'], counted)
+
+
+    def aggregate(self, pipeline):
+        return _aggregate(self._collection, pipeline)
         
 
     def insert(self, doc_or_docs, username=None):
@@ -71,7 +303,8 @@ class CollectionWrapper(object):
         try:
             for item in docs:
                 new_id = enforce_ids(item, new_id)
-                id = self._collection.insert(item)
+                id = self._collection.insert(self._unbucketed(item))
+                self._write_buckets(item, {})
                 
                 if id:
                     self._db.history_insert(
@@ -91,19 +324,46 @@ class CollectionWrapper(object):
             return ids[0]
 
 
-    def update(self, doc, username=None, direct=False):
+    def update(self, doc, username=None, direct=False, stored=None):
+        '''
+        stored: the document as already read by the caller, saving a second read.  In a
+        versioned collection a merging update that loses a race is re-read and merged
+        again under the retry policy, unless doc names the _v it expects.
+        '''
         assert '_id' in doc, "Cannot update document without _id attribute"
-        data = DBDoc(self._collection.find_one(doc['_id']))
-        old = deepcopy(data)
+        if getattr(doc, '_journal', None) and not direct:
+            return self.update_tracked(doc, username)
+        if self.retry is None or direct or VERSION_KEY in doc:
+            return self._update(doc, username, direct, stored)
+        reads = iter([stored])
+        return self.retry.run(lambda: self._update(doc, username, direct, next(reads, None)))
+
+
+    def _update(self, doc, username, direct, stored):
+        if stored is None:
+            data = DBDoc(self._read(doc['_id']))
+            old = deepcopy(data)
+        else:
+            data = DBDoc(deepcopy(stored))
+            old = stored
         if direct:
+            assert not partial_paths(doc), "Cannot replace a document holding a partial list"
             data = doc
         else:
             merge(data, doc)
         enforce_ids(data, doc['_id'])
-        result = self._collection.update({'_id': doc['_id']}, data)
+        spec = {'_id': doc['_id']}
+        if self.retry:
+            spec[VERSION_KEY] = doc.get(VERSION_KEY, old.get(VERSION_KEY))
+            data[VERSION_KEY] = (spec[VERSION_KEY] or 0) + 1
+        result, inline = self._write_main(spec, self._unbucketed(data))
+        if self.retry and not result.get('n'):
+            raise ConflictError("Document %s in '%s' changed since it was read" % (doc['_id'], self._collection.name))
 
+        if result.get('n'):
+            self._write_buckets(data, old, inline)
         if result.get('ok', False):
-            changes = diff_recursive(data, old)
+            changes = _unversioned(diff_recursive(data, old))
             if changes:
                 self._db.history_update(
                     collection = self._collection.name,
@@ -115,27 +375,354 @@ class CollectionWrapper(object):
         return result
         
 
-    def remove(self, spec_or_id, username=None):
-        if isinstance(spec_or_id, dict):
-            data = self._collection.find(spec_or_id)
+    def update_tracked(self, doc, username=None):
+        '''
+        Writes only the mutations journaled since doc.track_changes(), without re-reading
+        it.  In a versioned collection raises ConflictError if it was written meanwhile.
+        '''
+        enforce_ids(doc, doc['_id'])
+        update, changes = doc.get_changes()
+        if not update:
+            return {'ok': 1.0, 'n': 0}
+        partial = partial_paths(doc)
+        assert not any(x == y or x.startswith(y + '.') for y in partial for op in update.values() for x in op), \
+            "Cannot write positions in a partial list; use update_item or push_item"
+        lists = self._tracked_buckets(doc, update)
+        spec = {'_id': doc['_id']}
+        if self.retry:
+            spec[VERSION_KEY] = doc.get(VERSION_KEY)
+            update.setdefault('$set', {})[VERSION_KEY] = (spec[VERSION_KEY] or 0) + 1
+        result, inline = self._write_main(spec, update)
+        if self.retry and not result.get('n'):
+            raise ConflictError("Document %s in '%s' changed since it was read" % (doc['_id'], self._collection.name))
+
+        if result.get('ok', False):
+            for key, first in lists:
+                old = [] if key in inline else None
+                buckets.write_buckets(self._bucket(key), doc['_id'], doc.get(key) or [], self.buckets[key], old=old, first=first)
+            doc.clear_changes()
+            if self.retry:
+                dict.__setitem__(doc, VERSION_KEY, update['$set'][VERSION_KEY])
+            changes = _unversioned(changes)
+            if changes:
+                self._db.history_update(
+                    collection = self._collection.name,
+                    id = doc['_id'],
+                    username = username,
+                    diff = changes
+                )
+
+        return result
+
+
+    def _tracked_buckets(self, doc, update):
+        '''
+        Takes the writes to bucketed lists out of a tracked update, returning the
+        (key, index of the first changed item) of each list to rewrite the buckets of
+        '''
+        lists = {}
+        for op in update.values():
+            for path in op.keys():
+                parts = path.split('.')
+                if parts[0] in self.buckets:
+                    del op[path]
+                    first = len(parts) > 1 and parts[1].isdigit() and int(parts[1]) or 0
+                    lists[parts[0]] = min(lists.get(parts[0], first), first)
+        for key in list(update):
+            if not update[key]:
+                del update[key]
+        seq = doc.get(SEQ_KEY) or {}
+        for key in lists:
+            # Drops the list if it is still stored inline; update_tracked then buckets all of it
+            update.setdefault('$unset', {})[key] = ''
+            if key in seq:
+                update.setdefault('$set', {})['%s.%s' % (SEQ_KEY, key)] = max([seq[key]] + [x['_id'] for x in doc.get(key) or []])
+        return lists.items()
+
+
+    def _bump(self, update):
+        'Adds the version increment to an in-place update of a versioned collection'
+        if self.retry:
+            bump_version(update)
+        return update
+
+    def _bump_bucketed(self, id):
+        'Version increment for a write that went only to the buckets of document id'
+        if self.retry:
+            self._collection.update({'_id': id}, self._bump({}))
+
+
+    def push_item(self, id, key, item, username=None):
+        '''
+        Appends one object to the embedded list at key with $push, numbering it from the
+        document's own counter instead of scanning the list.  Returns the new item _id,
+        or None if the document does not exist.
+        '''
+        assert not item.get('_id'), "Cannot push item with _id attribute"
+        item = DBDoc(item)
+        resync = False
+        while True:
+            item_id = self._next_item_id(id, key, resync)
+            if item_id is None:
+                return None
+            item['_id'] = None
+            enforce_ids(item, item_id)
+            if key in self.buckets:
+                buckets.append_item(self._bucket(key), id, item, self.buckets[key], lambda: self._move_inline(id, key))
+                self._bump_bucketed(id)
+                break
+            result = self._collection.update(
+                {'_id': id, key: {'$not': {'$elemMatch': {'_id': item_id}}}},
+                self._bump({'$push': {key: item}})
+            )
+            if result.get('n'):
+                break
+            # Taken by an item a whole-document update added; recount from the stored ids
+            resync = True
+
+        self._db.history_update(
+            collection = self._collection.name,
+            id = id,
+            username = username,
+            diff = [{key: {'action': 'object added', 'data': item_id}}]
+        )
+        return item_id
+
+
+    def _next_item_id(self, id, key, resync=False):
+        counter = '%s.%s' % (SEQ_KEY, key)
+        if not resync:
+            raw = self._collection.find_and_modify(
+                {'_id': id, counter: {'$exists': True}},
+                {'$inc': {counter: 1}},
+                new = True,
+                fields = [counter]
+            )
+            if raw is not None:
+                return raw[SEQ_KEY][key]
+
+        stored = self._collection.find_one({'_id': id}, fields=[key])
+        if stored is None:
+            return None
+        if key in self.buckets:
+            buckets.load_buckets(self._bucket(key), [stored], key)
+        last = max([x.get('_id', 0) for x in stored.get(key) or []] or [0])
+        self._collection.update({'_id': id}, {'$set': {counter: last}})
+        return self._next_item_id(id, key)
+
+
+    def find_item(self, id, key, item_id):
+        'Returns (index, item) for one object of the embedded list at key, or None'
+        if key in self.buckets:
+            found = buckets.find_item(self._bucket(key), id, item_id, self.buckets[key])
+            if found or buckets.count_items(self._bucket(key), id):
+                return found
+        try:
+            found = self.aggregate([
+                {'$match': {'_id': id}},
+                {'$project': {'index': {'$indexOfArray': ['$%s._id' % key, item_id]}, key: 1}},
+                {'$project': {'index': 1, 'item': {'$arrayElemAt': ['$' + key, '$index']}}},
+            ])
+            if not found or found[0]['index'] < 0:
+                return None
+            return (found[0]['index'], found[0]['item'])
+        except (NotImplementedError, OperationFailure):
+            stored = self._collection.find_one({'_id': id}, fields=[key])
+            for i, item in enumerate(stored and stored.get(key) or []):
+                if item['_id'] == item_id:
+                    return (i, item)
+
+
+    def update_item(self, id, key, item, username=None, direct=False, stored=None):
+        '''
+        Rewrites one object of the embedded list at key with a positional $set.  The
+        item is merged into the stored one unless direct; stored is the (index, item)
+        from find_item, if the caller already has it.
+        '''
+        assert '_id' in item, "Cannot update item without _id attribute"
+        stored = stored or self.find_item(id, key, item['_id'])
+        if stored is None:
+            return None
+        index, old = stored
+        if direct:
+            data = DBDoc(item)
         else:
-            data = self._collection.find({'_id': spec_or_id})
-        data = [x for x in data]
-            
-        result = self._collection.remove(spec_or_id)
+            data = DBDoc(deepcopy(old))
+            merge(data, item)
+        enforce_ids(data, item['_id'])
+        if key in self.buckets:
+            result = self._bucket(key).update({'parent': id, 'items._id': item['_id']}, {'$set': {'items.$': data}})
+            if not result.get('n') and self._move_inline(id, key):
+                result = self._bucket(key).update({'parent': id, 'items._id': item['_id']}, {'$set': {'items.$': data}})
+            self._bump_bucketed(id)
+        else:
+            result = self._collection.update({'_id': id, key + '._id': item['_id']}, self._bump({'$set': {key + '.$': data}}))
 
         if result.get('ok', False):
-            for item in data:
-                self._db.history_remove(
+            changes = diff_recursive(data, old, '%s/%i/' % (key, index))
+            if changes:
+                self._db.history_update(
                     collection = self._collection.name,
-                    id = item['_id'],
+                    id = id,
                     username = username,
-                    data = item
+                    diff = changes
                 )
-            
+
         return result
 
 
+    def pull_item(self, id, key, item_id, username=None):
+        'Removes one object from the embedded list at key with $pull'
+        if key in self.buckets:
+            return self._pull_bucketed(id, key, item_id, username)
+        raw = self._collection.find_and_modify(
+            {'_id': id},
+            self._bump({'$pull': {key: {'_id': item_id}}}),
+            fields = {key: {'$elemMatch': {'_id': item_id}}}
+        )
+        removed = [x for x in (raw or {}).get(key) or [] if x['_id'] == item_id]
+        if removed:
+            self._db.history_update(
+                collection = self._collection.name,
+                id = id,
+                username = username,
+                diff = [{key: {'action': 'object removed', 'data': removed[0]}}]
+            )
+        return bool(removed)
+
+
+    def _pull_bucketed(self, id, key, item_id, username):
+        # Later items move up a place, so the buckets from the item's own on are rewritten
+        size = self.buckets[key]
+        found = buckets.find_item(self._bucket(key), id, item_id, size)
+        if found is None and self._move_inline(id, key):
+            found = buckets.find_item(self._bucket(key), id, item_id, size)
+        if found is None:
+            return False
+        start = found[0] // size
+        old = buckets.load_items(self._bucket(key), id, start)
+        items = [x for x in old if x['_id'] != item_id]
+        buckets.write_tail(self._bucket(key), id, start, items, old, size)
+        self._bump_bucketed(id)
+        self._db.history_update(
+            collection = self._collection.name,
+            id = id,
+            username = username,
+            diff = [{key: {'action': 'object removed', 'data': found[1]}}]
+        )
+        return True
+
+
+    def remove(self, spec_or_id, username=None, batch_size=1000, progress=None):
+        '''
+        Streams the matched documents batch_size at a time; each batch is deleted by _id
+        with $in and its history records written in one insert.  progress, if given, is
+        called with the running count of removed documents after each batch.
+        '''
+        spec = isinstance(spec_or_id, dict) and spec_or_id or {'_id': spec_or_id}
+        removed = 0
+        for batch in chunked(self._collection.find(spec), batch_size):
+            ids = [x['_id'] for x in batch]
+            result = self._collection.remove({'_id': {'$in': ids}})
+            if not result.get('ok', False):
+                return result
+            self._load_buckets(batch)
+            for key in self.buckets:
+                self._bucket(key).remove({'parent': {'$in': ids}})
+            self._db.history_write([
+                self._db.history_record(self._collection.name, x['_id'], username, action='document removed', data=x)
+                for x in batch
+            ])
+            removed += result.get('n', len(batch))
+            if progress:
+                progress(removed)
+            
+        return {'ok': 1.0, 'n': removed}
+
+
+
+def _aggregate(collection, pipeline):
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
+
+
+def _list_page(collection, head, key, skip, limit, spec):
+    'Returns (items, total) for a page of the embedded lists at key of the documents head matches'
+    match = spec and _item_spec(key, spec)
+    try:
+        return _list_page_aggregate(collection, head, key, skip, limit, match)
+    except (NotImplementedError, OperationFailure):
+        # No $slice or $facet: unwind instead and page what matched here
+        found = _aggregate(collection, head + [{'$unwind': '$' + key}] + (match and [{'$match': match}] or []))
+        return ([x[key] for x in found[skip:limit and skip + limit or None]], len(found))
+
+
+def _list_page_aggregate(collection, head, key, skip, limit, match):
+    head = head + [{'$project': {key: 1}}]
+    if match is None:
+        stored = {'$ifNull': ['$' + key, []]}
+        found = _aggregate(collection, head + [{'$project': {
+            'total': {'$size': stored},
+            'items': {'$slice': [stored, skip, limit or 2 ** 31 - 1]},
+        }}])
+        return found and (found[0]['items'], found[0]['total']) or ([], 0)
+
+    page = (skip and [{'$skip': skip}] or []) + (limit and [{'$limit': limit}] or [])
+    found = _aggregate(collection, head + [
+        {'$unwind': '$' + key},
+        {'$match': match},
+        {'$facet': {'items': page or [{'$skip': 0}], 'total': [{'$count': 'n'}]}},
+    ])[0]
+    return ([x[key] for x in found['items']], found['total'] and found['total'][0]['n'] or 0)
+
+
+def _item_spec(key, spec):
+    'spec on the objects of the embedded list at key, as a spec on the unwound documents'
+    result = {}
+    for field, cond in spec.items():
+        if field in ['$and', '$or', '$nor']:
+            result[field] = [_item_spec(key, x) for x in cond]
+        else:
+            result[key + '.' + field] = cond
+    return result
+
+
+def bump_version(update):
+    update.setdefault('$inc', {})[VERSION_KEY] = 1
+    return update
+
+
+def _unversioned(changes):
+    return [x for x in changes if VERSION_KEY not in x]
+
+
+
+class Page(object):
+    def __init__(self, items, total, has_more, skip, limit):
+        self.items = items
+        self.total = total
+        self.has_more = has_more
+        self.skip = skip
+        self.limit = limit
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+
+class ListCursor(list):
+    'Already-fetched results behind the CursorWrapper interface'
+    def all(self):
+        return list(self)
+
+    def count(self):
+        return len(self)
+
 
 
 class CursorWrapper(object):
@@ -144,22 +731,97 @@ class CursorWrapper(object):
         self._projected_cursor = projected_cursor
             
     def __getitem__(self, index):
-        return DBDoc(self._raw_cursor[index], None, self._projected_cursor and self._projected_cursor[index])
+        return self._wrap(self._raw_cursor[index], self._projected_cursor and self._projected_cursor[index])
+
+    def __iter__(self):
+        if self._projected_cursor:
+            for raw, proj in izip(self._raw_cursor, self._projected_cursor):
+                yield self._wrap(raw, proj)
+        else:
+            for raw in self._raw_cursor:
+                yield self._wrap(raw, None)
+
+    def _wrap(self, raw, proj):
+        return DBDoc(raw, None, proj)
         
     def all(self):
-        return [self[i] for i in range(self.count())]
+        return [x for x in self]
         
     def count(self):
         return self._raw_cursor.count()
 
 
 
+def chunked(iterable, size):
+    'Lists of up to size items from iterable, without reading ahead of the current one'
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_path(doc, path):
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
 
 
+def project(doc, fields):
+    'Client-side equivalent of a find() projection'
+    if isinstance(fields, dict) and fields and not any(fields.values()):
+        result = deepcopy(doc)
+        for key in fields:
+            parts = key.split('.')
+            parent = get_path(result, '.'.join(parts[:-1])) if len(parts) > 1 else result
+            if isinstance(parent, dict):
+                parent.pop(parts[-1], None)
+        return result
 
+    result = {'_id': doc['_id']}
+    for key in [x for x in fields if not isinstance(fields, dict) or fields[x]]:
+        parts = key.split('.')
+        src, dst = doc, result
+        for part in parts[:-1]:
+            if not isinstance(src, dict) or part not in src:
+                break
+            src = src[part]
+            dst = dst.setdefault(part, {})
+        else:
+            if isinstance(src, dict) and parts[-1] in src:
+                dst[parts[-1]] = deepcopy(src[parts[-1]])
+    return result
 
 
+def keyset_spec(sort, values):
+    '''
+    Range query selecting everything after the given sort key values.  Null and missing
+    values sort before all others, and match neither $gt nor $lt, so they get clauses of
+    their own.
+    '''
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        clause = dict((x[0], val) for x, val in zip(sort[:i], values[:i]))
+        value = values[i]
+        if direction > 0:
+            clause[key] = value is None and {'$exists': True, '$ne': None} or {'$gt': value}
+        elif value is None:
+            # Nothing sorts below null
+            continue
+        else:
+            clause['$or'] = [{key: {'$lt': value}}, {key: None}]
+        clauses.append(clause)
+    if not clauses:
+        return {'_id': {'$in': []}}
+    return len(clauses) == 1 and clauses[0] or {'$or': clauses}
 
 
+def encode_keyset_token(values):
+    return base64.urlsafe_b64encode(json_util.dumps(values))
 
 
+def decode_keyset_token(token):
+    return json_util.loads(base64.urlsafe_b64decode(str(token)))
@@ -1,20 +1,87 @@
 
 import datetime
-from dateutil.tz import tzlocal
+import time
+from bson import json_util
+from contextlib import contextmanager
 from pymongo import MongoClient
-from collection import CollectionWrapper
+from dateutil.tz import tzutc
+from collection import CollectionWrapper, RetryPolicy, encode_keyset_token, decode_keyset_token
+from accounting import AccountedDatabase, QueryLog, QueryBudgetExceeded
+from session import Session
+import buckets
+from dates import LOCAL_TZ
+
+
+HISTORY_SEQ = '_history'    # _ids entry numbering history records, see DatabaseWrapper.changes
 
 
 class DatabaseWrapper(object):
     def __init__(self, client=None, dbname=None):
         self._client = client or MongoClient(tz_aware=True)
-        self._db = self._client[dbname or 'test']
+        self._query_logs = []
+        self._db = AccountedDatabase(self._client[dbname or 'test'], self._query_logs)
         self.history = self._db._history
+        self.count_cache_ttl = 60
+        self._count_cache = {}
+        self.versioned = {}
+        self.buckets = {}
+        self._history_indexed = False
         
     def __getattr__(self, key):
         return CollectionWrapper(self._db[key], self)
     
-    
+
+    @contextmanager
+    def track_queries(self, warn_after=None):
+        query_log = QueryLog(warn_after)
+        self._query_logs.append(query_log)
+        try:
+            yield query_log
+        finally:
+            self._query_logs.remove(query_log)
+
+
+    @contextmanager
+    def query_budget(self, limit):
+        with self.track_queries() as query_log:
+            yield query_log
+        if query_log.count > limit:
+            raise QueryBudgetExceeded("%i queries issued, budget was %i:\n%s" % (query_log.count, limit, query_log.summary()))
+
+
+    def session(self, username=None):
+        return Session(self, username)
+
+
+    def versioning(self, collection, policy=None):
+        '''
+        Makes updates to collection conditional on each document's _v counter, retrying
+        merging updates that lose a race under policy (a RetryPolicy)
+        '''
+        self.versioned[collection] = policy or RetryPolicy()
+
+
+    def bucketing(self, collection, key, size=100):
+        '''
+        Stores the embedded list at key of collection's documents in the collection
+        'collection.key', in buckets of size objects, see buckets.py
+        '''
+        assert '.' not in key, "Only top-level lists can be bucketed"
+        self.buckets.setdefault(collection, {})[key] = size
+        # Reads go by parent, and append_item relies on one bucket per (parent, n)
+        buckets.bucket_collection(self, collection, key).ensure_index([('parent', 1), ('n', 1)], unique=True)
+
+
+    def get_cached_count(self, collection, spec):
+        entry = self._count_cache.get((collection, json_util.dumps(spec, sort_keys=True)))
+        if entry and entry[1] > time.time():
+            return entry[0]
+
+    def set_cached_count(self, collection, spec, count):
+        key = (collection, json_util.dumps(spec, sort_keys=True))
+        self._count_cache[key] = (count, time.time() + self.count_cache_ttl)
+
+
     def get_next_id(self, collection):
         if not self._db._ids.find({'collection': collection}).count():
             return 1
@@ -39,36 +106,71 @@ class DatabaseWrapper(object):
         )
     
     
+    def history_record(self, collection, id, username, **fields):
+        record = {
+            'collection': collection,
+            'id':  id,
+            'time': datetime.datetime.now(LOCAL_TZ),
+            'username': username,
+        }
+        record.update(fields)
+        return record
+
+    def history_write(self, records, session=None):
+        '''
+        Inserts one history record or a list of them, numbered with consecutive seq
+        values from a single counter increment, in the order changes() returns them
+        '''
+        if not isinstance(records, list):
+            records = [records]
+        if not self._history_indexed:
+            # changes() polls by seq
+            self._db._history.ensure_index('seq')
+            self._history_indexed = True
+        last = self._db._ids.find_and_modify(
+            {'collection': HISTORY_SEQ},
+            {'$inc': {'last_id': len(records)}},
+            upsert = True,
+            new = True
+        )['last_id']
+        for seq, record in enumerate(records, last - len(records) + 1):
+            record['seq'] = seq
+        if session is not None:
+            self._db._history.insert_many(records, session=session)
+        else:
+            self._db._history.insert(records)
+
     def history_insert(self, collection, id, username):
-        self._db._history.insert(
-            {
-                'collection': collection,
-                'id':  id,
-                'time': datetime.datetime.now().replace(tzinfo=tzlocal()),
-                'username': username,
-                'action': 'document created'
-            }            
-        )
+        self.history_write(self.history_record(collection, id, username, action='document created'))
 
     def history_update(self, collection, id, username, diff):
-        self._db._history.insert(
-            {
-                'collection': collection,
-                'id':  id,
-                'time': datetime.datetime.now().replace(tzinfo=tzlocal()),
-                'username': username,
-                'changes': diff
-            }            
-        )
+        self.history_write(self.history_record(collection, id, username, changes=diff))
     
     def history_remove(self, collection, id, username, data):
-        self._db._history.insert(
-            {
-                'collection': collection,
-                'id':  id,
-                'time': datetime.datetime.now().replace(tzinfo=tzlocal()),
-                'username': username,
-                'action': 'document removed',
-                'data': data                
-            }            
-        )
+        self.history_write(self.history_record(collection, id, username, action='document removed', data=data))
+
+
+    def changes(self, since=None, limit=1000, collections=None, gap_timeout=5):
+        '''
+        Returns (events, token): the history records written after the one since names,
+        at most limit of them, in seq order, and the token to pass as since next time.
+        since=None starts from the beginning.  With collections only those collections'
+        events are returned, so a batch may come back short or empty with the token
+        still moved on.
+
+        seq numbers are taken before the record is written, so a gap may be a write
+        still in flight: a batch stops before a gap until the record after it is
+        gap_timeout seconds old, after which the gap is taken as a failed write.
+        '''
+        after = since and decode_keyset_token(since)[0] or 0
+        records = self._db._history.find(spec={'seq': {'$gt': after}}, sort=[('seq', 1)], limit=limit)
+        settled = datetime.datetime.now(tzutc()) - datetime.timedelta(seconds=gap_timeout)
+        events = []
+        for record in records:
+            written = record['time'].tzinfo and record['time'] or record['time'].replace(tzinfo=tzutc())
+            if record['seq'] != after + 1 and written > settled:
+                break
+            after = record['seq']
+            if collections is None or record['collection'] in collections:
+                events.append(record)
+        return (events, encode_keyset_token([after]))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import re
+import datetime
+import dateutil.parser
+from dateutil.tz import tzlocal, tzutc, tzoffset
+
+
+LOCAL_TZ = tzlocal()
+UTC = tzutc()
+
+
+_iso_format = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d{1,6})\d*)?)?)?'
+    r'(Z|[+-]\d\d(?::?\d\d)?)?$'
+)
+
+
+def parse_datetime(val):
+    '''
+    Strict ISO 8601 (date, date and time to any precision, Z or +hh:mm offsets)
+    parsed directly; anything else goes through dateutil
+    '''
+    match = _iso_format.match(val)
+    if match is None:
+        return dateutil.parser.parse(val)
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    tz = None
+    if zone == 'Z':
+        tz = UTC
+    elif zone:
+        sign = zone[0] == '-' and -1 or 1
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:] if len(zone) > 3 else 0) * 60
+        tz = tzoffset(None, sign * offset)
+    try:
+        return datetime.datetime(
+            int(year), int(month), int(day),
+            int(hour or 0), int(minute or 0), int(second or 0),
+            int((fraction or '0').ljust(6, '0')),
+            tz
+        )
+    except ValueError:
+        return dateutil.parser.parse(val)
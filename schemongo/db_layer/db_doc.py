@@ -1,18 +1,24 @@
 #!/usr/bin/env python
 
 import copy
+from journal import Journal, journal_changes
+
+
+SEQ_KEY = '_seq'    # per-document counters of embedded list item ids, see CollectionWrapper.push_item
+VERSION_KEY = '_v'  # per-document write counter of versioned collections, see DatabaseWrapper.versioning
 
 class DBDoc(dict):
     def __init__(self, raw, parent=None, projection=None):
         dict.__init__(self, raw)
         self._parent = parent
         self._projection = projection
+        self._journal = None
         
         for key, val in self.items():
             if isinstance(val, dict):
                 self[key] = DBDoc(val, self)
             elif isinstance(val, list) and len(val) and isinstance(val[0], dict):
-                self[key] = DBDocList(val, self)
+                self[key] = DBDocList(val, self, getattr(val, '_partial', None))
         
     def __getattr__(self, key):
         if key not in self:
@@ -32,12 +38,72 @@ class DBDoc(dict):
             current = current._parent
         return current
 
+    def track_changes(self):
+        'Starts journaling mutations to this document and everything below it'
+        self._attach_journal(Journal(self))
+        return self
+
+    def get_changes(self, history=True):
+        'Returns (mongo update, history changes) for the mutations since track_changes()'
+        return journal_changes(self, history)
+
+    def clear_changes(self):
+        self._attach_journal(Journal(self))
+
+    def _attach_journal(self, journal):
+        self._journal = journal
+        for key, val in dict.items(self):
+            if isinstance(val, (DBDoc, DBDocList)):
+                val._attach_journal(journal)
+            elif isinstance(val, list):
+                journal.record_plain(self, key)
+
+    def __setitem__(self, key, val):
+        if self._journal:
+            self._journal.record_key(self, key)
+        dict.__setitem__(self, key, val)
+
+    def __delitem__(self, key):
+        if self._journal:
+            self._journal.record_key(self, key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if self._journal and key in self:
+            self._journal.record_key(self, key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwords):
+        for key, val in dict(*args, **kwords).items():
+            self[key] = val
+
+
+
+def _journaled(method):
+    def wrapper(self, *args, **kwords):
+        if self._journal:
+            self._journal.record_list(self)
+        return method(self, *args, **kwords)
+    wrapper.__name__ = method.__name__
+    return wrapper
 
 
 class DBDocList(list):
-    def __init__(self, raw, parent=None):
+    '''
+    partial: (skip, total) when this holds only part of the stored list, see
+    CollectionWrapper.find_items.  merge() then updates and adds the objects it holds
+    by _id without dropping the others, and whole-document writes refuse it.
+    '''
+    def __init__(self, raw, parent=None, partial=None):
         list.__init__(self)
         self._parent = parent
+        self._journal = None
+        self._partial = partial
 
         for item in raw:
             self.append(DBDoc(item, self))
@@ -51,13 +117,33 @@ class DBDocList(list):
             current = current._parent
         return current
 
+    def _attach_journal(self, journal):
+        self._journal = journal
+        for val in self:
+            if isinstance(val, DBDoc):
+                val._attach_journal(journal)
+
+    append = _journaled(list.append)
+    extend = _journaled(list.extend)
+    insert = _journaled(list.insert)
+    remove = _journaled(list.remove)
+    pop = _journaled(list.pop)
+    sort = _journaled(list.sort)
+    reverse = _journaled(list.reverse)
+    __setitem__ = _journaled(list.__setitem__)
+    __delitem__ = _journaled(list.__delitem__)
+    __setslice__ = _journaled(list.__setslice__)
+    __delslice__ = _journaled(list.__delslice__)
+    __iadd__ = _journaled(list.__iadd__)
+
 
 
         
 def enforce_ids(item, _id):
     if isinstance(item, dict):
-        for val in item.values():
-            enforce_ids(val, 1)
+        for key, val in item.items():
+            if key != SEQ_KEY:
+                enforce_ids(val, 1)
         if '_id' not in item or not item['_id']:
             item['_id'] = _id
             return _id + 1
@@ -71,21 +157,52 @@ def enforce_ids(item, _id):
 
 
 
+def partial_paths(doc, prefix=''):
+    'Dotted paths of the partial DBDocLists in doc'
+    paths = []
+    for key, val in dict.items(doc):
+        if getattr(val, '_partial', None):
+            paths.append(prefix + key)
+        elif isinstance(val, dict):
+            paths.extend(partial_paths(val, prefix + key + '.'))
+    return paths
+
+
 def merge(original, new):
     for key, val in new.items():
-        if isinstance(val, dict) and key in original and isinstance(original[key], dict):
+        if getattr(val, '_partial', None) and key in original and isinstance(original[key], list):
+            stored = dict((x['_id'], x) for x in original[key] if isinstance(x, dict) and '_id' in x)
+            for doc in val:
+                if doc.get('_id') in stored:
+                    merge(stored[doc['_id']], doc)
+                else:
+                    original[key].append(DBDoc(doc, original[key]))
+        elif isinstance(val, dict) and key in original and isinstance(original[key], dict):
             merge(original[key], val)
         elif isinstance(val, dict):
             original[key] = DBDoc(val, original)
         elif isinstance(val, list) and key in original and isinstance(original[key], list) and len(val) and isinstance(val[0], dict):
-            old = original[key]
-            ids = [x['_id'] for x in old]
+            old = {}
+            for x in reversed(original[key]):
+                old[x['_id']] = x
+            reused = set()
             original[key] = DBDocList([], original)
             for doc in val:
-                if '_id' in doc and doc['_id'] in ids:
-                    new = old[ids.index(doc['_id'])]
+                if '_id' in doc and doc['_id'] in reused:
+                    # A repeated _id merges into a copy of the result so far, leaving the earlier entry as it was
+                    new = old[doc['_id']] = DBDoc(copy.deepcopy(old[doc['_id']]), original[key])
+                    merge(new, doc)
+                    original[key].append(new)
+                elif '_id' in doc and doc['_id'] in old:
+                    reused.add(doc['_id'])
+                    new = old[doc['_id']]
                     merge(new, doc)
-                    original[key].append(DBDoc(new, original[key]))
+                    if isinstance(new, DBDoc):
+                        # Already wrapped: move it over instead of copying the subtree
+                        new._parent = original[key]
+                        original[key].append(new)
+                    else:
+                        original[key].append(DBDoc(new, original[key]))
                 else:
                     original[key].append(DBDoc(doc, original[key]))
         else:
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+from copy import deepcopy
+from diff import diff_recursive, diff_lists_recursive
+
+
+'''
+Change journal for DBDoc trees.  DBDoc.track_changes() attaches one Journal to every
+node of a document; from then on each DBDoc records the first old value of any key it
+sets or deletes, and each DBDocList snapshots itself on its first mutation.  Lists of
+plain values are snapshotted up front and compared when the changes are collected.
+
+journal_changes() turns the journal into a Mongo update ($set/$unset) and a history
+change list in the same format diff_recursive() produces.
+'''
+
+
+MISSING = object()
+
+
+class Journal(object):
+    def __init__(self, root):
+        self.root = root
+        self.keys = {}
+        self.lists = {}
+        self.plain = {}
+
+    def record_key(self, node, key):
+        if (id(node), key) not in self.keys:
+            old = dict.get(node, key, MISSING)
+            if isinstance(old, (dict, list)):
+                # merge() edits replaced subtrees in place, so keep a copy
+                old = deepcopy(old if isinstance(old, dict) else list(old))
+            self.keys[(id(node), key)] = (node, key, old)
+
+    def record_list(self, node):
+        if id(node) not in self.lists:
+            self.lists[id(node)] = (node, deepcopy(list(node)))
+
+    def record_plain(self, node, key):
+        self.plain[(id(node), key)] = (node, key, list(dict.__getitem__(node, key)))
+
+
+
+def _node_path(journal, node):
+    'Path of keys from the journal root to node, or None if node is no longer attached'
+    path = []
+    while node is not journal.root:
+        parent = node._parent
+        if parent is None:
+            return None
+        if isinstance(parent, list):
+            keys = [i for i, x in enumerate(parent) if x is node]
+        else:
+            keys = [k for k, x in dict.items(parent) if x is node]
+        if not keys:
+            return None
+        path.insert(0, keys[0])
+        node = parent
+    return path
+
+
+def _covered(path, dirty):
+    return any(tuple(path[:i]) in dirty for i in range(len(path)))
+
+
+def _diff_value(new, old, path):
+    if old is MISSING and new is MISSING:
+        return []
+    if old is MISSING:
+        return [{path: {'action': 'field added'}}]
+    if new is MISSING:
+        return [{path: {'action': 'field removed', 'data': old}}]
+    if isinstance(new, dict) and isinstance(old, dict):
+        return diff_recursive(new, old, path + '/')
+    if isinstance(new, list) and isinstance(old, list):
+        return diff_lists_recursive(new, old, path)
+    if new != old:
+        return [{path: old}]
+    return []
+
+
+def journal_changes(doc, history=True):
+    '''
+    Returns (update, changes) for a tracked document: the Mongo update operators
+    that apply its recorded mutations, and their history change records.  With
+    history=False changes is left empty, so new list objects need no _id yet.
+    '''
+    journal = doc._journal
+    entries = []
+    for node, key, old in journal.keys.values():
+        path = _node_path(journal, node)
+        if path is not None:
+            entries.append((path + [key], dict.get(node, key, MISSING), old))
+    for node, old in journal.lists.values():
+        path = _node_path(journal, node)
+        if path is not None:
+            entries.append((path, list(node), old))
+    for node, key, old in journal.plain.values():
+        if (id(node), key) in journal.keys:
+            continue
+        path = _node_path(journal, node)
+        new = dict.get(node, key, MISSING)
+        if path is not None and new is not MISSING and new != old:
+            entries.append((path + [key], new, old))
+
+    entries = [x for x in entries if x[1] is MISSING or x[1] != x[2]]
+    dirty = set(tuple(x[0]) for x in entries)
+    update = {}
+    changes = []
+    for path, new, old in sorted(entries, key=lambda x: x[0]):
+        if _covered(path, dirty):
+            continue
+        mongo_path = '.'.join(str(x) for x in path)
+        if new is MISSING:
+            update.setdefault('$unset', {})[mongo_path] = ''
+        else:
+            update.setdefault('$set', {})[mongo_path] = new
+        if history:
+            changes.extend(_diff_value(new, old, '/'.join(str(x) for x in path)))
+    return (update, changes)
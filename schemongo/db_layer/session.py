@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import inspect
+from pymongo.errors import OperationFailure
+from db_doc import DBDoc, enforce_ids, merge, VERSION_KEY
+from collection import ConflictError, bump_version
+
+try:
+    from pymongo import UpdateOne
+except ImportError:
+    UpdateOne = None
+
+
+'''
+Unit of work.  A Session keeps an identity map of the documents it has loaded, one
+tracked DBDoc per stored document, and buffers inserts, updates and removes until
+commit().  Commit writes one insert, one bulk update and one remove per collection,
+then a single history insert and one _ids update per inserted-into collection:
+
+    with db.session('bob') as session:
+        user = session.users.find_one(4)
+        user['visits'] += 1
+        session.users.update(user)
+        session.log.insert({'user': 4})
+
+Where the driver has sessions the writes run in a multi-document transaction; a
+server that refuses transactions (standalone, mongomock) gets the same writes
+without one.  Leaving the with-block through an exception discards the buffer.
+'''
+
+
+TRANSACTIONS_UNSUPPORTED = 20     # IllegalOperation, raised by standalone servers
+
+
+def _supports(obj, name):
+    return inspect.ismethod(getattr(obj, name, None))
+
+
+class Session(object):
+    def __init__(self, db, username=None):
+        self.db = db
+        self.username = username
+        self._docs = {}
+        self._reset()
+
+    def _reset(self):
+        self._bumped = []
+        self._inserts = {}
+        self._inserted = set()
+        self._updates = {}
+        self._removes = {}
+        self._next_ids = {}
+        self._order = []
+
+    def __getattr__(self, key):
+        return self[key]
+
+    def __getitem__(self, key):
+        return SessionCollection(self, key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+    def _touch(self, name):
+        if name not in self._order:
+            self._order.append(name)
+
+    def _register(self, name, raw):
+        key = (name, raw['_id'])
+        if key not in self._docs:
+            self._docs[key] = DBDoc(raw).track_changes()
+        return self._docs[key]
+
+    def _removed(self, name, id):
+        return id in self._removes.get(name, [])
+
+    def _next_id(self, name):
+        if name not in self._next_ids:
+            self._next_ids[name] = self.db.get_next_id(name)
+        return self._next_ids[name]
+
+
+    def rollback(self):
+        self._docs = {}
+        self._reset()
+
+    def commit(self):
+        writes, records = self._plan()
+        client = self.db._client
+        if _supports(client, 'start_session') and writes:
+            try:
+                with client.start_session() as session:
+                    with session.start_transaction():
+                        self._write(writes, records, session)
+            except OperationFailure as e:
+                if e.code != TRANSACTIONS_UNSUPPORTED:
+                    raise
+                self._write(writes, records)
+        elif writes:
+            self._write(writes, records)
+
+        for name in [x for x in self._inserts if self._inserts[x]]:
+            self.db.set_last_id(name, self._next_ids[name] - 1)
+        for doc in self._docs.values():
+            doc.clear_changes()
+        for doc in self._bumped:
+            dict.__setitem__(doc, VERSION_KEY, (doc.get(VERSION_KEY) or 0) + 1)
+        self._reset()
+
+
+    def _plan(self):
+        'Reads what the buffered writes need and returns them as (collection, action, arg) steps plus history records'
+        writes = []
+        records = []
+        for name in self._order:
+            coll = self.db._db[name]
+
+            inserts = self._inserts.get(name)
+            if inserts:
+                writes.append((name, 'insert', inserts))
+                records.extend(self.db.history_record(name, x['_id'], self.username, action='document created') for x in inserts)
+
+            updates = self._updates.get(name, {})
+            unloaded = [id for id in updates if (name, id) not in self._docs]
+            if unloaded:
+                for raw in coll.find({'_id': {'$in': unloaded}}):
+                    self._register(name, raw)
+            versioned = name in self.db.versioned
+            ops = []
+            for id, incoming in updates.items():
+                doc = self._docs.get((name, id))
+                if doc is None:
+                    continue
+                for item in incoming:
+                    merge(doc, item)
+                enforce_ids(doc, id)
+                update, changes = doc.get_changes()
+                if update and versioned:
+                    # Only if the document is still at the version this session loaded
+                    ops.append(({'_id': id, VERSION_KEY: doc.get(VERSION_KEY)}, bump_version(update)))
+                    self._bumped.append(doc)
+                elif update:
+                    ops.append((id, update))
+                if changes:
+                    records.append(self.db.history_record(name, id, self.username, changes=changes))
+            if ops:
+                writes.append((name, 'update', ops))
+
+            removes = self._removes.get(name)
+            if removes:
+                data = [x for x in coll.find({'_id': {'$in': removes}})]
+                if data:
+                    writes.append((name, 'remove', [x['_id'] for x in data]))
+                records.extend(self.db.history_record(name, x['_id'], self.username, action='document removed', data=x) for x in data)
+
+        return (writes, records)
+
+
+    def _check_matched(self, name, ops, matched):
+        if name in self.db.versioned and matched < len(ops):
+            raise ConflictError("%i of %i documents in '%s' changed since the session read them" % (len(ops) - matched, len(ops), name))
+
+
+    def _write(self, writes, records, session=None):
+        for name, action, arg in writes:
+            coll = self.db._db[name]
+            if session is not None:
+                # Drivers with sessions only speak the CRUD API
+                if action == 'insert':
+                    coll.insert_many(arg, session=session)
+                elif action == 'update':
+                    result = coll.bulk_write([UpdateOne(_spec(x), y) for x, y in arg], ordered=False, session=session)
+                    self._check_matched(name, arg, result.matched_count)
+                else:
+                    coll.delete_many({'_id': {'$in': arg}}, session=session)
+            elif action == 'insert':
+                coll.insert(arg)
+            elif action == 'update':
+                self._check_matched(name, arg, _bulk_update(coll, arg))
+            else:
+                coll.remove({'_id': {'$in': arg}})
+
+        if records:
+            self.db.history_write(records, session)
+
+
+
+def _spec(spec_or_id):
+    return isinstance(spec_or_id, dict) and spec_or_id or {'_id': spec_or_id}
+
+
+def _bulk_update(coll, ops):
+    '(spec or _id, update) pairs written as one bulk update where the driver has it; returns how many matched'
+    if len(ops) > 1 and _supports(coll._collection, 'initialize_unordered_bulk_op'):
+        bulk = coll.initialize_unordered_bulk_op()
+        for spec, update in ops:
+            bulk.find(_spec(spec)).update_one(update)
+        return bulk.execute()['nMatched']
+    return sum(coll.update(_spec(spec), update).get('n', 0) for spec, update in ops)
+
+
+
+
+class SessionCollection(object):
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+        self._collection = session.db._db[name]
+        assert name not in session.db.buckets, "Sessions cannot write collections with bucketed lists"
+
+    def find(self, spec=None, skip=0, limit=0, sort=None):
+        'Stored documents only; inserts buffered in this session are not matched'
+        raws = self._collection.find(spec=spec, skip=skip, limit=limit, sort=sort)
+        return [self.session._register(self.name, x) for x in raws if not self.session._removed(self.name, x['_id'])]
+
+    def find_one(self, spec_or_id):
+        if not isinstance(spec_or_id, dict):
+            if self.session._removed(self.name, spec_or_id):
+                return None
+            if (self.name, spec_or_id) in self.session._docs:
+                return self.session._docs[(self.name, spec_or_id)]
+            spec_or_id = {'_id': spec_or_id}
+        raw = self._collection.find_one(spec_or_id)
+        if raw is None or self.session._removed(self.name, raw['_id']):
+            return None
+        return self.session._register(self.name, raw)
+
+
+    def insert(self, doc_or_docs):
+        if isinstance(doc_or_docs, list):
+            return [self._insert(x) for x in doc_or_docs]
+        return self._insert(doc_or_docs)
+
+    def _insert(self, doc):
+        assert not doc.get('_id'), "Cannot insert document with _id attribute"
+        session = self.session
+        if not isinstance(doc, DBDoc):
+            doc = DBDoc(doc)
+        session._next_ids[self.name] = enforce_ids(doc, session._next_id(self.name))
+        session._touch(self.name)
+        session._inserts.setdefault(self.name, []).append(doc)
+        session._inserted.add((self.name, doc['_id']))
+        session._docs[(self.name, doc['_id'])] = doc
+        return doc['_id']
+
+
+    def update(self, doc):
+        assert '_id' in doc, "Cannot update document without _id attribute"
+        session = self.session
+        key = (self.name, doc['_id'])
+        current = session._docs.get(key)
+        if current is not None and current is not doc:
+            merge(current, doc)
+        if key in session._inserted:
+            return
+        session._touch(self.name)
+        incoming = session._updates.setdefault(self.name, {}).setdefault(doc['_id'], [])
+        if current is None:
+            incoming.append(doc)
+
+
+    def remove(self, spec_or_id):
+        session = self.session
+        if isinstance(spec_or_id, dict):
+            ids = [x['_id'] for x in self._collection.find(spec=spec_or_id, fields=['_id'])]
+        else:
+            ids = [spec_or_id]
+
+        for id in ids:
+            key = (self.name, id)
+            doc = session._docs.pop(key, None)
+            if key in session._inserted:
+                session._inserted.remove(key)
+                session._inserts[self.name] = [x for x in session._inserts[self.name] if x is not doc]
+                continue
+            session._updates.get(self.name, {}).pop(id, None)
+            session._touch(self.name)
+            if not session._removed(self.name, id):
+                session._removes.setdefault(self.name, []).append(id)
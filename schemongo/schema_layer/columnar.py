@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import os
+import json
+import struct
+import datetime
+from dateutil.tz import tzutc
+from ..db_layer.collection import get_path
+from schema_doc import is_object
+
+try:
+    import numpy
+    from numpy.lib.format import magic, dtype_to_descr
+except ImportError:
+    numpy = None
+
+
+'''
+Columnar snapshots for analytics.  export_columns() writes every scalar field of a
+collection (nested objects flattened to dotted names) as one .npy array per column in
+a directory, with a .valid.npy mask for missing values.  Strings are a .offsets.npy
+array into a .blob file of UTF-8 bytes.  load_columns() maps the files back read-only
+without copying them:
+
+    db.export_columns('orders', '/data/orders')
+    snapshot = load_columns('/data/orders')
+    pandas.DataFrame(dict((x, snapshot[x]) for x in ['_id', 'total', 'placed']))
+
+Lists, plain dicts and serialize fields are left out.  Needs numpy.
+'''
+
+
+DTYPES = {
+    'integer': 'int64',
+    'reference': 'int64',
+    'float': 'float64',
+    'boolean': 'bool',
+    'datetime': 'datetime64[us]',
+}
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=tzutc())
+
+
+def column_types(schema, prefix=''):
+    'Dotted name and schema type of every column a snapshot of schema has'
+    columns = []
+    for key in sorted(schema.keys()):
+        field = schema[key]
+        if (key == '_id' and prefix) or 'serialize' in field:
+            continue
+        if is_object(field):
+            columns.extend(column_types(field['schema'], prefix + key + '.'))
+        elif field['type'] in DTYPES or field['type'] == 'string':
+            columns.append((prefix + key, field['type']))
+    return columns
+
+
+def export_columns(db, name, path, spec=None, batch_size=10000):
+    '''
+    Writes a snapshot of the documents matching spec to the directory path; returns how
+    many.  The rows are streamed from one cursor, batch_size at a time, and each file is
+    sized from the rows actually written, so documents changing meanwhile cannot leave
+    the columns out of step.
+    '''
+    if numpy is None:
+        raise ImportError("export_columns needs numpy")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    columns = column_types(db.schemas[name])
+    coll = db._db[name]
+
+    arrays = {}
+    valid = {}
+    blobs = {}
+    ends = {}
+    for column, _type in columns:
+        valid[column] = ColumnWriter(os.path.join(path, column + '.valid.npy'), 'bool', batch_size)
+        if _type == 'string':
+            arrays[column] = ColumnWriter(os.path.join(path, column + '.offsets.npy'), 'int64', batch_size)
+            arrays[column].append(0)
+            blobs[column] = open(os.path.join(path, column + '.blob'), 'wb')
+            ends[column] = 0
+        else:
+            arrays[column] = ColumnWriter(os.path.join(path, column + '.npy'), DTYPES[_type], batch_size)
+
+    rows = 0
+    try:
+        for doc in coll.find(spec, sort=[('_id', 1)]):
+            for column, _type in columns:
+                value = get_path(doc, column)
+                valid[column].append(value is not None)
+                if _type == 'string':
+                    if value is not None:
+                        value = unicode(value).encode('utf-8')
+                        blobs[column].write(value)
+                        ends[column] += len(value)
+                    arrays[column].append(ends[column])
+                else:
+                    arrays[column].append(None if value is None else _scalar(_type, value))
+            rows += 1
+    finally:
+        for blob in blobs.values():
+            blob.close()
+        for array in arrays.values() + valid.values():
+            array.close()
+
+    with open(os.path.join(path, 'meta.json'), 'w') as meta:
+        json.dump({'collection': name, 'count': rows, 'columns': columns}, meta)
+    return rows
+
+
+class ColumnWriter(object):
+    '''
+    Appends values to a .npy file a batch at a time.  Space for the header is reserved
+    up front and the header written on close, once the length is known.  None is
+    stored as zero.
+    '''
+    HEADER_SIZE = 128
+
+    def __init__(self, filename, dtype, batch_size):
+        self.dtype = numpy.dtype(dtype)
+        self.file = open(filename, 'wb')
+        self.file.seek(self.HEADER_SIZE)
+        self.buffer = numpy.zeros(batch_size, self.dtype)
+        self.pending = 0
+        self.length = 0
+
+    def append(self, value):
+        if value is not None:
+            self.buffer[self.pending] = value
+        self.pending += 1
+        if self.pending == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.buffer[:self.pending].tofile(self.file)
+        self.length += self.pending
+        self.buffer[:] = 0
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        header = repr({'descr': dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (self.length,)})
+        header = header.ljust(self.HEADER_SIZE - 11) + '\n'
+        self.file.seek(0)
+        self.file.write(magic(1, 0) + struct.pack('<H', len(header)) + header)
+        self.file.close()
+
+
+def _scalar(_type, value):
+    if _type == 'datetime':
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=tzutc())
+        delta = value - EPOCH
+        return numpy.datetime64((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds, 'us')
+    return value
+
+
+
+def load_columns(path):
+    if numpy is None:
+        raise ImportError("load_columns needs numpy")
+    return ColumnSnapshot(path)
+
+
+class ColumnSnapshot(object):
+    '''
+    A snapshot written by export_columns(), memory-mapped read-only.  snapshot[name] is
+    a numpy array, or a StringColumn for strings; snapshot.valid[name] is its mask.
+    '''
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as meta:
+            meta = json.load(meta)
+        self.collection = meta['collection']
+        self.count = meta['count']
+        self.types = dict((x, y) for x, y in meta['columns'])
+        self.names = [x for x, y in meta['columns']]
+        self.columns = {}
+        self.valid = {}
+        for name in self.names:
+            self.valid[name] = _map(path, name + '.valid.npy')[:self.count]
+            if self.types[name] == 'string':
+                offsets = _map(path, name + '.offsets.npy')[:self.count + 1]
+                self.columns[name] = StringColumn(offsets, _map(path, name + '.blob'), self.valid[name])
+            else:
+                self.columns[name] = _map(path, name + '.npy')[:self.count]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.count
+
+    def keys(self):
+        return list(self.names)
+
+
+def _map(path, filename):
+    filename = os.path.join(path, filename)
+    if filename.endswith('.npy'):
+        return numpy.load(filename, mmap_mode='r')
+    if not os.path.getsize(filename):
+        return numpy.zeros(0, 'uint8')
+    return numpy.memmap(filename, dtype='uint8', mode='r')
+
+
+class StringColumn(object):
+    'Strings of one snapshot column, decoded from the mapped blob on access'
+    def __init__(self, offsets, blob, valid):
+        self.offsets = offsets
+        self.blob = blob
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, index):
+        if not self.valid[index]:
+            return None
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tostring().decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
@@ -1,24 +1,50 @@
 #!/usr/bin/env python
 
+from collections import Counter
+from copy import deepcopy
 from ..db_layer import database
-from ..db_layer.collection import CursorWrapper
-from ..db_layer.db_doc import DBDoc
-from schema_doc import enforce_datatypes, merge, run_auto_funcs, generate_prototype, fill_in_prototypes, \
+from ..db_layer.collection import CursorWrapper, ListCursor, project, get_path, chunked
+from ..db_layer.db_doc import DBDoc, DBDocList, VERSION_KEY
+from schema_doc import enforce_datatypes, enforce_datatypes_bulk, merge, run_auto_funcs, changed_paths, Prototype, AllowedCache, \
                        enforce_schema_behaviors, is_object, is_list_of_objects, is_list_of_references
 from serialization import serialize, serialize_list, get_serial_dict, get_serial_list
+from expansion import expand_tree, subtree, reference_expansion, compile_lookup_pipeline, \
+                      resolve_reference_spec, reference_split, LOOKUP_KEY
+from session import SchemaSession
+import transfer
+import columnar
+import migration
+from pymongo.errors import OperationFailure
 
 from pprint import pprint as p
 
 
+REFERENCE_NOT_FOUND = 'reference not found'
+
+
 class SchemaDatabaseWrapper(database.DatabaseWrapper):
     def __init__(self, *args, **kwords):
         super(SchemaDatabaseWrapper, self).__init__(*args, **kwords)
         self.schemas = {}
         self.references = {}
+        self.expand_defaults = {}
+        self.prototypes = {}
+        self.stats = Counter()
+        self.allowed_store = {}
         
-    def register_schema(self, key, schema):
+    def register_schema(self, key, schema, expand=None):
+        for referring in self.references.values():
+            if key in referring:
+                referring.remove(key)
         self._prep_schema(schema, key)
         self.schemas[key] = schema
+        self.expand_defaults[key] = expand
+        self.prototypes[key] = Prototype(schema)
+        self.buckets.pop(key, None)
+        for field, val in schema.items():
+            if 'bucket' in val:
+                assert is_list_of_objects(val), "'%s': only lists of objects can be bucketed" % field
+                self.bucketing(key, field, val['bucket'])
         
     def _prep_schema(self, schema, coll_name):
         schema.update({'_id':{'type':'integer'}})
@@ -28,65 +54,106 @@ class SchemaDatabaseWrapper(database.DatabaseWrapper):
             elif is_list_of_objects(val):
                 self._prep_schema(schema[key]['schema']['schema'], coll_name)
             elif is_list_of_references(val):
-                remote = val['schema']['collection']
-                self.references[remote] = self.references.get(remote, [])
-                self.references[remote].append(coll_name)
+                self._add_reference(val['schema']['collection'], coll_name)
             elif val['type'] == 'reference':
-                remote = val['collection']
-                self.references[remote] = self.references.get(remote, [])
-                self.references[remote].append(coll_name)
+                self._add_reference(val['collection'], coll_name)
+
+    def _add_reference(self, remote, coll_name):
+        referring = self.references.setdefault(remote, [])
+        if coll_name not in referring:
+            referring.append(coll_name)
                 
     def check_singular_references(self, coll_name, id):
+        'id: one _id, or a list of them checked in the same pass'
+        ids = _id_set(id)
         for coll in self.references.get(coll_name,[]):
             schema = self.schemas[coll]
             err_list = []
-            for item in self[coll].find():
-                errs = self._check_singular_references_recursive(item, schema, coll_name, id)
+            for item in self._referring(coll, coll_name, ids, required=True):
+                errs = self._check_singular_references_recursive(item, schema, coll_name, ids)
                 if errs:
                     err_list.append("Collection '%s', item %s: undeleteable reference encountered" % (coll, item['_id']))
             if err_list:
                 return err_list
-    
-    def _check_singular_references_recursive(self, item, schema, coll_name, id):
+
+    def _referring(self, coll, coll_name, ids, required=False):
+        '''
+        The unexpanded documents of coll holding a reference to one of ids in coll_name,
+        found by querying the reference paths rather than scanning the collection
+        '''
+        wrapper = self[coll].coll
+        spec = []
+        for path in _reference_paths(self.schemas[coll], coll_name, required):
+            top, _, rest = path.partition('.')
+            if top in wrapper.buckets:
+                # Bucket items are raw, a reference stored as its bare _id
+                bucket = wrapper._bucket(top)
+                parents = [x['parent'] for x in bucket.find({'items.' + rest: {'$in': list(ids)}}, fields=['parent'])]
+                spec.append({'_id': {'$in': parents}})
+            else:
+                spec.append({path + '._id': {'$in': list(ids)}})
+        if not spec:
+            return []
+        return self[coll].find({'$or': spec}, expand=False)
+
+    def _check_singular_references_recursive(self, item, schema, coll_name, ids):
         for key, val in schema.items():
             if is_object(val):
-                errs = self._check_singular_references_recursive(item[key], schema[key]['schema'], coll_name, id)
+                errs = self._check_singular_references_recursive(item[key], schema[key]['schema'], coll_name, ids)
                 if errs:
                     return errs                
             elif is_list_of_objects(val):
                 for x in item[key]:
-                    errs = self._check_singular_references_recursive(x, schema[key]['schema']['schema'], coll_name, id)             
+                    errs = self._check_singular_references_recursive(x, schema[key]['schema']['schema'], coll_name, ids)             
                     if errs:
                         return errs
             elif val['type'] == 'reference' and 'required' in val and val['required']:
-                if item[key]['_id'] == id:
+                if item[key] and item[key]['_id'] in ids:
                     return True
 
     def remove_references(self, coll_name, id):
+        'id: one _id, or a list of them cleared in the same pass'
+        ids = _id_set(id)
         for coll in self.references.get(coll_name,[]):
             schema = self.schemas[coll]
-            for item in self[coll].find():
-                if self._remove_references_recursive(item, schema, coll_name, id):
+            for item in self._referring(coll, coll_name, ids):
+                if self._remove_references_recursive(item, schema, coll_name, ids):
                     self[coll].update(item)
 
-    def _remove_references_recursive(self, item, schema, coll_name, id):
+    def _remove_references_recursive(self, item, schema, coll_name, ids):
         result = False
         for key, val in schema.items():
             if is_object(val):
-                result = result or self._remove_references_recursive(item[key], schema[key]['schema'], coll_name, id)
+                result = self._remove_references_recursive(item[key], schema[key]['schema'], coll_name, ids) or result
             elif is_list_of_objects(val):
                 for x in item[key]:
-                    result = result or self._remove_references_recursive(x, schema[key]['schema']['schema'], coll_name, id)             
+                    result = self._remove_references_recursive(x, schema[key]['schema']['schema'], coll_name, ids) or result
             elif is_list_of_references(val):
-                if id in [x['_id'] for x in item[key]]:
-                    item[key] = [x for x in item[key] if x['_id'] != id]
+                if any(x['_id'] in ids for x in item[key]):
+                    item[key] = [x for x in item[key] if x['_id'] not in ids]
                     result = True
-            elif val['type'] == 'reference' and item[key]['_id'] == id:
+            elif val['type'] == 'reference' and item[key] and item[key]['_id'] in ids:
                 item[key] = None
                 result = True
         return result
                 
     
+    def session(self, username=None):
+        return SchemaSession(self, username)
+
+
+    def export_collection(self, name, out, spec=None):
+        return transfer.export_collection(self, name, out, spec)
+
+    def import_collection(self, name, lines, username=None, ids='preserve', history=True, batch_size=1000):
+        return transfer.import_collection(self, name, lines, username, ids, history, batch_size)
+
+    def export_columns(self, name, path, spec=None, batch_size=10000):
+        return columnar.export_columns(self, name, path, spec, batch_size)
+
+    def migrate(self, name, schema, username=None, batch_size=1000):
+        return migration.migrate(self, name, schema, username, batch_size)
+
     def __getattr__(self, key):
         return self[key]
 
@@ -100,29 +167,97 @@ class SchemaCollectionWrapper(object):
         self.schema = schema
         self.db = db
         self.coll = database.CollectionWrapper(collection, db)
-
-    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None):
-        return SchemaCursorWrapper(self.coll.find(spec, fields, skip, limit, sort), self.db, self.schema)
-
-    def find_one(self, spec_or_id, fields=None, skip=0, sort=None):
-        tmp = self.coll.find_one(spec_or_id, fields, skip, sort)
+        self.prototype = db.prototypes[collection.name]
+
+    def _expand_tree(self, expand):
+        if expand is None:
+            expand = self.db.expand_defaults.get(self.coll._collection.name)
+        return expand_tree(expand)
+
+    def _batch(self, lazy):
+        return lazy and ReferenceBatch(self.db) or None
+
+    def resolve_spec(self, spec):
+        return resolve_reference_spec(self.db, self.schema, spec)
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None, expand=None, lazy=False, lookup=False):
+        if lookup:
+            return self._find_lookup(spec, fields, skip, limit, sort, self._expand_tree(expand), self._batch(lazy))
+        return SchemaCursorWrapper(self.coll.find(self.resolve_spec(spec), fields, skip, limit, sort), self.db, self.schema,
+                                   self._expand_tree(expand), self._batch(lazy))
+
+    def _find_lookup(self, spec, fields, skip, limit, sort, expand, batch):
+        pipeline, refs = compile_lookup_pipeline(self.db, self.schema, spec, skip, limit, sort, expand)
+        try:
+            raws = self.coll.aggregate(pipeline)
+        except (NotImplementedError, OperationFailure):
+            if any(reference_split(self.schema, x[0]) for x in sort or []):
+                raise
+            return SchemaCursorWrapper(self.coll.find(self.resolve_spec(spec), fields, skip, limit, sort), self.db, self.schema, expand, batch)
+
+        results = ListCursor()
+        for raw in self.coll._load_buckets(raws):
+            found = raw.pop(LOOKUP_KEY, {})
+            data = DBDoc(raw, None, fields and project(raw, fields))
+            apply_lookups(self.db, refs, data, found, batch)
+            expand_references(self.db, self.schema, data, expand, batch=batch)
+            results.append(data)
+        return results
+
+    def find_one(self, spec_or_id, fields=None, skip=0, sort=None, expand=None, lazy=False, slices=None):
+        if slices:
+            [self._item_prototype(x) for x in slices]
+        tmp = self.coll.find_one(self.resolve_spec(spec_or_id), fields, skip, sort, slices)
         if not tmp:
             return
-        expand_references(self.db, self.schema, tmp)
+        expand_references(self.db, self.schema, tmp, self._expand_tree(expand), batch=self._batch(lazy))
         return tmp
+
+    def paginate(self, spec=None, fields=None, limit=20, sort=None, after=None, expand=None, lazy=False):
+        items, token = self.coll.paginate(self.resolve_spec(spec), fields, limit, sort, after)
+        tree = self._expand_tree(expand)
+        batch = self._batch(lazy)
+        for item in items:
+            expand_references(self.db, self.schema, item, tree, batch=batch)
+        return (items, token)
+
+    def find_page(self, spec=None, fields=None, skip=0, limit=20, sort=None, total='exact', expand=None, lazy=False):
+        page = self.coll.find_page(self.resolve_spec(spec), fields, skip, limit, sort, total)
+        tree = self._expand_tree(expand)
+        batch = self._batch(lazy)
+        for item in page:
+            expand_references(self.db, self.schema, item, tree, batch=batch)
+        return page
     
     
-    def process_insert(self, incoming):
+    def allowed_cache(self):
+        return AllowedCache(self.db.allowed_store)
+
+
+    def process_insert(self, incoming, allowed=None):
         errs = enforce_datatypes(self.schema, incoming)
         if errs:
             return (None, errs)
-            
-        data = generate_prototype(self.schema)
+        return self._validate_insert(incoming, allowed)
+
+
+    def process_inserts(self, docs, allowed=None):
+        '''
+        process_insert() for a batch, with the datatypes converted column by column (see
+        enforce_datatypes_bulk).  Returns a (data, errs) pair per document.
+        '''
+        allowed = allowed or self.allowed_cache()
+        return [(None, errs) if errs else self._validate_insert(incoming, allowed)
+                for incoming, errs in zip(docs, enforce_datatypes_bulk(self.schema, docs))]
+
+
+    def _validate_insert(self, incoming, allowed=None):
+        data = self.prototype.instantiate()
         merge(data, incoming)
-        fill_in_prototypes(self.schema, data)
-        run_auto_funcs(self.schema, data)
+        self.prototype.fill(data)
+        run_auto_funcs(self.schema, data, stats=self.db.stats)
         
-        errs = enforce_schema_behaviors(self.schema, data, self)
+        errs = enforce_schema_behaviors(self.schema, data, self, allowed=allowed or self.allowed_cache())
         if errs:
             return (None, errs)
             
@@ -130,38 +265,51 @@ class SchemaCollectionWrapper(object):
 
 
     def process_direct_insert(self, incoming):
-        data = generate_prototype(self.schema)
+        data = self.prototype.instantiate()
         merge(data, incoming)
-        fill_in_prototypes(self.schema, data)
-        run_auto_funcs(self.schema, data)
+        self.prototype.fill(data)
+        run_auto_funcs(self.schema, data, stats=self.db.stats)
         return (data, [])
     
     
-    def process_update(self, incoming):
+    def process_update(self, incoming, data=None, allowed=None):
         assert '_id' in incoming, "Cannot update document without _id attribute"
         
         errs = enforce_datatypes(self.schema, incoming)
         if errs:
             return (None, errs)
 
-        data = self.coll.find_one({"_id":incoming["_id"]})
-        merge(data, incoming)
-        fill_in_prototypes(self.schema, data)
-        run_auto_funcs(self.schema, data)
+        if data is None:
+            data = self.coll.find_one({"_id":incoming["_id"]})
+        return self._validate_update(incoming, data, allowed)
 
-        errs = enforce_schema_behaviors(self.schema, data, self)
+
+    def _validate_update(self, incoming, data, allowed=None):
+        self._merge_update(self.prototype, data, incoming)
+
+        errs = enforce_schema_behaviors(self.schema, data, self, allowed=allowed or self.allowed_cache())
         if errs:
             return (None, errs)
             
         return (data, [])
 
 
-    def process_direct_update(self, incoming):
-        data = self.coll.find_one({"_id":incoming["_id"]})
-        merge(data, incoming)
-        fill_in_prototypes(self.schema, data)
-        run_auto_funcs(self.schema, data)
+    def process_direct_update(self, incoming, data=None):
+        if data is None:
+            data = self.coll.find_one({"_id":incoming["_id"]})
+        self._merge_update(self.prototype, data, incoming)
         return (data, [])
+
+
+    def _merge_update(self, prototype, data, incoming):
+        changed = None
+        if prototype.depends:
+            data.track_changes()
+        merge(data, incoming)
+        prototype.fill(data)
+        if prototype.depends:
+            changed = changed_paths(data)
+        run_auto_funcs(prototype.schema, data, changed, self.db.stats)
     
     
     def insert(self, doc_or_docs, username=None, direct=False):
@@ -170,15 +318,12 @@ class SchemaCollectionWrapper(object):
         else:
             docs = doc_or_docs
             
-        datas = []
-        errs = []
-        for incoming in docs:
-            if direct:
-                data, local_errs = self.process_direct_insert(incoming)
-            else:
-                data, local_errs = self.process_insert(incoming)
-            datas.append(data)
-            errs.append(local_errs)
+        if direct:
+            results = [self.process_direct_insert(x) for x in docs]
+        else:
+            results = self.process_inserts(docs)
+        datas = [x[0] for x in results]
+        errs = [x[1] for x in results]
 
         if any(errs) and len(errs) == 1:
             return ([], errs[0])
@@ -190,43 +335,223 @@ class SchemaCollectionWrapper(object):
 
 
     def update(self, incoming, username=None, direct=False):
+        assert '_id' in incoming, "Cannot update document without _id attribute"
+        if not direct:
+            errs = enforce_datatypes(self.schema, incoming)
+            if errs:
+                return errs
+        retry = self.coll.retry
+        if retry is None or VERSION_KEY in incoming:
+            return self._update(incoming, username, direct)
+        return retry.run(lambda: self._update(incoming, username, direct))
+
+
+    def _update(self, incoming, username, direct):
+        if not direct:
+            # An update of _id alone is how documents are brought up to a changed schema
+            fields = len(incoming) > 1 and self.prototype.patch_fields(incoming.keys()) or None
+            if fields is not None and not fields & set(self.coll.buckets):
+                return self._patch(incoming, fields, username)
+
+        stored = self.coll.find_one({"_id":incoming["_id"]})
+        if stored is None:
+            return ["_id: '%s' not found" % incoming['_id']]
         if direct:
-            data, errs = self.process_direct_update(incoming)
+            data, errs = self.process_direct_update(incoming, deepcopy(stored))
         else:
-            data, errs = self.process_update(incoming)
+            data, errs = self._validate_update(incoming, deepcopy(stored))
         if errs:
             return errs
             
-        self.coll.update(data, username, direct=True)
+        self.coll.update(data, username, direct=True, stored=stored)
+
+
+    def _patch(self, incoming, fields, username=None):
+        '''
+        Update reading and writing only the fields incoming touches plus the auto fields
+        depending on them, see Prototype.patch_fields()
+        '''
+        if self.coll.retry:
+            fields = fields | set([VERSION_KEY])
+        raw = self.coll._collection.find_one({'_id': incoming['_id']}, fields=list(fields))
+        if raw is None:
+            return ["_id: '%s' not found" % incoming['_id']]
+        data = DBDoc(raw).track_changes()
+        merge(data, incoming)
+        self.prototype.fill(data, keys=fields)
 
+        schema = dict((k, v) for k, v in self.schema.items() if k in fields)
+        run_auto_funcs(schema, data, changed_paths(data), self.db.stats)
+        errs = enforce_schema_behaviors(self.schema, data, self, allowed=self.allowed_cache())
+        if errs:
+            return errs
 
-    def remove(self, spec_or_id, username=None):
-        if isinstance(spec_or_id, dict):
-            data = self.coll.find(spec_or_id)
-        else:
-            data = self.coll.find({'_id': spec_or_id})
-        data = [x for x in data]
-        
-        for item in data:
-            errs = self.db.check_singular_references(self.coll._collection.name, item._id)
-            if errs:
-                return errs
+        self.coll.update_tracked(data, username)
+
+
+    def _item_prototype(self, key):
+        assert key in self.schema and is_list_of_objects(self.schema[key]), "'%s' is not a list of objects" % key
+        return self.prototype.children[key]
+
+
+    def push_item(self, id, key, incoming, username=None):
+        prototype = self._item_prototype(key)
+        schema = prototype.schema
+        errs = enforce_datatypes(schema, incoming)
+        if errs:
+            return (None, errs)
+        if self._items_need_document(key):
+            def change(data):
+                item = prototype.instantiate(data[key])
+                item.pop('_id')   # numbered by the write
+                merge(item, incoming)
+                data[key].append(item)
+                return item
+            item, errs = self._write_through_document(id, key, change, username)
+            return (item and item['_id'], errs)
+
+        data = prototype.instantiate()
+        merge(data, incoming)
+        prototype.fill(data)
+        run_auto_funcs(schema, data, stats=self.db.stats)
+
+        errs = enforce_schema_behaviors(schema, data, self, allowed=self.allowed_cache())
+        if errs:
+            return (None, errs)
+
+        return (self.coll.push_item(id, key, data, username), None)
+
+
+    def update_item(self, id, key, incoming, username=None):
+        assert '_id' in incoming, "Cannot update item without _id attribute"
+        prototype = self._item_prototype(key)
+        schema = prototype.schema
+        errs = enforce_datatypes(schema, incoming)
+        if errs:
+            return errs
+
+        stored = self.coll.find_item(id, key, incoming['_id'])
+        if stored is None:
+            return ["%s: item %s not found" % (key, incoming['_id'])]
+        if self._items_need_document(key):
+            def change(data):
+                for item in data[key]:
+                    if item['_id'] == incoming['_id']:
+                        merge(item, incoming)
+                        return item
+            return self._write_through_document(id, key, change, username)[1]
+
+        data = DBDoc(deepcopy(stored[1]))
+        self._merge_update(prototype, data, incoming)
+
+        errs = enforce_schema_behaviors(schema, data, self, allowed=self.allowed_cache())
+        if errs:
+            return errs
 
-        self.db.remove_references(self.coll._collection.name, item._id)
+        self.coll.update_item(id, key, data, username, direct=True, stored=stored)
+
+
+    def pull_item(self, id, key, item_id, username=None):
+        self._item_prototype(key)
+        if not self._items_need_document(key):
+            return self.coll.pull_item(id, key, item_id, username)
+        if self.coll.find_item(id, key, item_id) is None:
+            return False
+        def change(data):
+            data[key] = DBDocList([x for x in data[key] if x['_id'] != item_id], data)
+        self._write_through_document(id, key, change, username)
+        return True
+
+
+    def _items_need_document(self, key):
+        '''
+        Whether item writes to key have to go through the whole document: an auto field
+        without 'depends' or an auto_init may read past the item (e.g. elem.get_root()),
+        and auto fields depending on key have to be recomputed.
+        '''
+        return self.prototype.opaque or _has_auto_init(self.prototype.children[key]) \
+            or any(key in x for x in self.prototype.auto_inputs.values())
+
+
+    def _write_through_document(self, id, key, change, username):
+        '''
+        Item write on the loaded document: change(data) edits the list at key and returns
+        the item it touched, if any, which is then validated on its own so errors read as
+        on the direct path.  All auto fields are rerun and the document is written whole.
+        Returns (item, errs), or (None, None) if the document does not exist.
+        '''
+        def write(stored):
+            if stored is None:
+                return (None, None)
+            data = deepcopy(stored)
+            data[key] = DBDocList(data.get(key) or [], data)
+            item = change(data)
+            self.prototype.fill(data)
+            run_auto_funcs(self.schema, data, stats=self.db.stats)
+
+            allowed = self.allowed_cache()
+            errs = item is not None and enforce_schema_behaviors(self.prototype.children[key].schema, item, self, allowed=allowed)
+            errs = errs or enforce_schema_behaviors(self.schema, data, self, allowed=allowed)
+            if errs:
+                return (None, errs)
+            self.coll.update(data, username, direct=True, stored=stored)
+            return (item, None)
+
+        written = lambda: write(self.coll.find_one({'_id': id}))
+        if self.coll.retry is None:
+            return written()
+        return self.coll.retry.run(written)
+
+
+    def find_items(self, id, key, skip=0, limit=20, spec=None, expand=None, lazy=False):
+        'One page of the embedded list at key, see CollectionWrapper.find_items'
+        schema = self._item_prototype(key).schema
+        page = self.coll.find_items(id, key, skip, limit, spec)
+        tree = subtree(self._expand_tree(expand), key)
+        batch = self._batch(lazy)
+        for item in page:
+            expand_references(self.db, schema, item, tree, batch=batch)
+        return page
+
+
+    def count_items(self, id, key):
+        self._item_prototype(key)
+        return self.coll.count_items(id, key)
+
+
+    def remove(self, spec_or_id, username=None, batch_size=1000, progress=None):
+        '''
+        Checks and clears references to the matched documents batch_size ids at a time,
+        then removes them in batches, see CollectionWrapper.remove
+        '''
+        name = self.coll._collection.name
+        spec = isinstance(spec_or_id, dict) and spec_or_id or {'_id': spec_or_id}
+        if self.db.references.get(name):
+            for ids in self._id_batches(spec, batch_size):
+                errs = self.db.check_singular_references(name, ids)
+                if errs:
+                    return errs
+            for ids in self._id_batches(spec, batch_size):
+                self.db.remove_references(name, ids)
         
-        self.coll.remove(spec_or_id, username)
+        self.coll.remove(spec_or_id, username, batch_size, progress)
+
+
+    def _id_batches(self, spec, batch_size):
+        for batch in chunked(self.coll._collection.find(spec, fields=['_id']), batch_size):
+            yield [x['_id'] for x in batch]
 
 
     def serialize(self, item):
-        return serialize(self.schema, item)
+        return serialize(self.schema, item, self.db.stats)
 
 
     def get_serial_dict(self, item):
-        return get_serial_dict(self.schema, item)
+        return get_serial_dict(self.schema, item, self.db.stats)
 
 
     def serialize_list(self, items):
-        return serialize_list(self.schema, items)
+        return serialize_list(self.schema, items, self.db.stats)
 
 
     def find_and_serialize(self, spec=None, fields=None, skip=0, limit=0, sort=None):
@@ -238,55 +563,246 @@ class SchemaCollectionWrapper(object):
 
 
     def find_and_serial_dict(self, spec=None, fields=None, skip=0, limit=0, sort=None):
-        return get_serial_list(self.schema, self.find(spec, fields, skip, limit, sort))
+        return get_serial_list(self.schema, self.find(spec, fields, skip, limit, sort), self.db.stats)
 
 
     def find_one_and_serial_dict(self, spec_or_id, fields=None, skip=0, sort=None):
-        return get_serial_dict(self.schema, self.find_one(spec_or_id, fields, skip, sort))
+        return get_serial_dict(self.schema, self.find_one(spec_or_id, fields, skip, sort), self.db.stats)
+
+
+
+def _has_auto_init(prototype):
+    return any('auto_init' in x for x in prototype.schema.values()) \
+        or any(_has_auto_init(x) for x in prototype.children.values())
+
+
+def _reference_paths(schema, coll_name, required=False, prefix=''):
+    'Dotted paths of the references to coll_name in schema, only the required ones if required'
+    paths = []
+    for key, val in schema.items():
+        if is_object(val):
+            paths.extend(_reference_paths(val['schema'], coll_name, required, prefix + key + '.'))
+        elif is_list_of_objects(val):
+            paths.extend(_reference_paths(val['schema']['schema'], coll_name, required, prefix + key + '.'))
+        elif is_list_of_references(val):
+            if val['schema']['collection'] == coll_name and not required:
+                paths.append(prefix + key)
+        elif val['type'] == 'reference' and val['collection'] == coll_name and (val.get('required') or not required):
+            paths.append(prefix + key)
+    return paths
+
+
+def _id_set(id):
+    return set(id) if isinstance(id, (list, set, tuple)) else set([id])
 
 
 
 class SchemaCursorWrapper(CursorWrapper):
-    def __init__(self, cursor, db, schema):
+    def __init__(self, cursor, db, schema, expand=True, batch=None):
         CursorWrapper.__init__(self, cursor._raw_cursor, cursor._projected_cursor)
         self.db = db
         self.schema = schema
+        self.expand = expand
+        self.batch = batch
 
-    def __getitem__(self, index):
-        tmp = CursorWrapper.__getitem__(self, index)
-        expand_references(self.db, self.schema, tmp)
+    def _wrap(self, raw, proj):
+        tmp = CursorWrapper._wrap(self, raw, proj)
+        expand_references(self.db, self.schema, tmp, self.expand, batch=self.batch)
         return tmp
 
 
 
-def expand_references(db, schema, data):
+class ReferenceBatch(object):
+    'Unresolved ReferenceProxy objects from one result set, fetched together'
+    def __init__(self, db):
+        self.db = db
+        self.pending = []
+
+    def resolve(self):
+        pending, self.pending = self.pending, []
+        groups = {}
+        for proxy in pending:
+            groups.setdefault(proxy._schema['collection'], []).append(proxy)
+
+        nested = ReferenceBatch(self.db)
+        for coll_name, proxies in groups.items():
+            ids = list(set(x['_id'] for x in proxies))
+            found = {}
+            for doc in self.db[coll_name].coll.find({'_id': {'$in': ids}}):
+                found[doc['_id']] = doc
+            for proxy in proxies:
+                proxy._fill(found.get(proxy['_id']), nested)
+
+
+class ReferenceProxy(DBDoc):
+    '''
+    Stands in for an expanded reference, holding only its _id until any other key is
+    read.  The first access resolves every pending proxy in the same ReferenceBatch.
+    A missing document leaves it holding only its _id, with _missing set, where eager
+    expansion gives REFERENCE_NOT_FOUND.
+    '''
+    def __init__(self, _id, schema, expand, seen, batch):
+        self._schema = schema
+        self._expand = expand
+        self._seen = seen
+        self._batch = batch
+        self._resolved = True
+        self._not_found = False
+        DBDoc.__init__(self, {'_id': _id})
+        self._resolved = False
+        batch.pending.append(self)
+
+    def resolve(self):
+        if not self._resolved:
+            self._batch.resolve()
+        return self
+
+    @property
+    def _missing(self):
+        'Whether the referenced document does not exist, which takes resolving the proxy'
+        return self.resolve()._not_found
+
+    def _fill(self, doc, batch):
+        self._resolved = True
+        if doc is None:
+            self._not_found = True
+            return
+        coll_name = self._schema['collection']
+        fields = self._schema.get('fields')
+        DBDoc.__init__(self, doc, None, fields and project(doc, fields))
+        expand_references(self._batch.db, self._batch.db.schemas[coll_name], self, self._expand,
+                          self._seen | frozenset([(coll_name, self['_id'])]), batch)
+        setattr(self, '__schema', self._batch.db.schemas[coll_name])
+
+    def __getattr__(self, key):
+        if key.startswith('__') and key.endswith('__'):
+            raise AttributeError(key)
+        self.resolve()
+        if key in self.__dict__:
+            return self.__dict__[key]
+        return DBDoc.__getattr__(self, key)
+
+    def __getitem__(self, key):
+        if key != '_id':
+            self.resolve()
+        return DBDoc.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key != '_id':
+            self.resolve()
+        return DBDoc.get(self, key, default)
+
+    def __contains__(self, key):
+        return key == '_id' or DBDoc.__contains__(self.resolve(), key)
+
+    def __iter__(self):
+        return DBDoc.__iter__(self.resolve())
+
+    def __len__(self):
+        return DBDoc.__len__(self.resolve())
+
+    def __eq__(self, other):
+        return DBDoc.__eq__(self.resolve(), other)
+
+    def __ne__(self, other):
+        return DBDoc.__ne__(self.resolve(), other)
+
+    def __repr__(self):
+        return DBDoc.__repr__(self.resolve())
+
+    def __deepcopy__(self, memo):
+        return DBDoc.__deepcopy__(self.resolve(), memo)
+
+    def keys(self):
+        return DBDoc.keys(self.resolve())
+
+    def values(self):
+        return DBDoc.values(self.resolve())
+
+    def items(self):
+        return DBDoc.items(self.resolve())
+
+    def iterkeys(self):
+        return DBDoc.iterkeys(self.resolve())
+
+    def itervalues(self):
+        return DBDoc.itervalues(self.resolve())
+
+    def iteritems(self):
+        return DBDoc.iteritems(self.resolve())
+
+
+
+def expand_references(db, schema, data, expand=True, seen=frozenset(), batch=None):
     for key in schema.keys():
         if is_object(schema[key]):
             if key in data:
-                expand_references(db, schema[key]['schema'], data[key])
+                expand_references(db, schema[key]['schema'], data[key], subtree(expand, key), seen, batch)
             else:
                 data[key] = None
         elif is_list_of_objects(schema[key]):
             if key in data:
-                [expand_references(db, schema[key]['schema']['schema'], x) for x in data[key]]
+                [expand_references(db, schema[key]['schema']['schema'], x, subtree(expand, key), seen, batch) for x in data[key]]
             else:
                 data[key] = []
         elif is_list_of_references(schema[key]):
             if key in data:
-                data[key] = [_expand_single_reference(db, schema[key]['schema'], x) for x in data[key] if data[key]]
+                child = reference_expansion(expand, key)
+                data[key] = [_expand_single_reference(db, schema[key]['schema'], x, child, seen, batch) for x in data[key] if data[key]]
             else:
                 data[key] = []
         elif schema[key]['type'] == 'reference':
             if key in data:
-                data[key] = data[key] and _expand_single_reference(db, schema[key], data[key])
+                child = reference_expansion(expand, key)
+                data[key] = data[key] and _expand_single_reference(db, schema[key], data[key], child, seen, batch)
             else:
                 data[key] = None
                 
                 
-def _expand_single_reference(db, schema, _id):
-    result = db[schema['collection']].find_one({'_id':_id}, fields=schema.get('fields', None))
+def apply_lookups(db, refs, data, found, batch=None):
+    'Replaces reference ids in data with the documents a lookup pipeline joined in as found'
+    for path, schema, is_list, expand in refs:
+        parts = path.split('.')
+        parent = get_path(data, '.'.join(parts[:-1])) if len(parts) > 1 else data
+        if not isinstance(parent, dict) or not parent.get(parts[-1]):
+            continue
+        docs = dict((x['_id'], x) for x in get_path(found, path) or [])
+        if is_list:
+            parent[parts[-1]] = [_looked_up_reference(db, schema, x, docs, expand, batch) for x in parent[parts[-1]]]
+        else:
+            parent[parts[-1]] = _looked_up_reference(db, schema, parent[parts[-1]], docs, expand, batch)
+
+
+def _looked_up_reference(db, schema, _id, docs, expand, batch):
+    coll_name = schema['collection']
+    if expand is None:
+        return DBDoc({'_id': _id})
+    if _id not in docs:
+        return REFERENCE_NOT_FOUND
+    if expand is True:
+        expand = expand_tree(db.expand_defaults.get(coll_name))
+    fields = schema.get('fields')
+    result = DBDoc(docs[_id], None, fields and project(docs[_id], fields))
+    expand_references(db, db.schemas[coll_name], result, expand, frozenset([(coll_name, _id)]), batch)
+    result.__schema = db.schemas[coll_name]
+    return result
+
+
+def _expand_single_reference(db, schema, _id, expand=True, seen=frozenset(), batch=None):
+    if isinstance(_id, dict) or _id == REFERENCE_NOT_FOUND:
+        return _id
+    coll_name = schema['collection']
+    if expand is None or (coll_name, _id) in seen:
+        return DBDoc({'_id': _id})
+    if expand is True:
+        expand = expand_tree(db.expand_defaults.get(coll_name))
+    if batch:
+        return ReferenceProxy(_id, schema, expand, seen, batch)
+
+    result = db[coll_name].coll.find_one({'_id':_id}, fields=schema.get('fields', None))
     if result:
-        result.__schema = db.schemas[schema['collection']]
+        expand_references(db, db.schemas[coll_name], result, expand, seen | frozenset([(coll_name, _id)]))
+        result.__schema = db.schemas[coll_name]
         return result
     else:
-        return 'reference not found'
+        return REFERENCE_NOT_FOUND
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+from bson.son import SON
+from schema_doc import is_object, is_list_of_objects, is_list_of_references
+
+
+LOOKUP_KEY = '_lookup'
+
+
+def expand_tree(expand):
+    '''
+    Normalizes an expand= specification:
+        None, True      expand every reference, recursively
+        n               expand references n levels deep
+        False, []       leave every reference as an {'_id': id} stub
+        [paths]         expand only the listed dotted paths, e.g. ['contact', 'contact.company']
+        {path: spec}    expand path, using spec inside the referenced document
+    Returns True, an integer depth, or a dict tree of {key: subtree}.
+    '''
+    if expand is None or expand is True:
+        return True
+    if expand is False:
+        return 0
+    if isinstance(expand, (int, long)):
+        return expand
+    if not isinstance(expand, dict):
+        expand = dict((x, {}) for x in expand)
+
+    tree = {}
+    for path, sub in expand.items():
+        if sub is False:
+            continue
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        sub = expand_tree(sub)
+        if isinstance(sub, dict) and isinstance(node.get(parts[-1]), dict):
+            node[parts[-1]].update(sub)
+        else:
+            node[parts[-1]] = sub
+    return tree
+
+
+def subtree(expand, key):
+    if isinstance(expand, dict):
+        return expand.get(key, {})
+    return expand
+
+
+def reference_expansion(expand, key):
+    'Returns the spec to expand a reference with, or None to leave it as a stub'
+    if isinstance(expand, dict):
+        return expand.get(key)
+    if expand is True:
+        return True
+    if expand > 0:
+        return expand - 1
+
+
+
+def lookup_references(schema, expand, path=''):
+    '''
+    Reference fields a $lookup can reach (top level and inside embedded objects, not
+    inside embedded lists), as (path, reference schema, is_list, expansion spec) tuples
+    '''
+    refs = []
+    for key, val in schema.items():
+        if is_object(val):
+            refs.extend(lookup_references(val['schema'], subtree(expand, key), path + key + '.'))
+        elif is_list_of_references(val):
+            refs.append((path + key, val['schema'], True, reference_expansion(expand, key)))
+        elif val['type'] == 'reference':
+            refs.append((path + key, val, False, reference_expansion(expand, key)))
+    return refs
+
+
+def _remote_prefix(key, paths):
+    for path in paths:
+        if key.startswith(path + '.'):
+            return path
+
+def _remote_keys(spec, paths):
+    result = set()
+    for key, val in spec.items():
+        if key in ['$and', '$or', '$nor']:
+            for clause in val:
+                result |= _remote_keys(clause, paths)
+        elif _remote_prefix(key, paths):
+            result.add(key)
+    return result
+
+def _rewrite_remote(spec, paths):
+    result = {}
+    for key, val in spec.items():
+        if key in ['$and', '$or', '$nor']:
+            result[key] = [_rewrite_remote(x, paths) for x in val]
+        elif _remote_prefix(key, paths):
+            result[LOOKUP_KEY + '.' + key] = val
+        else:
+            result[key] = val
+    return result
+
+
+def compile_lookup_pipeline(db, schema, spec=None, skip=0, limit=0, sort=None, expand=True):
+    '''
+    Returns (pipeline, refs), where refs are the lookup_references() that the pipeline
+    joins in under LOOKUP_KEY.  When the spec or sort uses fields of referenced
+    documents the lookups come before paging, otherwise after it.
+    '''
+    spec = spec or {}
+    sort = sort or []
+    refs = lookup_references(schema, expand)
+    paths = [x[0] for x in refs]
+
+    remote_keys = _remote_keys(spec, paths) | set(x[0] for x in sort if _remote_prefix(x[0], paths))
+    used = {}
+    for key in remote_keys:
+        prefix = _remote_prefix(key, paths)
+        used.setdefault(prefix, set()).add(key[len(prefix) + 1:])
+    refs = [x for x in refs if x[3] is not None or x[0] in used]
+
+    local, remote = {}, {}
+    for key, val in spec.items():
+        if (key in ['$and', '$or', '$nor'] and _remote_keys({key: val}, paths)) or _remote_prefix(key, paths):
+            remote[key] = val
+        else:
+            local[key] = val
+
+    paging = []
+    if sort:
+        paging.append({'$sort': SON([(_remote_prefix(k, paths) and LOOKUP_KEY + '.' + k or k, d) for k, d in sort])})
+    if skip:
+        paging.append({'$skip': skip})
+    if limit:
+        paging.append({'$limit': limit})
+    lookups = [_lookup_stage(db, x, used.get(x[0], set())) for x in refs]
+
+    pipeline = local and [{'$match': local}] or []
+    if remote_keys:
+        pipeline += lookups
+        pipeline += remote and [{'$match': _rewrite_remote(remote, paths)}] or []
+        pipeline += paging
+    else:
+        pipeline += paging + lookups
+    return (pipeline, refs)
+
+
+def _lookup_stage(db, ref, used_fields):
+    path, ref_schema, is_list, _ = ref
+    remote_schema = db.schemas[ref_schema['collection']]
+    fields = ref_schema.get('fields')
+    if not fields or any('serialize' in remote_schema.get(x, {}) for x in fields):
+        return {'$lookup': {
+            'from': ref_schema['collection'],
+            'localField': path,
+            'foreignField': '_id',
+            'as': LOOKUP_KEY + '.' + path,
+        }}
+
+    if is_list:
+        match = {'$in': ['$_id', {'$ifNull': ['$$ref', []]}]}
+    else:
+        match = {'$eq': ['$_id', '$$ref']}
+    return {'$lookup': {
+        'from': ref_schema['collection'],
+        'let': {'ref': '$' + path},
+        'pipeline': [
+            {'$match': {'$expr': match}},
+            {'$project': dict((x, 1) for x in set(fields) | used_fields)},
+        ],
+        'as': LOOKUP_KEY + '.' + path,
+    }}
+
+
+
+def reference_split(schema, key):
+    '''
+    Splits a dotted spec key at the first reference field it crosses, returning
+    (reference path, reference schema, remainder), or None for a plain field
+    '''
+    parts = key.split('.')
+    for i, part in enumerate(parts[:-1]):
+        if part not in schema:
+            return None
+        val = schema[part]
+        if is_object(val):
+            schema = val['schema']
+        elif is_list_of_objects(val):
+            schema = val['schema']['schema']
+        elif is_list_of_references(val):
+            return ('.'.join(parts[:i+1]), val['schema'], '.'.join(parts[i+1:]))
+        elif val['type'] == 'reference':
+            return ('.'.join(parts[:i+1]), val, '.'.join(parts[i+1:]))
+        else:
+            return None
+
+
+def resolve_reference_spec(db, schema, spec):
+    '''
+    Rewrites conditions on fields of referenced documents, e.g. {'customer.region': 'X'},
+    into {'customer': {'$in': [ids]}} by first querying the referenced collection.  $in
+    matches lists of references on array membership.  Conditions on the same reference
+    are resolved together, so they must all hold for one referenced document.
+    '''
+    if not spec or not isinstance(spec, dict):
+        return spec
+    result = {}
+    remote = {}
+    for key, val in spec.items():
+        if key in ['$and', '$or', '$nor']:
+            result[key] = [resolve_reference_spec(db, schema, x) for x in val]
+            continue
+        split = reference_split(schema, key)
+        if split:
+            remote.setdefault(split[0], (split[1], {}))[1][split[2]] = val
+        else:
+            result[key] = val
+
+    for path, (ref_schema, subspec) in remote.items():
+        coll_name = ref_schema['collection']
+        subspec = resolve_reference_spec(db, db.schemas[coll_name], subspec)
+        ids = [x['_id'] for x in db[coll_name].coll._collection.find(subspec, fields=['_id'])]
+        if path in result:
+            result.setdefault('$and', []).append({path: {'$in': ids}})
+        else:
+            result[path] = {'$in': ids}
+    return result
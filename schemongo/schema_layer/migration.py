@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+from ..db_layer.collection import chunked, get_path, bump_version
+from ..db_layer.db_doc import DBDoc, enforce_ids
+from ..db_layer.session import _bulk_update
+from schema_doc import is_object, is_list_of_objects, run_auto_funcs, _convert_value, _generate_prototype_field
+
+
+'''
+Schema migrations.  migrate() registers a new schema for a collection and brings the
+stored documents up to it, instead of leaving each to be fixed on its next write:
+
+    removed fields      $unset
+    added fields        $set to the prototype value (default, None, [], {})
+    changed types       values converted as enforce_datatypes would, per batch
+    added auto fields   computed per document, per batch
+
+$unset and $set go out as one multi-document update per batch of batch_size _ids;
+conversions and auto fields are written with one bulk update per batch.  Objects in
+embedded lists are refilled per document.  Values that do not convert are left as
+they are and reported, in the result and in the single 'schema migrated' history
+record written for the whole migration.
+'''
+
+
+CONVERTIBLE = ['boolean', 'integer', 'float', 'string', 'datetime']
+
+
+def schema_changes(old, new, prefix=''):
+    'Returns (added, removed, converted, lists): [(path, field)], [path], [(path, field)], [path]'
+    added, removed, converted, lists = [], [], [], []
+    for key, field in new.items():
+        path = prefix + key
+        if 'serialize' in field:
+            continue
+        if key not in old or 'serialize' in old[key]:
+            added.append((path, field))
+        elif is_object(field) and is_object(old[key]):
+            changes = schema_changes(old[key]['schema'], field['schema'], path + '.')
+            for total, part in zip((added, removed, converted, lists), changes):
+                total.extend(part)
+        elif is_list_of_objects(field) and is_list_of_objects(old[key]):
+            if any(schema_changes(old[key]['schema']['schema'], field['schema']['schema'])):
+                lists.append(path)
+        elif field['type'] != old[key]['type'] or is_object(field) != is_object(old[key]):
+            if field['type'] in CONVERTIBLE and old[key]['type'] in CONVERTIBLE:
+                converted.append((path, field))
+            else:
+                removed.append(path)
+                added.append((path, field))
+    for key in old.keys():
+        if key not in new and 'serialize' not in old[key]:
+            removed.append(prefix + key)
+    return (added, removed, converted, lists)
+
+
+def migrate(db, name, schema, username=None, batch_size=1000):
+    '''
+    Registers schema for collection name and migrates its documents; returns a summary
+    of the changed paths and any values that could not be converted
+    '''
+    old = db.schemas[name]
+    db.register_schema(name, schema, db.expand_defaults.get(name))
+    added, removed, converted, lists = schema_changes(old, schema)
+    coll = db._db[name]
+    errs = []
+    # Writes to a versioned collection move _v on, so updates from stale reads conflict
+    bump = name in db.versioned and bump_version or (lambda x: x)
+
+    if removed:
+        _update_batches(coll, {'$or': [{x: {'$exists': True}} for x in removed]},
+                        bump({'$unset': dict((x, '') for x in removed)}), batch_size)
+
+    for path, field in converted:
+        errs.extend(_convert_batches(coll, path, field, batch_size, bump))
+
+    for path, field in added:
+        if 'auto' in field or 'auto_init' in field:
+            continue
+        value = _generate_prototype_field(field)
+        if isinstance(value, dict):
+            enforce_ids(value, 1)
+        spec = {path: {'$exists': False}}
+        if '.' in path:
+            spec[path.rsplit('.', 1)[0]] = {'$ne': None}
+        _update_batches(coll, spec, bump({'$set': {path: value}}), batch_size)
+
+    autos = [(path, field) for path, field in added if 'auto' in field or 'auto_init' in field]
+    if autos:
+        _auto_batches(coll, autos, batch_size, bump)
+
+    for path in lists:
+        errs.extend(_list_batches(coll, path, db.prototypes[name], schema, batch_size, bump))
+
+    summary = {
+        'added': sorted(x[0] for x in added),
+        'removed': sorted(removed),
+        'converted': sorted(x[0] for x in converted),
+        'lists': sorted(lists),
+        'errors': errs,
+    }
+    if any(summary.values()):
+        db.history_write(db.history_record(name, None, username, action='schema migrated', changes=summary))
+    return summary
+
+
+def _id_batches(coll, spec, batch_size):
+    for batch in chunked(coll.find(spec, fields=['_id']), batch_size):
+        yield [x['_id'] for x in batch]
+
+
+def _update_batches(coll, spec, update, batch_size):
+    for ids in _id_batches(coll, spec, batch_size):
+        coll.update({'$and': [spec, {'_id': {'$in': ids}}]}, update, multi=True)
+
+
+def _convert_batches(coll, path, field, batch_size, bump):
+    errs = []
+    spec = {path: {'$ne': None}}
+    for batch in chunked(coll.find(spec, fields=[path]), batch_size):
+        ops = []
+        for doc in batch:
+            try:
+                value = _convert_value(field, get_path(doc, path))
+            except Exception, e:
+                errs.append('%s %s: %s' % (doc['_id'], path.replace('.', '/'), e.message))
+                continue
+            ops.append((doc['_id'], bump({'$set': {path: value}})))
+        if ops:
+            _bulk_update(coll, ops)
+    return errs
+
+
+def _auto_batches(coll, autos, batch_size, bump):
+    for batch in chunked(coll.find(), batch_size):
+        ops = []
+        for raw in batch:
+            doc = DBDoc(raw)
+            update = {}
+            for path, field in autos:
+                parent = get_path(doc, path.rsplit('.', 1)[0]) if '.' in path else doc
+                if isinstance(parent, dict):
+                    value = field.get('auto') or field['auto_init']
+                    update[path] = _convert_value(field, value(parent))
+            if update:
+                ops.append((doc['_id'], bump({'$set': update})))
+        if ops:
+            _bulk_update(coll, ops)
+
+
+def _list_batches(coll, path, prototype, schema, batch_size, bump):
+    errs = []
+    for key in path.split('.'):
+        field = schema[key]
+        prototype = prototype.children[key]
+        schema = is_object(field) and field['schema'] or field['schema']['schema']
+    for batch in chunked(coll.find({path + '.0': {'$exists': True}}, fields=[path]), batch_size):
+        ops = []
+        for raw in batch:
+            items = DBDoc(raw)
+            for i, item in enumerate(get_path(items, path)):
+                for key, val in item.items():
+                    if key in schema and schema[key]['type'] in CONVERTIBLE:
+                        try:
+                            item[key] = _convert_value(schema[key], val)
+                        except Exception, e:
+                            errs.append('%s %s/%i/%s: %s' % (raw['_id'], path.replace('.', '/'), i, key, e.message))
+                prototype.fill(item)
+                run_auto_funcs(schema, item)
+            ops.append((raw['_id'], bump({'$set': {path: get_path(items, path)}})))
+        _bulk_update(coll, ops)
+    return errs
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
+import time
 import datetime
-import dateutil.parser
-from dateutil.tz import tzlocal
-from ..db_layer.db_doc import DBDoc, DBDocList, enforce_ids, merge
+from copy import deepcopy
+from ..db_layer.db_doc import DBDoc, DBDocList, enforce_ids, merge, SEQ_KEY, VERSION_KEY
+from ..db_layer.dates import parse_datetime, LOCAL_TZ
 
 """
 data types                      on_write                            on_serialize
@@ -58,11 +59,11 @@ def _convert_datetime(val):
     if isinstance(val, datetime.datetime):
         pass
     elif type(val) in [str, unicode]:
-        val = dateutil.parser.parse(val)
+        val = parse_datetime(val)
     else:
         raise
     if val.tzinfo is None:
-        val = val.replace(tzinfo=tzlocal())
+        val = val.replace(tzinfo=LOCAL_TZ)
     return val
 
 def _convert_reference(val):
@@ -112,7 +113,9 @@ def enforce_datatypes(schema, data, path=''):
     errs = []
     for key in data.keys():
         path = path and (path + '/')
-        if key not in schema or is_read_only(schema[key]):
+        if key == VERSION_KEY and not path:
+            continue
+        elif key not in schema or is_read_only(schema[key]):
             data.pop(key)
         elif is_object(schema[key]):
             errs.extend(enforce_datatypes(schema[key]['schema'], data[key], path + key))
@@ -127,22 +130,96 @@ def enforce_datatypes(schema, data, path=''):
     return errs
 
 
-def enforce_schema_behaviors(schema, data, db_coll, path=''):
+def enforce_datatypes_bulk(schema, docs):
+    '''
+    enforce_datatypes() for a batch of documents, converting each top-level field as one
+    column across the batch.  Returns each document's errors, as enforce_datatypes would.
+    '''
+    errs = [[] for x in docs]
+    kinds = {}
+    columns = {}
+    for i, data in enumerate(docs):
+        for pos, key in enumerate(data.keys()):
+            if key not in kinds:
+                kinds[key] = _column_kind(schema, key)
+                columns[key] = []
+            kind = kinds[key]
+            if kind == 'column':
+                columns[key].append((i, pos))
+            elif kind == 'drop':
+                del data[key]
+            elif kind == 'nested':
+                nested = enforce_datatypes(dict([(key, schema[key])]), dict([(key, data[key])]))
+                errs[i].extend((pos, x) for x in nested)
+
+    for key, cells in columns.items():
+        if not cells:
+            continue
+        field = schema[key]
+        values = [docs[i][key] for i, pos in cells]
+        try:
+            converted = _convert_column(field, values)
+        except Exception:
+            # Find the failing cells, with the same messages as _convert_value
+            converted = []
+            for (i, pos), value in zip(cells, values):
+                try:
+                    value = _convert_value(field, value)
+                except Exception, e:
+                    errs[i].append((pos, '%s: %s' % (key, e.message)))
+                converted.append(value)
+        for (i, pos), value, old in zip(cells, converted, values):
+            if value is not old:
+                docs[i][key] = value
+
+    return [[msg for pos, msg in sorted(x, key=lambda y: y[0])] for x in errs]
+
+
+def _column_kind(schema, key):
+    if key == VERSION_KEY:
+        return 'keep'
+    if key not in schema or is_read_only(schema[key]):
+        return 'drop'
+    if is_object(schema[key]) or is_list_of_objects(schema[key]):
+        return 'nested'
+    return 'column'
+
+
+_native = {
+    'boolean': bool,
+    'integer': int,
+    'float': float,
+    'string': unicode,
+}
+
+def _convert_column(field, values):
+    'Converted values, raising on the first that fails; values already of the type are kept'
+    _type = field['type']
+    if _type not in _converters:
+        return [_convert_value(field, x) for x in values]
+    convert = _converters[_type]
+    native = _native.get(_type)
+    return [x if x is None or type(x) is native else convert(x) for x in values]
+
+
+def enforce_schema_behaviors(schema, data, db_coll, path='', allowed=None):
+    allowed = allowed or AllowedCache()
     errs = []
     for key in [x for x in data.keys() if x in schema]:
         path = path and (path + '/')
         if is_object(schema[key]):
-            errs.extend(enforce_schema_behaviors(schema[key]['schema'], data[key], db_coll, path + key))
+            errs.extend(enforce_schema_behaviors(schema[key]['schema'], data[key], db_coll, path + key, allowed))
         elif is_list_of_objects(schema[key]):
             for i, item in enumerate(data[key]):
-                errs.extend(enforce_schema_behaviors(schema[key]['schema']['schema'], item, db_coll, path + '%s/%s' % (key, i)))
+                errs.extend(enforce_schema_behaviors(schema[key]['schema']['schema'], item, db_coll, path + '%s/%s' % (key, i), allowed))
         elif schema[key]['type'] == 'list' and 'schema' in schema[key] and 'allowed' in schema[key]['schema']:
+            values = data[key] and allowed.values(schema[key]['schema'], data, many=True)
             for i, item in enumerate(data[key]):
-                if not check_allowed(schema[key]['schema']['allowed'], data, data[key][i]):
+                if not _is_allowed(data[key][i], values):
                     errs.append('%s%s/%s: %s' % (path, key, i, "'%s' not one of the allowed values" % data[key][i]))                
         else:
             if 'allowed' in schema[key]:
-                if not check_allowed(schema[key]['allowed'], data, data[key]):
+                if not _is_allowed(data[key], allowed.values(schema[key], data)):
                     errs.append('%s%s: %s' % (path, key, "'%s' not one of the allowed values" % data[key]))
             if 'required' in schema[key] and schema[key]['required']:
                 if key not in data or data[key] is None:
@@ -154,14 +231,56 @@ def enforce_schema_behaviors(schema, data, db_coll, path=''):
     return errs
 
 
-def check_allowed(allowed, elem, data):
-    if callable(allowed):
-        allowed = allowed(elem)
-    if not hasattr(allowed, '__iter__'):
-        raise "'required' parameter '%s' did not evaluate to an iterable" % allowed
-    if data not in allowed:
-        return False
-    return True
+class AllowedCache(object):
+    '''
+    Allowed values for one validation batch.  Static lists become sets once per batch.
+    A callable is called once per list of values it checks; with 'allowed_cache' set on
+    the field its result is reused regardless of the element:
+
+        'allowed_cache': 'batch'    for the rest of the batch
+        'allowed_cache': 30         for 30 seconds, through the shared store
+    '''
+    def __init__(self, store=None):
+        self.sets = {}
+        self.store = {} if store is None else store
+
+    def values(self, field, elem, many=False):
+        allowed = field['allowed']
+        if not callable(allowed):
+            if id(allowed) not in self.sets:
+                self.sets[id(allowed)] = _allowed_set(allowed)
+            return self.sets[id(allowed)]
+
+        policy = field.get('allowed_cache')
+        if policy is None:
+            return _allowed_set(allowed(elem), many)
+        if policy == 'batch':
+            if allowed not in self.sets:
+                self.sets[allowed] = _allowed_set(allowed(elem))
+            return self.sets[allowed]
+        entry = self.store.get(allowed)
+        if entry is None or entry[0] < time.time():
+            entry = self.store[allowed] = (time.time() + policy, _allowed_set(allowed(elem)))
+        return entry[1]
+
+
+def _is_allowed(value, values):
+    try:
+        return value in values
+    except TypeError:
+        # An unhashable value against a set: compare one by one
+        return any(value == x for x in values)
+
+
+def _allowed_set(values, hashed=True):
+    if not hasattr(values, '__iter__'):
+        raise TypeError("'allowed' parameter '%s' did not evaluate to an iterable" % values)
+    if not hashed:
+        return values
+    try:
+        return frozenset(values)
+    except TypeError:
+        return list(values)
 
 
 
@@ -181,7 +300,7 @@ def _generate_prototype_field(schema, parent=None):
     elif is_list_of_objects(schema):
         return DBDocList([], parent)
     elif 'default' in schema:
-        return schema['default']
+        return deepcopy(schema['default'])
     elif schema['type'] == 'dict':
         return {}
     elif schema['type'] == 'list':
@@ -205,21 +324,168 @@ def fill_in_prototypes(schema, doc):
             [fill_in_prototypes(schema[key]['schema']['schema'], item) for item in doc[key]]
             
     for key in doc.keys():
-        if key not in schema:
+        if key not in schema and key not in (SEQ_KEY, VERSION_KEY):
             doc.pop(key)
         
 
-def run_auto_funcs(schema, data):
+class Prototype(object):
+    '''
+    generate_prototype() and fill_in_prototypes() compiled for one schema.  The schema
+    is walked once, into a factory per field; instantiate() then only calls those, and
+    copies nothing but mutable defaults.
+    '''
+    def __init__(self, schema):
+        self.schema = schema
+        self.fields = []
+        self.children = {}
+        for key, val in schema.items():
+            if is_object(val):
+                self.children[key] = Prototype(val['schema'])
+            elif is_list_of_objects(val):
+                self.children[key] = Prototype(val['schema']['schema'])
+            if 'serialize' not in val:
+                self.fields.append((key, self._factory(key, val)))
+        self.depends = any('auto' in x and 'depends' in x for x in schema.values()) \
+                    or any(x.depends for x in self.children.values())
+
+        # What a partial update needs loaded, see patch_fields()
+        self.opaque = any('auto' in x and 'depends' not in x for x in schema.values()) \
+                   or any(x.opaque for x in self.children.values())
+        self.element_rules = set(key for key, val in schema.items() if _has_element_rule(val))
+        self.auto_inputs = dict((key, set(x.split('.')[0] for x in val['depends']))
+                                for key, val in schema.items() if 'auto' in val and 'depends' in val)
+
+    def _factory(self, key, schema):
+        if is_object(schema):
+            return self.children[key].instantiate
+        elif is_list_of_objects(schema):
+            return lambda parent: DBDocList([], parent)
+        elif 'default' in schema:
+            default = schema['default']
+            if isinstance(default, (dict, list)):
+                return lambda parent: _wrap(deepcopy(default), parent)
+            return lambda parent: default
+        elif schema['type'] == 'dict':
+            return lambda parent: DBDoc({}, parent)
+        elif schema['type'] == 'list':
+            return lambda parent: []
+        else:
+            return lambda parent: None
+
+    def instantiate(self, parent=None):
+        doc = DBDoc({}, parent)
+        for key, factory in self.fields:
+            dict.__setitem__(doc, key, factory(doc))
+        return doc
+
+    def fill(self, doc, keys=None):
+        'keys limits the top-level fields filled in, for partially loaded documents'
+        for key, factory in self.fields:
+            if key != '_id' and key not in doc and (keys is None or key in keys):
+                doc[key] = factory(doc)
+        for key, child in self.children.items():
+            if keys is not None and key not in keys:
+                continue
+            if is_object(self.schema[key]):
+                if not doc[key]:
+                    doc[key] = {}
+                child.fill(doc[key])
+            else:
+                if not doc[key]:
+                    doc[key] = []
+                for item in doc[key]:
+                    child.fill(item)
+
+        for key in doc.keys():
+            if key not in self.schema and key not in (SEQ_KEY, VERSION_KEY):
+                doc.pop(key)
+
+
+    def patch_fields(self, keys):
+        '''
+        The top-level fields an update of keys has to load: the keys themselves, and the
+        auto fields depending on them together with their other inputs.  None when the
+        whole document is needed, i.e. some auto field has no 'depends', or a loaded
+        field's callable 'allowed' is passed the whole element.
+        '''
+        if self.opaque:
+            return None
+        fields = set(keys) | set(['_id'])
+        grown = True
+        while grown:
+            grown = False
+            for key, inputs in self.auto_inputs.items():
+                if key not in fields and inputs & fields:
+                    fields |= inputs | set([key])
+                    grown = True
+        if fields & self.element_rules:
+            return None
+        return fields
+
+
+def _has_element_rule(field):
+    if callable(field.get('allowed')):
+        return True
+    if field['type'] == 'list' and 'schema' in field:
+        if is_object(field['schema']):
+            return any(_has_element_rule(x) for x in field['schema']['schema'].values())
+        return callable(field['schema'].get('allowed'))
+    if is_object(field):
+        return any(_has_element_rule(x) for x in field['schema'].values())
+    return False
+
+
+def _wrap(value, parent):
+    if isinstance(value, dict):
+        return DBDoc(value, parent)
+    if isinstance(value, list) and len(value) and isinstance(value[0], dict):
+        return DBDocList(value, parent)
+    return value
+
+
+def run_auto_funcs(schema, data, changed=None, stats=None, path=''):
+    '''
+    changed: dotted paths changed by an update (see changed_paths); auto fields with
+    'depends' are then only recomputed when one of those paths touches a dependency
+    '''
     for key in schema.keys():
         if is_object(schema[key]):
-            run_auto_funcs(schema[key]['schema'], data[key])
+            run_auto_funcs(schema[key]['schema'], data[key], changed, stats, path + key + '.')
         elif is_list_of_objects(schema[key]):
-            [run_auto_funcs(schema[key]['schema']['schema'], x) for x in data[key]]
+            for i, x in enumerate(data[key]):
+                run_auto_funcs(schema[key]['schema']['schema'], x, changed, stats, '%s%s.%i.' % (path, key, i))
         elif 'auto_init' in schema[key] and not data._id:
             data[key] = schema[key]['auto_init'](data)
             data[key] = _convert_value(schema[key], data[key])
         elif 'auto' in schema[key]:
+            if changed is not None and 'depends' in schema[key] and not _affected(schema[key]['depends'], path, changed):
+                _count(stats, 'auto skipped')
+                continue
             data[key] = schema[key]['auto'](data)
             data[key] = _convert_value(schema[key], data[key])
+            _count(stats, 'auto computed')
+            if changed is not None:
+                changed.add(path + key)
+
+
+def changed_paths(doc):
+    'Dotted paths a tracked DBDoc has changed since track_changes()'
+    # Before the write numbers new list objects, so no history diff
+    update = doc.get_changes(history=False)[0]
+    return set(update.get('$set', {}).keys() + update.get('$unset', {}).keys())
+
+
+def _affected(depends, path, changed):
+    for dep in depends:
+        dep = path + dep
+        for x in changed:
+            if x == dep or x.startswith(dep + '.') or dep.startswith(x + '.'):
+                return True
+    return False
+
+
+def _count(stats, key):
+    if stats is not None:
+        stats[key] += 1
 
 
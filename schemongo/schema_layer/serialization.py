@@ -2,22 +2,24 @@
 
 import json
 import copy
-from schema_doc import is_object, is_list_of_objects, is_list_of_references
+from schema_doc import is_object, is_list_of_objects, is_list_of_references, _count
+from ..db_layer.collection import get_path
+from ..db_layer.db_doc import DBDoc
 
 
-def serialize_list(schema, items):
-    return json.dumps(get_serial_list(schema, items))
+def serialize_list(schema, items, stats=None):
+    return json.dumps(get_serial_list(schema, items, stats))
 
-def serialize(schema, item):
-    return json.dumps(get_serial_dict(schema, item))
+def serialize(schema, item, stats=None):
+    return json.dumps(get_serial_dict(schema, item, stats))
     
-def get_serial_dict(schema, item):
+def get_serial_dict(schema, item, stats=None):
     data = copy.deepcopy(item._projection or item)
-    update_serial_recursive(schema, item, data)
+    update_serial_recursive(schema, item, data, stats)
     return data
 
-def get_serial_list(schema, items):
-    return [get_serial_dict(schema, x) for x in items]
+def get_serial_list(schema, items, stats=None):
+    return [get_serial_dict(schema, x, stats) for x in items]
     
 def get_by_id(list, id):
     for item in list:
@@ -27,32 +29,51 @@ def get_by_id(list, id):
 
     
     
-def update_serial_recursive(schema, item, data):
+def update_serial_recursive(schema, item, data, stats=None):
     for key in data.keys():
-        if key not in schema:
+        if key not in schema or getattr(item.get(key), '_partial', None):
+            # A partial list is left out, so the output can be sent back to update()
             data.pop(key)
         elif is_object(schema[key]):
-            update_serial_recursive(schema[key]['schema'], item[key], data[key])
+            update_serial_recursive(schema[key]['schema'], item[key], data[key], stats)
         elif is_list_of_objects(schema[key]):
             for subdata in data[key]:
                 subitem = get_by_id(item[key], subdata['_id'])
-                update_serial_recursive(schema[key]['schema']['schema'], subitem, subdata)
+                update_serial_recursive(schema[key]['schema']['schema'], subitem, subdata, stats)
         elif is_list_of_references(schema[key]):
-            data[key] = [_update_single_reference(x) for x in item[key]]
+            data[key] = [_update_single_reference(x, stats) for x in item[key]]
         elif schema[key]['type'] == 'datetime':
             data[key] = data[key] and data[key].isoformat()
         elif schema[key]['type'] == 'reference':
-            data[key] = _update_single_reference(item[key])
+            data[key] = _update_single_reference(item[key], stats)
                 
     for key in schema.keys():
         if 'serialize' in schema[key]:
-            data[key] = schema[key]['serialize'](item)
+            data[key] = _serialize_field(schema[key], key, item, stats)
 
 
-def _update_single_reference(item):
+def _serialize_field(field, key, item, stats):
+    '''
+    A serialize function with 'depends' is rerun for the same DBDoc only when one of
+    those fields has changed since its last result
+    '''
+    if 'depends' not in field or not isinstance(item, DBDoc):
+        return field['serialize'](item)
+    inputs = [copy.deepcopy(get_path(item, x)) for x in field['depends']]
+    cache = vars(item).setdefault('_serial_cache', {})
+    if key in cache and cache[key][0] == inputs:
+        _count(stats, 'serialize skipped')
+        return cache[key][1]
+    cache[key] = (inputs, field['serialize'](item))
+    _count(stats, 'serialize computed')
+    return cache[key][1]
+
+
+def _update_single_reference(item, stats=None):
     if item is None:
         return None
-    if hasattr(item, '__schema'):
-        return get_serial_dict(item.__schema, item)
-    else:
+    if not isinstance(item, dict) or getattr(item, '_missing', False):
         return {'_err': 'reference not found'}
+    if getattr(item, '__schema', None) is None:
+        return {'_id': item['_id']}
+    return get_serial_dict(item.__schema, item, stats)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from copy import deepcopy
+from ..db_layer.session import Session, SessionCollection
+
+
+class SchemaSession(Session):
+    '''
+    Session whose writes are validated like SchemaCollectionWrapper's.  Updates are
+    validated against a copy of the identity-mapped document and merged into it once
+    they pass, so each document is read at most once per session.  References to
+    removed documents are cleared after commit.
+    '''
+    def __getitem__(self, key):
+        return SchemaSessionCollection(self, key)
+
+    def commit(self):
+        removed = [(name, list(ids)) for name, ids in self._removes.items() if ids]
+        super(SchemaSession, self).commit()
+        for name, ids in removed:
+            self.db.remove_references(name, ids)
+
+
+class SchemaSessionCollection(SessionCollection):
+    def __init__(self, session, name):
+        super(SchemaSessionCollection, self).__init__(session, name)
+        self.wrapper = session.db[name]
+
+    def insert(self, doc_or_docs):
+        if not isinstance(doc_or_docs, list):
+            docs = [doc_or_docs]
+        else:
+            docs = doc_or_docs
+
+        datas = []
+        errs = []
+        allowed = self.wrapper.allowed_cache()
+        for incoming in docs:
+            data, local_errs = self.wrapper.process_insert(incoming, allowed)
+            datas.append(data)
+            errs.append(local_errs)
+
+        if any(errs) and len(errs) == 1:
+            return ([], errs[0])
+        if any(errs) and len(errs) > 1:
+            return ([], errs)
+
+        ids = [self._insert(x) for x in datas]
+        return (ids, None)
+
+    def update(self, incoming):
+        stored = self.find_one(incoming['_id'])
+        if stored is None:
+            return ["_id: '%s' not found" % incoming['_id']]
+        data, errs = self.wrapper.process_update(incoming, deepcopy(stored))
+        if errs:
+            return errs
+        super(SchemaSessionCollection, self).update(data)
+
+    def remove(self, spec_or_id):
+        if isinstance(spec_or_id, dict):
+            ids = [x['_id'] for x in self._collection.find(spec=spec_or_id, fields=['_id'])]
+        else:
+            ids = [spec_or_id]
+        errs = ids and self.session.db.check_singular_references(self.name, ids)
+        if errs:
+            return errs
+        for id in ids:
+            super(SchemaSessionCollection, self).remove(id)
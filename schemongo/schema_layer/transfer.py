@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import json
+from ..db_layer.collection import chunked
+from ..db_layer.db_doc import enforce_ids
+from serialization import get_serial_dict
+
+
+'''
+Moving whole collections as NDJSON, one serialized document per line.  Export streams
+what serialize() would write, with references left as {'_id': id} stubs so the lines
+import again; import validates each chunk of lines like insert() and writes it with
+one bulk insert:
+
+    with open('users.ndjson', 'w') as out:
+        db.export_collection('users', out)
+
+    with open('users.ndjson') as lines:
+        id_map, errs = other_db.import_collection('users', lines, ids='remap', history=False)
+'''
+
+
+def export_collection(db, name, out, spec=None):
+    'Writes the documents matching spec to out, one line each; returns how many'
+    coll = db[name]
+    count = 0
+    for item in coll.find(spec, sort=[('_id', 1)], expand=False):
+        out.write(json.dumps(get_serial_dict(coll.schema, item, db.stats)) + '\n')
+        count += 1
+    return count
+
+
+def import_collection(db, name, lines, username=None, ids='preserve', history=True, batch_size=1000):
+    '''
+    ids:    'preserve'  documents keep the _id they were exported with
+            'remap'     documents are numbered on from the collection's last _id
+    Returns ({exported _id: stored _id}, errs).  Lines that are not a JSON object or
+    fail validation are skipped and reported as 'line n: ...'; with history=False no
+    history records are written.
+    '''
+    assert ids in ['preserve', 'remap'], "ids must be 'preserve' or 'remap'"
+    coll = db[name]
+    allowed = coll.allowed_cache()
+    id_map = {}
+    errs = []
+    numbered = ((i, x) for i, x in enumerate(lines, 1) if x.strip())
+
+    for batch in chunked(numbered, batch_size):
+        parsed = []
+        for number, line in batch:
+            try:
+                doc = json.loads(line)
+            except ValueError:
+                errs.append('line %i: invalid JSON' % number)
+                continue
+            if not isinstance(doc, dict):
+                errs.append('line %i: not an object' % number)
+                continue
+            parsed.append(((number, line), doc))
+        batch = [x[0] for x in parsed]
+        docs = [x[1] for x in parsed]
+        old_ids = [x.pop('_id', None) for x in docs]
+        valid = []
+        for (number, line), old_id, (data, local_errs) in zip(batch, old_ids, coll.process_inserts(docs, allowed)):
+            if local_errs:
+                errs.extend('line %i: %s' % (number, x) for x in local_errs)
+            else:
+                valid.append((old_id, data))
+        if not valid:
+            continue
+
+        next_id = db.get_next_id(name)
+        if ids == 'preserve':
+            kept = [x[0] for x in valid if x[0]]
+            next_id = max([next_id] + [x + 1 for x in kept])
+        datas = []
+        for old_id, data in valid:
+            if ids == 'preserve' and old_id:
+                enforce_ids(data, old_id)
+            else:
+                next_id = enforce_ids(data, next_id)
+            if old_id:
+                id_map[old_id] = data['_id']
+            datas.append(data)
+
+        coll.coll._collection.insert([coll.coll._unbucketed(x) for x in datas])
+        for data in datas:
+            coll.coll._write_buckets(data, {})
+        if history:
+            db.history_write([db.history_record(name, x['_id'], username, action='document created') for x in datas])
+        db.set_last_id(name, max([db.get_next_id(name) - 1] + [x['_id'] for x in datas]))
+
+    return (id_map, errs)
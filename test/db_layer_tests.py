@@ -4,7 +4,10 @@ import datetime
 
 import mongomock
 from schemongo import db_layer
-from schemongo.db_layer.db_doc import DBDoc
+from schemongo.db_layer.db_doc import DBDoc, merge
+from schemongo.db_layer.accounting import QueryBudgetExceeded
+from schemongo.db_layer.collection import project, keyset_spec, ConflictError, RetryPolicy
+from pymongo.errors import DuplicateKeyError
 
 from pprint import pprint as p
 
@@ -332,3 +335,506 @@ class DBLayerTests(TestCase):
             {'location': {'action': 'field removed', 'data': 'France'}},
             {'other_names': {'action': 'array reordered', 'data': ['fred','george']}},
         ])
+
+
+    def test_query_budget(self):
+        self.db.collection.insert([{"name":"bob"}, {"name":"fred"}, {"name":"george"}])
+
+        with self.db.query_budget(4) as log:
+            cursor = self.db.collection.find()
+            items = [cursor[i] for i in range(cursor.count())]
+        self.assertEqual(len(items), 3)
+        self.assertEqual(log.count, 4)
+        self.assertEqual(log.by_kind(), {'count': 1, 'read': 3})
+        self.assertEqual(log.by_shape(), {
+            ('collection', 'count', '{}'): 1,
+            ('collection', 'find', '{}'): 3,
+        })
+
+        with self.db.track_queries() as log:
+            list(self.db._db.collection.find())
+        self.assertEqual(log.by_shape(), {('collection', 'find', '{}'): 1})
+
+        with self.assertRaises(QueryBudgetExceeded):
+            with self.db.query_budget(2):
+                cursor = self.db.collection.find()
+                [cursor[i] for i in range(cursor.count())]
+
+        with self.db.query_budget(1):
+            self.db.collection.find().all()
+
+        with self.db.track_queries(warn_after=2) as log:
+            for name in ['bob', 'fred', 'george']:
+                self.db.collection.find_one({"name": name})
+        self.assertEqual(log.repeated, [('collection', 'find_one', "{'name': ?}")])
+
+
+    def test_paginate(self):
+        self.db.collection.insert([{"name": x, "group": i % 2} for i, x in enumerate('abcdefg')])
+
+        items, token = self.db.collection.paginate(limit=3)
+        self.assertEqual([x.name for x in items], ['a', 'b', 'c'])
+        items, token = self.db.collection.paginate(limit=3, after=token)
+        self.assertEqual([x.name for x in items], ['d', 'e', 'f'])
+        items, token = self.db.collection.paginate(limit=3, after=token)
+        self.assertEqual([x.name for x in items], ['g'])
+        self.assertIsNone(token)
+
+        names = []
+        token = None
+        while True:
+            items, token = self.db.collection.paginate({'name': {'$ne': 'c'}}, ['name', 'group'], 2,
+                                                       [('group', -1), ('name', 1)], token)
+            names.extend(x.name for x in items)
+            self.assertEqual(sorted(items[0]._projection.keys()), ['_id', 'group', 'name'])
+            if not token:
+                break
+        self.assertEqual(names, ['b', 'd', 'f', 'a', 'e', 'g'])
+
+        self.db.nullable.insert([{"n": 3}, {"n": None}, {"n": 1}, {"n": None}, {"n": 2}])
+        for direction, expected in [(1, [2, 4, 3, 5, 1]), (-1, [1, 5, 3, 2, 4])]:
+            ids = []
+            token = None
+            while True:
+                items, token = self.db.nullable.paginate(limit=1, sort=[('n', direction)], after=token)
+                ids.extend(x._id for x in items)
+                if not token:
+                    break
+            self.assertEqual(ids, expected)
+
+        # $gt/$lt never match null or missing values on a server, so those get their own clauses
+        self.assertEqual(keyset_spec([('n', 1), ('_id', 1)], [None, 2]),
+                         {'$or': [{'n': {'$exists': True, '$ne': None}}, {'n': None, '_id': {'$gt': 2}}]})
+        self.assertEqual(keyset_spec([('n', -1), ('_id', 1)], [1, 3]),
+                         {'$or': [{'$or': [{'n': {'$lt': 1}}, {'n': None}]}, {'n': 1, '_id': {'$gt': 3}}]})
+        self.assertEqual(keyset_spec([('n', -1), ('_id', 1)], [None, 2]), {'n': None, '_id': {'$gt': 2}})
+        self.assertEqual(keyset_spec([('n', -1)], [None]), {'_id': {'$in': []}})
+
+
+    def test_find_page(self):
+        self.db.collection.insert([{"name": x, "data": {"a": i, "b": i}} for i, x in enumerate('abcde')])
+
+        page = self.db.collection.find_page({'name': {'$ne': 'a'}}, ['name'], skip=1, limit=2, sort=[('name', -1)])
+        self.assertEqual([x.name for x in page], ['d', 'c'])
+        self.assertEqual(page.items[0]._projection, {'_id': 4, 'name': 'd'})
+        self.assertEqual(page.total, 4)
+        self.assertTrue(page.has_more)
+
+        page = self.db.collection.find_page(skip=3, limit=2, total=None)
+        self.assertEqual([x.name for x in page], ['d', 'e'])
+        self.assertIsNone(page.total)
+        self.assertFalse(page.has_more)
+
+        page = self.db.collection.find_page({'name': {'$ne': 'a'}}, total='cached')
+        self.assertEqual(page.total, 4)
+        self.db.collection.insert({"name": "f"})
+        page = self.db.collection.find_page({'name': {'$ne': 'a'}}, total='cached')
+        self.assertEqual(page.total, 4)
+        self.assertEqual(len(page), 5)
+        page = self.db.collection.find_page(total='estimate')
+        self.assertEqual(page.total, 6)
+
+        doc = {'_id': 1, 'name': 'a', 'data': {'a': 1, 'b': 2}}
+        self.assertEqual(project(doc, ['data.a']), {'_id': 1, 'data': {'a': 1}})
+        self.assertEqual(project(doc, {'name': 1}), {'_id': 1, 'name': 'a'})
+        self.assertEqual(project(doc, {'data': 0}), {'_id': 1, 'name': 'a'})
+
+
+    def test_tracked_update(self):
+        self.db.collection.insert({
+            "name":"bob",
+            "extra": "x",
+            "subdoc": {"data": 1},
+            "num_list": [1,2],
+            "doclist": [{"name": "fred"}, {"name": "george"}, {"name": "ron"}],
+        })
+
+        doc = self.db.collection.find_one(1).track_changes()
+        doc.name = 'ignored attribute'
+        doc['name'] = 'bobby'
+        doc.subdoc['data'] = 5
+        del doc['extra']
+        doc['num_list'].append(3)
+        doc.doclist.pop(2)
+        doc.doclist.append({'name': 'ginny'})
+        doc.doclist.reverse()
+        doc['location'] = 'Paris'
+
+        with self.db.track_queries() as log:
+            self.db.collection.update(doc, 'admin')
+        # The update, the history seq counter and the history record
+        self.assertEqual(log.by_kind(), {'write': 3})
+        self.assertEqual(doc.get_changes(), ({}, []))
+
+        inst = self.db.collection.find_one(1)
+        self.assertEqual(inst, {
+            "_id": 1,
+            "name":"bobby",
+            "location": "Paris",
+            "subdoc": {"_id": 1, "data": 5},
+            "num_list": [1,2,3],
+            "doclist": [{"_id": 3, "name": "ginny"}, {"_id": 2, "name": "george"}, {"_id": 1, "name": "fred"}],
+        })
+
+        inst = self.db.history_find({"collection":"collection", "id":1})[1]
+        self.assertEqual(inst['username'], 'admin')
+        self.assertEqual(sorted(inst['changes']), sorted([
+            {'doclist': {'action': 'array reordered', 'data': [1, 2, 3]}},
+            {'doclist/0/name': 'ron'},
+            {'location': {'action': 'field added'}},
+            {'name': 'bob'},
+            {'num_list': {'action': 'item added', 'data': 3}},
+            {'subdoc/data': 1},
+            {'extra': {'action': 'field removed', 'data': 'x'}},
+        ]))
+
+        inst = self.db.collection.find_one(1).track_changes()
+        inst.doclist[1]['name'] = 'percy'
+        self.assertEqual(inst.get_changes(), ({'$set': {'doclist.1.name': 'percy'}}, [{'doclist/1/name': 'george'}]))
+        self.db.collection.update(inst)
+        self.assertEqual(self.db.collection.find_one(1).doclist[1].name, 'percy')
+
+
+    def test_session(self):
+        self.db.collection.insert([
+            {"name": "bob", "doclist": [{"name": "fred"}]},
+            {"name": "tom"},
+            {"name": "sally"},
+        ])
+
+        with self.db.track_queries() as log:
+            with self.db.session('admin') as session:
+                bob = session.collection.find_one(1)
+                self.assertTrue(session.collection.find({'name': 'bob'})[0] is bob)
+                bob['name'] = 'bobby'
+                bob.doclist.append({'name': 'george'})
+                session.collection.update(bob)
+                session.collection.update({'_id': 2, 'name': 'tommy'})
+                session.collection.remove(3)
+                self.assertEqual(session.collection.find_one(3), None)
+                self.assertEqual(session.collection.insert([{'name': 'jim'}, {'name': 'kim'}]), [4, 5])
+                session.other.insert({'name': 'ann'})
+                self.assertEqual(self.db.collection.find_one(1).name, 'bob')
+
+        shapes = log.by_shape()
+        self.assertEqual(shapes[('collection', 'insert', '{}')], 1)
+        self.assertEqual(shapes[('collection', 'remove', "{'_id': {'$in': ?}}")], 1)
+        self.assertEqual(shapes[('_history', 'insert', '{}')], 1)
+        self.assertEqual(len([x for x in log.queries if x[:2] == ('collection', 'update')]), 2)
+
+        self.assertEqual([x['name'] for x in self.db.collection.find()], ['bobby', 'tommy', 'jim', 'kim'])
+        self.assertEqual(self.db.collection.find_one(1).doclist, [{'_id': 1, 'name': 'fred'}, {'_id': 2, 'name': 'george'}])
+        self.assertEqual(self.db.other.find_one(1), {'_id': 1, 'name': 'ann'})
+        self.assertEqual(self.db.collection.insert({'name': 'next'}), 6)
+
+        history = self.db.history_find({'username': 'admin'})
+        self.assertEqual(sorted((x['collection'], x['id'], x.get('action')) for x in history), [
+            ('collection', 1, None),
+            ('collection', 2, None),
+            ('collection', 3, 'document removed'),
+            ('collection', 4, 'document created'),
+            ('collection', 5, 'document created'),
+            ('other', 1, 'document created'),
+        ])
+
+        try:
+            with self.db.session() as session:
+                session.collection.remove(1)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.db.collection.find_one(1).name, 'bobby')
+
+
+    def test_list_items(self):
+        self.db.collection.insert({"name": "bob", "doclist": [{"name": "fred"}, {"name": "george"}]})
+
+        with self.db.track_queries() as log:
+            self.assertEqual(self.db.collection.push_item(1, 'doclist', {'name': 'ron', 'pets': [{'name': 'scabbers'}]}, 'admin'), 3)
+        self.assertEqual(log.by_kind(), {'read': 1, 'write': 6})
+        with self.db.track_queries() as log:
+            self.assertEqual(self.db.collection.push_item(1, 'doclist', {'name': 'ginny'}), 4)
+        self.assertEqual(log.by_kind(), {'write': 4})
+        self.assertEqual(self.db.collection.push_item(5, 'doclist', {'name': 'nobody'}), None)
+
+        self.assertTrue(self.db.collection.pull_item(1, 'doclist', 4, 'admin'))
+        self.assertFalse(self.db.collection.pull_item(1, 'doclist', 4))
+        self.assertEqual(self.db.collection.push_item(1, 'doclist', {'name': 'percy'}), 5)
+
+        self.assertEqual(self.db.collection.find_item(1, 'doclist', 3), (2, {'_id': 3, 'name': 'ron', 'pets': [{'_id': 1, 'name': 'scabbers'}]}))
+        self.assertEqual(self.db.collection.find_item(1, 'doclist', 4), None)
+        self.db.collection.update_item(1, 'doclist', {'_id': 3, 'name': 'ronald'}, 'admin')
+
+        inst = self.db.collection.find_one(1)
+        self.assertEqual(inst.doclist, [
+            {'_id': 1, 'name': 'fred'},
+            {'_id': 2, 'name': 'george'},
+            {'_id': 3, 'name': 'ronald', 'pets': [{'_id': 1, 'name': 'scabbers'}]},
+            {'_id': 5, 'name': 'percy'},
+        ])
+        self.assertEqual(inst._seq, {'doclist': 5})
+
+        changes = [x['changes'] for x in self.db.history_find({'username': 'admin'})]
+        self.assertEqual(changes, [
+            [{'doclist': {'action': 'object added', 'data': 3}}],
+            [{'doclist': {'action': 'object removed', 'data': {'_id': 4, 'name': 'ginny'}}}],
+            [{'doclist/2/name': 'ron'}],
+        ])
+
+        inst.doclist.append({'name': 'charlie'})
+        self.db.collection.update(inst)
+        self.assertEqual(self.db.collection.find_one(1).doclist[-1]._id, 6)
+        self.db.collection.update({'_id': 1, '_seq': {'doclist': 2}}, direct=False)
+        self.assertEqual(self.db.collection.push_item(1, 'doclist', {'name': 'bill'}), 7)
+
+
+    def test_versioning(self):
+        self.db.versioning('collection', RetryPolicy(attempts=2, backoff=0))
+        self.db.collection.insert({"name": "bob", "count": 1, "doclist": [{"name": "fred"}]})
+        stale = self.db.collection.find_one(1)
+
+        self.db.collection.update({"_id": 1, "name": "bobby"})
+        self.assertEqual(self.db.collection.find_one(1)['_v'], 1)
+
+        # Loses the race against the update above, so is re-read and merged again
+        with self.db.track_queries() as log:
+            self.db.collection.update({"_id": 1, "count": 2}, stored=stale)
+        self.assertEqual([x[1] for x in log.queries if x[0] == 'collection'], ['update', 'find_one', 'update'])
+        data = self.db.collection.find_one(1)
+        self.assertEqual((data.name, data.count, data._v), ("bobby", 2, 2))
+
+        self.assertRaises(ConflictError, self.db.collection.update, {"_id": 1, "_v": 1, "count": 3})
+        self.assertRaises(ConflictError, self.db.collection.update, DBDoc(dict(stale, _v=1)), direct=True)
+        stale.track_changes()['count'] = 4
+        self.assertRaises(ConflictError, self.db.collection.update_tracked, stale)
+        self.assertEqual(self.db.collection.find_one(1).count, 2)
+
+        current = self.db.collection.find_one(1).track_changes()
+        current['count'] = 5
+        self.db.collection.update_tracked(current)
+        self.assertEqual(current._v, 3)
+        self.db.collection.push_item(1, "doclist", {"name": "george"})
+        self.assertEqual(self.db.collection.find_one(1)._v, 4)
+
+        changes = [x['changes'] for x in self.db.history_find({"changes": {"$exists": True}})]
+        self.assertEqual(changes, [
+            [{'name': 'bob'}],
+            [{'count': 1}],
+            [{'count': 2}],
+            [{'doclist': {'action': 'object added', 'data': 2}}],
+        ])
+
+
+    def test_versioned_session(self):
+        self.db.versioning('collection', RetryPolicy(attempts=2, backoff=0))
+        self.db.collection.insert({"name": "bob"})
+        self.db.collection.update({"_id": 1, "name": "bobby"})
+        stale = self.db.collection.find_one(1)
+
+        with self.db.session() as session:
+            session.collection.find_one(1)['name'] = 'session'
+            session.collection.update(session.collection.find_one(1))
+        data = self.db.collection.find_one(1)
+        self.assertEqual((data.name, data._v), ('session', 2))
+        self.assertRaises(ConflictError, self.db.collection.update, stale)
+
+        session = self.db.session()
+        doc = session.collection.find_one(1)
+        doc['name'] = 'lost'
+        session.collection.update(doc)
+        self.db.collection.update({"_id": 1, "name": "plain"})
+        self.assertRaises(ConflictError, session.commit)
+        self.assertEqual(self.db.collection.find_one(1).name, 'plain')
+
+
+    def test_batched_remove(self):
+        self.db.collection.insert([{"name": "bob", "num": x} for x in range(5)] + [{"name": "sue"}])
+        counts = []
+        with self.db.track_queries() as log:
+            result = self.db.collection.remove({"name": "bob"}, 'admin', batch_size=2, progress=counts.append)
+        self.assertEqual(result['n'], 5)
+        self.assertEqual(counts, [2, 4, 5])
+        self.assertEqual([x[1] for x in log.queries if x[0] == 'collection'].count('remove'), 3)
+        self.assertEqual([x[:2] for x in log.queries if x[0] == '_history'], [('_history', 'insert')] * 3)
+
+        self.assertEqual([x['name'] for x in self.db.collection.find()], ['sue'])
+        removed = self.db.history_find({"action": "document removed", "username": "admin"})
+        self.assertEqual(sorted(x['data']['num'] for x in removed), range(5))
+        self.assertEqual(self.db.collection.remove({"name": "bob"})['n'], 0)
+
+
+    def test_merge_lists(self):
+        doc = DBDoc({
+            "name": "bob",
+            "doclist": [
+                {"_id": 1, "name": "fred", "pets": [{"_id": 1, "name": "hedwig"}]},
+                {"_id": 2, "name": "george"},
+                {"_id": 3, "name": "ron"},
+            ],
+        })
+        fred, george = doc.doclist[0], doc.doclist[1]
+        hedwig = fred.pets[0]
+
+        merge(doc, {"doclist": [
+            {"_id": 2},
+            {"_id": 1, "name": "freddie", "pets": [{"_id": 1, "name": "errol"}]},
+            {"name": "ginny", "sub": {"data": 1}},
+        ]})
+
+        self.assertEqual(doc.doclist, [
+            {"_id": 2, "name": "george"},
+            {"_id": 1, "name": "freddie", "pets": [{"_id": 1, "name": "errol"}]},
+            {"name": "ginny", "sub": {"data": 1}},
+        ])
+        self.assertTrue(doc.doclist[0] is george)
+        self.assertTrue(doc.doclist[1] is fred)
+        self.assertTrue(doc.doclist[1].pets[0] is hedwig)
+        for item in doc.doclist:
+            self.assertTrue(item.get_parent() is doc.doclist)
+            self.assertTrue(item.get_root() is doc)
+        self.assertTrue(hedwig.get_root() is doc)
+        self.assertTrue(doc.doclist[2].sub.get_root() is doc)
+        self.assertEqual(type(doc.doclist[2]), DBDoc)
+
+
+    def test_merge_duplicate_ids(self):
+        doc = DBDoc({"doclist": [{"_id": 1, "name": "fred", "pets": [{"_id": 1, "name": "hedwig"}]}]})
+        fred = doc.doclist[0]
+
+        merge(doc, {"doclist": [{"_id": 1, "name": "freddie"}, {"_id": 1, "age": 3, "pets": [{"_id": 1, "name": "errol"}]}]})
+
+        self.assertEqual(doc.doclist, [
+            {"_id": 1, "name": "freddie", "pets": [{"_id": 1, "name": "hedwig"}]},
+            {"_id": 1, "name": "freddie", "age": 3, "pets": [{"_id": 1, "name": "errol"}]},
+        ])
+        self.assertTrue(doc.doclist[0] is fred)
+        self.assertFalse(doc.doclist[1].pets is fred.pets)
+        for item in doc.doclist:
+            self.assertTrue(item.get_parent() is doc.doclist)
+            self.assertTrue(item.pets[0].get_root() is doc)
+
+
+    def test_list_item_paging(self):
+        self.db.collection.insert({"name": "bob", "doclist": [{"num": x, "odd": x % 2} for x in range(10)]})
+
+        page = self.db.collection.find_items(1, 'doclist', 2, 3)
+        self.assertEqual([x.num for x in page], [2, 3, 4])
+        self.assertEqual((page.total, page.has_more), (10, True))
+        page = self.db.collection.find_items(1, 'doclist', 3, 5, {"odd": 1})
+        self.assertEqual(([x.num for x in page], page.total, page.has_more), ([7, 9], 5, False))
+        page = self.db.collection.find_items(1, 'doclist', spec={"$or": [{"num": 0}, {"num": {"$gt": 8}}]})
+        self.assertEqual([x.num for x in page], [0, 9])
+        self.assertEqual(self.db.collection.count_items(1, 'doclist'), 10)
+        self.assertEqual(self.db.collection.count_items(1, 'missing'), 0)
+
+        inst = self.db.collection.find_one(1, slices={'doclist': (8, 5)})
+        self.assertEqual(inst.doclist, [{"_id": 9, "num": 8, "odd": 0}, {"_id": 10, "num": 9, "odd": 1}])
+        self.assertTrue(inst.doclist[0].get_root() is inst)
+
+        # Merging a partial list leaves the objects it does not hold alone
+        inst.doclist[0]['num'] = 80
+        inst.doclist.append({"num": 10})
+        self.db.collection.update(inst)
+        stored = self.db.collection.find_one(1).doclist
+        self.assertEqual([x.num for x in stored], range(8) + [80, 9, 10])
+        self.assertEqual(stored[-1]._id, 11)
+
+        self.assertRaises(AssertionError, self.db.collection.update, inst, direct=True)
+        inst.track_changes()
+        inst['name'] = 'bobby'
+        self.db.collection.update(inst)
+        inst.doclist[0]['num'] = 8
+        self.assertRaises(AssertionError, self.db.collection.update, inst)
+        self.assertEqual(self.db.collection.count_items(1, 'doclist'), 11)
+
+
+    def test_bucketed_lists(self):
+        self.db.bucketing('collection', 'doclist', 3)
+        self.db.collection.insert({"name": "bob", "doclist": [{"num": x} for x in range(7)]})
+        buckets = self.db._db['collection.doclist']
+        self.assertEqual([(x['n'], x['count']) for x in buckets.find(sort=[('n', 1)])], [(0, 3), (1, 3), (2, 1)])
+        self.assertNotIn('doclist', self.db._db.collection.find_one(1))
+        self.assertRaises(DuplicateKeyError, buckets.insert, {'parent': 1, 'n': 2, 'count': 0, 'items': []})
+
+        inst = self.db.collection.find_one(1)
+        self.assertEqual([x.num for x in inst.doclist], range(7))
+        self.assertEqual([x._id for x in self.db.collection.find({}, ['doclist'])[0].doclist], range(1, 8))
+
+        # Appending rewrites only the last bucket
+        inst.doclist.append({"num": 7})
+        with self.db.track_queries() as log:
+            self.db.collection.update(inst, 'admin')
+        self.assertEqual([x[3] for x in log.queries if x[0] == 'collection.doclist' and x[2] == 'write'], ["{'n': ?, 'parent': ?}"])
+        self.assertEqual(self.db.collection.push_item(1, 'doclist', {"num": 8}), 9)
+        with self.db.track_queries() as log:
+            self.assertEqual(self.db.collection.push_item(1, 'doclist', {"num": 9}), 10)
+        self.assertEqual([x[1] for x in log.queries if x[0] == 'collection.doclist'], ['find', 'update'])
+        self.assertEqual([(x['n'], x['count']) for x in buckets.find(sort=[('n', 1)])], [(0, 3), (1, 3), (2, 3), (3, 1)])
+
+        self.assertEqual(self.db.collection.find_item(1, 'doclist', 5), (4, {"_id": 5, "num": 4}))
+        self.db.collection.update_item(1, 'doclist', {"_id": 5, "num": 40})
+        self.assertTrue(self.db.collection.pull_item(1, 'doclist', 2, 'admin'))
+        self.assertEqual(self.db.collection.count_items(1, 'doclist'), 9)
+        self.assertEqual([x.num for x in self.db.collection.find_items(1, 'doclist', 2, 3)], [3, 40, 5])
+        self.assertEqual([x.num for x in self.db.collection.find_items(1, 'doclist', 1, 2, {"num": {"$gte": 5}})], [5, 6])
+
+        inst = self.db.collection.find_one(1).track_changes()
+        inst.doclist[6]['num'] = 70
+        inst['name'] = 'bobby'
+        self.db.collection.update(inst)
+        inst = self.db.collection.find_one(1)
+        self.assertEqual((inst.name, [x.num for x in inst.doclist]), ('bobby', [0, 2, 3, 40, 5, 6, 70, 8, 9]))
+        self.assertEqual([(x['n'], x['count']) for x in buckets.find(sort=[('n', 1)])], [(0, 3), (1, 3), (2, 3)])
+
+        changes = [x['changes'] for x in self.db.history_find({'username': 'admin'})]
+        self.assertEqual(changes, [
+            [{'doclist': {'action': 'object added', 'data': 8}}],
+            [{'doclist': {'action': 'object removed', 'data': {'_id': 2, 'num': 1}}}],
+        ])
+        self.db.collection.remove(1)
+        self.assertEqual(buckets.find().count(), 0)
+
+
+    def test_bucketing_inline_lists(self):
+        self.db.collection.insert([{"name": x, "doclist": [{"num": y} for y in range(3)]} for x in ["bob", "sue", "tom", "ann"]])
+        self.db.bucketing('collection', 'doclist', 2)
+        buckets = self.db._db['collection.doclist']
+
+        # Stored inline until the first write to each document moves the list into buckets
+        self.assertEqual([x.num for x in self.db.collection.find_one(1).doclist], [0, 1, 2])
+        self.assertEqual(self.db.collection.count_items(2, 'doclist'), 3)
+        self.assertEqual(self.db.collection.find_item(2, 'doclist', 3), (2, {"_id": 3, "num": 2}))
+        self.assertEqual([x.num for x in self.db.collection.find_items(2, 'doclist', 1, 5)], [1, 2])
+
+        self.db.collection.update({"_id": 1, "name": "bobby"})
+        self.assertEqual(self.db.collection.push_item(2, 'doclist', {"num": 3}), 4)
+        inst = self.db.collection.find_one(3).track_changes()
+        inst.doclist[2]['num'] = 20
+        self.db.collection.update(inst)
+        self.db.collection.update_item(4, 'doclist', {"_id": 1, "num": 10})
+
+        for id, nums in [(1, [0, 1, 2]), (2, [0, 1, 2, 3]), (3, [0, 1, 20]), (4, [10, 1, 2])]:
+            self.assertNotIn('doclist', self.db._db.collection.find_one(id))
+            self.assertEqual(sum(x['count'] for x in buckets.find({'parent': id})), len(nums))
+            self.assertEqual([x.num for x in self.db.collection.find_one(id).doclist], nums)
+        self.assertTrue(self.db.collection.pull_item(4, 'doclist', 2))
+        self.assertEqual([x.num for x in self.db.collection.find_one(4).doclist], [10, 2])
+
+
+    def test_changes(self):
+        self.db.collection.insert([{"name": "bob"}, {"name": "sue"}])
+        self.db.other.insert({"name": "ann"})
+        self.db.collection.update({"_id": 1, "name": "bobby"})
+
+        events, token = self.db.changes(limit=2)
+        self.assertEqual([(x['seq'], x['collection'], x['id']) for x in events], [(1, 'collection', 1), (2, 'collection', 2)])
+        events, token = self.db.changes(token, collections=['collection'])
+        self.assertEqual([(x['seq'], x['changes']) for x in events], [(4, [{'name': 'bob'}])])
+        self.assertEqual(self.db.changes(token), ([], token))
+
+        # A seq taken by a write not yet in _history holds back the ones after it
+        self.db._db._ids.update({'collection': '_history'}, {'$inc': {'last_id': 1}})
+        self.db.collection.remove(2)
+        self.assertEqual(self.db.changes(token), ([], token))
+        events, token = self.db.changes(token, gap_timeout=0)
+        self.assertEqual([(x['seq'], x['action']) for x in events], [(6, 'document removed')])
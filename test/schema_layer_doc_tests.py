@@ -1,10 +1,11 @@
 import os
 from unittest import TestCase
 import datetime
+from copy import deepcopy
 
 import mongomock
 from schemongo.schema_layer.schema_doc import DBDoc, DBDocList, \
-    enforce_datatypes, generate_prototype, run_auto_funcs, enforce_ids, merge
+    enforce_datatypes, enforce_datatypes_bulk, generate_prototype, fill_in_prototypes, run_auto_funcs, enforce_ids, merge, Prototype
 
 from pprint import pprint as p
 
@@ -250,3 +251,106 @@ class DBDocTests(TestCase):
 
 
 
+
+
+    def test_prototype(self):
+        schema = {
+            "_id": {"type": "integer"},
+            "name": {"type": "string", "default": "anon"},
+            "full": {"type": "string", "serialize": lambda e: e.name},
+            "tags": {"type": "list", "default": ["new"]},
+            "meta": {"type": "dict", "default": {"source": "web"}},
+            "hash": {"type": "dict"},
+            "num_list": {"type": "list", "schema": {"type": "integer"}},
+            "subdoc": {"type": "dict", "schema": {
+                "data": {"type": "integer", "default": 3},
+                "deep": {"type": "dict", "schema": {
+                    "flags": {"type": "list", "default": []},
+                }},
+            }},
+            "doclist": {"type": "list", "schema": {"type": "dict", "schema": {
+                "_id": {"type": "integer"},
+                "name": {"type": "string"},
+                "count": {"type": "integer", "default": 0},
+            }}},
+        }
+        prototype = Prototype(schema)
+        first = prototype.instantiate()
+        second = prototype.instantiate()
+        self.assertEqual(first, generate_prototype(schema))
+        self.assertEqual(type(first.subdoc), DBDoc)
+        self.assertEqual(type(first.meta), DBDoc)
+        self.assertTrue(first.subdoc.deep.get_root() is first)
+        self.assertTrue(first.doclist.get_parent() is first)
+
+        first.tags.append("old")
+        first.meta['source'] = "api"
+        first.subdoc.deep.flags.append(1)
+        self.assertEqual(second.tags, ["new"])
+        self.assertEqual(second.meta, {"source": "web"})
+        self.assertEqual(second.subdoc.deep.flags, [])
+        self.assertEqual(schema["tags"]["default"], ["new"])
+        self.assertEqual(generate_prototype(schema).tags, ["new"])
+
+        data = DBDoc({"name": "bob", "subdoc": None, "doclist": [{"_id": 1, "name": "fred"}], "stray": 1})
+        expected = DBDoc({"name": "bob", "subdoc": None, "doclist": [{"_id": 1, "name": "fred"}], "stray": 1})
+        prototype.fill(data)
+        fill_in_prototypes(schema, expected)
+        self.assertEqual(data, expected)
+        self.assertEqual(data.doclist[0], {"_id": 1, "name": "fred", "count": 0})
+
+
+    def test_parse_datetime(self):
+        import dateutil.parser
+        from schemongo.db_layer.dates import parse_datetime
+        for val in [
+            '2014-03-09',
+            '2014-03-09T10:21',
+            '2014-03-09 10:21:05',
+            '2014-03-09T10:21:05.123',
+            '2014-03-09T10:21:05.1234567',
+            '2014-03-09T10:21:05Z',
+            '2014-03-09T10:21:05.5+05:30',
+            '2014-03-09T10:21:05-0800',
+            '2014-03-09T10:21-03',
+            'March 9, 2014 10:21am',
+            '09/03/2014',
+        ]:
+            parsed, expected = parse_datetime(val), dateutil.parser.parse(val)
+            self.assertEqual(parsed, expected, val)
+            self.assertEqual(parsed.utcoffset(), expected.utcoffset(), val)
+        self.assertRaises(ValueError, parse_datetime, '2014-13-09')
+
+
+    def test_enforce_datatypes_bulk(self):
+        schema = {
+            "name": {"type": "string"},
+            "count": {"type": "integer"},
+            "price": {"type": "float"},
+            "active": {"type": "boolean"},
+            "when": {"type": "datetime"},
+            "nums": {"type": "list", "schema": {"type": "integer"}},
+            "auto": {"type": "integer", "auto": lambda e: 1},
+            "subdoc": {"type": "dict", "schema": {
+                "data": {"type": "integer"},
+            }},
+            "doclist": {"type": "list", "schema": {"type": "dict", "schema": {
+                "data": {"type": "integer"},
+            }}},
+        }
+        docs = [
+            {"name": "bob", "count": "3", "price": 2, "active": 1, "when": "2014-03-09T10:21:05Z", "nums": ["1", 2]},
+            {"name": 5, "count": "x", "price": "1.5", "auto": 7, "extra": 1, "subdoc": {"data": "y"}},
+            {"count": None, "price": "z", "nums": ["a"], "doclist": [{"data": "1"}, {"data": "q"}]},
+            {"count": 4, "price": 1.0, "active": False, "subdoc": {"data": 2}},
+        ]
+        expected = deepcopy(docs)
+        expected_errs = [enforce_datatypes(schema, x) for x in expected]
+
+        self.assertEqual(enforce_datatypes_bulk(schema, docs), expected_errs)
+        self.assertEqual(docs, expected)
+        self.assertEqual([type(x.get('count')) for x in docs], [int, str, type(None), int])
+        self.assertEqual(expected_errs[1], [
+            "count: Could not convert 'x' to type 'integer'",
+            "subdoc/data: Could not convert 'y' to type 'integer'",
+        ])
@@ -1,13 +1,21 @@
 import os
-from unittest import TestCase
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
 import datetime
 from dateutil.tz import tzlocal
 
 import mongomock
 from schemongo import schema_layer
 from schemongo.db_layer.db_doc import DBDoc
+from schemongo.db_layer.collection import project, ConflictError, RetryPolicy
+from schemongo.schema_layer import columnar
+from schemongo.schema_layer.expansion import compile_lookup_pipeline, expand_tree, LOOKUP_KEY
+from schemongo.schema_layer.database import apply_lookups
+from bson.son import SON
 
 import json
+from StringIO import StringIO
 from pprint import pprint as p
 
 
@@ -845,6 +853,131 @@ class SchemaLayerTests(TestCase):
         })
 
 
+    def test_delete_references_batched(self):
+        self.db.register_schema('users', {
+            "name": {"type": "string"},
+        })
+        self.db.register_schema('test', {
+            "owner": {"type": "reference", "collection": "users", "required": True},
+            "contacts": {"type": "list", "schema": {"type": "reference", "collection": "users"}},
+        })
+        self.db.register_schema('test', self.db.schemas['test'])
+        self.assertEqual(self.db.references['users'], ['test'])
+        self.db.users.insert([{"name": x} for x in ['Bob', 'Fred', 'Sue', 'Ann']])
+        self.db.test.insert({"owner": {"_id": 4}, "contacts": [{"_id": 1}, {"_id": 2}, {"_id": 3}]})
+
+        self.assertEqual(self.db.users.remove({"_id": {"$gt": 1}}, batch_size=2), [
+            "Collection 'test', item 1: undeleteable reference encountered"
+        ])
+        self.assertEqual(self.db.users.find().count(), 4)
+
+        with self.db.track_queries() as log:
+            self.assertIsNone(self.db.users.remove({"_id": {"$lt": 4}}, batch_size=2))
+        # The referring documents are found by querying the reference paths, not by a scan
+        self.assertNotIn(('test', 'find', 'read', '{}'), log.queries)
+        self.assertEqual([x['name'] for x in self.db.users.find()], ['Ann'])
+        self.assertEqual(self.db.test.find_one(1).contacts, [])
+
+
+    def test_delete_bucketed_reference(self):
+        self.db.register_schema('users', {"name": {"type": "string"}})
+        self.db.register_schema('test', {
+            "lines": {"type": "list", "bucket": 2, "schema": {"type": "dict", "schema": {
+                "user": {"type": "reference", "collection": "users"},
+            }}},
+        })
+        self.db.users.insert([{"name": x} for x in ['Bob', 'Fred', 'Sue']])
+        self.db.test.insert([{"lines": [{"user": {"_id": 3}}, {"user": {"_id": 2}}, {"user": {"_id": 1}}]}, {"lines": []}])
+
+        self.assertIsNone(self.db.users.remove(1))
+        self.assertEqual([x.user for x in self.db.test.find_one(1, expand=False).lines], [{"_id": 3}, {"_id": 2}, None])
+
+
+    def test_export_import(self):
+        schema = {
+            "name": {"type": "string", "required": True},
+            "joined": {"type": "datetime"},
+            "upper": {"type": "string", "serialize": lambda e: e.name.upper()},
+            "friend": {"type": "reference", "collection": "test"},
+            "tags": {"type": "list", "schema": {"type": "dict", "schema": {"label": {"type": "string"}}}},
+        }
+        self.db.register_schema('test', schema)
+        self.db.test.insert([
+            {"name": "Bob", "joined": "2014-03-09T10:21:05Z", "tags": [{"label": "a"}, {"label": "b"}]},
+            {"name": "Sue", "friend": {"_id": 1}},
+        ])
+        self.db.test.remove(1)
+        self.db.test.insert({"name": "Ann", "friend": {"_id": 2}})
+
+        out = StringIO()
+        self.assertEqual(self.db.export_collection('test', out), 2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[0]), json.loads(self.db.test.serialize(self.db.test.find_one(2, expand=False))))
+
+        other = schema_layer.init(mongomock.MongoClient(), 'other')
+        other.register_schema('test', schema)
+        other.test.insert({"name": "Joe"})
+        id_map, errs = other.import_collection('test', ['{"name": "Bad"'] + lines + ['', '{"_id": 9}', '[1]'], 'admin', batch_size=2)
+        self.assertEqual((id_map, errs), ({2: 2, 3: 3}, [
+            'line 1: invalid JSON',
+            'line 5: name: value is required',
+            'line 6: not an object',
+        ]))
+        self.assertEqual(other.test.find_one(3, expand=False).friend, {'_id': 2})
+        self.assertEqual(other.test.serialize(other.test.find_one(3)), self.db.test.serialize(self.db.test.find_one(3)))
+        self.assertEqual(other.test.insert({"name": "Jim"}), ([4], None))
+        self.assertEqual(other.history_find({"username": "admin"}).count(), 2)
+
+        id_map, errs = other.import_collection('test', out.getvalue().splitlines(), ids='remap', history=False)
+        self.assertEqual(id_map, {2: 5, 3: 6})
+        self.assertEqual([x['name'] for x in other.test.find()], ['Joe', 'Sue', 'Ann', 'Jim', 'Sue', 'Ann'])
+        self.assertEqual(other.history_find({"id": {"$gt": 4}}).count(), 0)
+
+
+    @skipIf(columnar.numpy is None, "needs numpy")
+    def test_export_columns(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "count": {"type": "integer"},
+            "price": {"type": "float"},
+            "active": {"type": "boolean"},
+            "placed": {"type": "datetime"},
+            "owner": {"type": "reference", "collection": "test"},
+            "address": {"type": "dict", "schema": {"city": {"type": "string"}}},
+            "tags": {"type": "list"},
+            "label": {"type": "string", "serialize": lambda e: e.name},
+        })
+        self.db.test.insert([
+            {"name": u"B\xf6b", "count": 3, "price": 1.5, "active": True, "placed": "2014-03-09T10:21:05.5Z",
+             "address": {"city": "Paris"}, "tags": ["a"]},
+            {"count": 4, "owner": {"_id": 1}, "address": {"city": "Caen"}},
+        ])
+        path = tempfile.mkdtemp()
+        try:
+            self.assertEqual(self.db.export_columns('test', path), 2)
+            snapshot = columnar.load_columns(path)
+            self.assertEqual(snapshot.keys(), ['_id', 'active', 'address.city', 'count', 'name', 'owner', 'placed', 'price'])
+            self.assertTrue(isinstance(snapshot['count'], columnar.numpy.memmap))
+            self.assertEqual(list(snapshot['count']), [3, 4])
+            self.assertEqual(list(snapshot['_id']), [1, 2])
+            self.assertEqual(list(snapshot['name']), [u"B\xf6b", None])
+            self.assertEqual(list(snapshot['address.city']), ["Paris", "Caen"])
+            self.assertEqual(list(snapshot.valid['owner']), [False, True])
+            self.assertEqual(snapshot['owner'][1], 1)
+            self.assertEqual(str(snapshot['placed'][0]), '2014-03-09T10:21:05.500000')
+
+            self.assertEqual(self.db.export_columns('test', path, batch_size=1), 2)
+            snapshot = columnar.load_columns(path)
+            self.assertEqual(list(snapshot['name']), [u"B\xf6b", None])
+            self.assertEqual(list(snapshot['price']), [1.5, 0])
+            self.assertEqual(len(snapshot.valid['active']), 2)
+
+            self.assertEqual(self.db.export_columns('test', path, {'count': 9}), 0)
+            self.assertEqual(list(columnar.load_columns(path)['name']), [])
+        finally:
+            shutil.rmtree(path)
+
+
     def test_serialized_projection(self):
         self.db.register_schema('test', {
             "first_name": {"type": "string"},
@@ -1173,6 +1306,20 @@ class SchemaLayerTests(TestCase):
         self.assertIsNone(self.db.test.find_one({'_id':2}))
 
 
+    def test_allowed_unhashable(self):
+        self.db.register_schema('test', {
+            "opts": {"type": "dict", "allowed": ["none", {"x": 1}]},
+            "codes": {"type": "dict", "allowed": ["a", "b"]},
+            "tags": {"type": "list", "schema": {"type": "dict", "allowed": ["a"]}},
+        })
+        self.assertEqual(self.db.test.insert({"opts": {"x": 2}, "codes": {"x": 1}, "tags": [{"x": 1}]})[1], [
+            "codes: '{'x': 1}' not one of the allowed values",
+            "opts: '{'x': 2}' not one of the allowed values",
+            "tags/0: '{'x': 1}' not one of the allowed values",
+        ])
+        self.assertEqual(self.db.test.insert({"opts": {"x": 1}})[1], ["codes: '{}' not one of the allowed values"])
+
+
     def test_allowed_string_list(self):
         self.db.register_schema('test', {
             "name": {"type": "string"},
@@ -1189,4 +1336,579 @@ class SchemaLayerTests(TestCase):
         ids, errs = self.db.test.insert(data)
         self.assertIsNotNone(errs)
 
-        self.assertEqual(errs, ["tags/0: 'lalala' not one of the allowed values"])
\ No newline at end of file
+        self.assertEqual(errs, ["tags/0: 'lalala' not one of the allowed values"])
+
+    def test_paginate(self):
+        self.db.register_schema('users', {
+            "username": {"type": "string"},
+        })
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "contact": {'type': 'reference', 'collection': 'users', 'fields': ['username']},
+        })
+        ids, errs = self.db.users.insert({'username': 'bob'})
+        ids, errs = self.db.test.insert([{'name': x, 'contact': {'_id': 1}} for x in 'cba'])
+        self.assertIsNone(errs)
+
+        items, token = self.db.test.paginate(limit=2, sort=[('name', 1)])
+        self.assertEqual([x.name for x in items], ['a', 'b'])
+        self.assertEqual(items[0].contact.username, 'bob')
+
+        items, token = self.db.test.paginate(limit=2, sort=[('name', 1)], after=token)
+        self.assertEqual([x.name for x in items], ['c'])
+        self.assertIsNone(token)
+
+
+    def test_expand_selection(self):
+        self.db.register_schema('companies', {
+            "name": {"type": "string"},
+            "owner": {'type': 'reference', 'collection': 'users', 'fields': ['username']},
+        })
+        self.db.register_schema('users', {
+            "username": {"type": "string"},
+            "company": {'type': 'reference', 'collection': 'companies', 'fields': ['name']},
+        })
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "contact": {'type': 'reference', 'collection': 'users', 'fields': ['username', 'company']},
+            "others": {"type": "list", "schema": {'type': 'reference', 'collection': 'users'}},
+        })
+        self.db.companies.insert({'name': 'Acme'}, direct=True)
+        self.db.users.insert({'username': 'bob', 'company': {'_id': 1}})
+        self.db.companies.update({'_id': 1, 'owner': {'_id': 1}})
+        ids, errs = self.db.test.insert({'name': 'Samsung', 'contact': {'_id': 1}, 'others': [{'_id': 1}]})
+        self.assertIsNone(errs)
+
+        inst = self.db.test.find_one(1)
+        self.assertEqual(inst.contact.company.name, 'Acme')
+        self.assertEqual(inst.contact.company.owner, {'_id': 1})
+
+        inst = self.db.test.find_one(1, expand=False)
+        self.assertEqual(inst.contact, {'_id': 1})
+        self.assertEqual(inst.others, [{'_id': 1}])
+        self.assertEqual(json.loads(self.db.test.serialize(inst)), {
+            '_id': 1, 'name': 'Samsung', 'contact': {'_id': 1}, 'others': [{'_id': 1}]
+        })
+
+        inst = self.db.test.find({}, expand=['contact'])[0]
+        self.assertEqual(inst.contact.username, 'bob')
+        self.assertEqual(inst.contact.company, {'_id': 1})
+        self.assertEqual(inst.others, [{'_id': 1}])
+
+        inst = self.db.test.find_one(1, expand={'contact.company': True, 'others': 0})
+        self.assertEqual(inst.contact.company.name, 'Acme')
+        self.assertEqual(inst.others[0].username, 'bob')
+        self.assertEqual(inst.others[0].company, {'_id': 1})
+
+        inst = self.db.test.find_one(1, expand=2)
+        self.assertEqual(inst.contact.company.name, 'Acme')
+        self.assertEqual(inst.contact.company.owner, {'_id': 1})
+
+        self.db.register_schema('users', self.db.schemas['users'], expand=False)
+        inst = self.db.test.find_one(1)
+        self.assertEqual(inst.contact.username, 'bob')
+        self.assertEqual(inst.contact.company, {'_id': 1})
+
+
+    def test_lazy_references(self):
+        self.db.register_schema('users', {
+            "username": {"type": "string"},
+            "manager": {'type': 'reference', 'collection': 'users', 'fields': ['username']},
+        })
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "contact": {'type': 'reference', 'collection': 'users', 'fields': ['username']},
+            "others": {"type": "list", "schema": {'type': 'reference', 'collection': 'users'}},
+        })
+        self.db.users.insert([{'username': 'bob'}, {'username': 'fred'}, {'username': 'george'}])
+        self.db.users.update({'_id': 2, 'manager': {'_id': 1}})
+        self.db.test.insert([
+            {'name': 'Samsung', 'contact': {'_id': 1}, 'others': [{'_id': 2}, {'_id': 3}]},
+            {'name': 'Apple', 'contact': {'_id': 2}, 'others': []},
+            {'name': 'Nokia', 'contact': {'_id': 4}, 'others': []},
+        ])
+
+        with self.db.track_queries() as log:
+            items = self.db.test.find(lazy=True).all()
+            self.assertEqual(log.count, 1)
+            self.assertEqual(items[0].contact['_id'], 1)
+            self.assertEqual(log.count, 1)
+
+            self.assertEqual(items[1].contact.username, 'fred')
+            self.assertEqual(log.count, 2)
+            self.assertEqual(items[0].others[1]['username'], 'george')
+            self.assertEqual(items[0].contact.username, 'bob')
+            self.assertEqual(log.count, 2)
+
+            self.assertEqual(items[1].contact.manager.username, 'bob')
+            self.assertEqual(log.count, 3)
+
+        self.assertEqual(json.loads(self.db.test.serialize(items[0])), {
+            '_id': 1, 'name': 'Samsung',
+            'contact': {'_id': 1, 'username': 'bob'},
+            'others': [{'_id': 2, 'username': 'fred', 'manager': {'_id': 1, 'username': 'bob'}},
+                       {'_id': 3, 'username': 'george', 'manager': None}],
+        })
+        self.assertEqual(json.loads(self.db.test.serialize(items[2]))['contact'], {'_err': 'reference not found'})
+        dangling = self.db.test.find_one(3, lazy=True)
+        self.assertEqual(json.loads(self.db.test.serialize(dangling))['contact'], {'_err': 'reference not found'})
+        # A proxy cannot turn into the string eager expansion gives, so it stays a dict flagged _missing
+        self.assertEqual(self.db.test.find_one(3).contact, 'reference not found')
+        self.assertTrue(dangling.contact._missing)
+        self.assertEqual(dangling.contact, {'_id': 4})
+        self.assertFalse(items[0].contact._missing)
+
+        inst = self.db.test.find_one(1, lazy=True)
+        self.assertEqual(inst, self.db.test.find_one(1))
+
+
+    def test_lookup_find(self):
+        self.db.register_schema('users', {
+            "username": {"type": "string"},
+            "region": {"type": "string"},
+        })
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "contact": {'type': 'reference', 'collection': 'users', 'fields': ['username']},
+            "others": {"type": "list", "schema": {'type': 'reference', 'collection': 'users'}},
+        })
+        self.db.users.insert([{'username': 'bob', 'region': 'X'}, {'username': 'fred', 'region': 'Y'}])
+        self.db.test.insert([
+            {'name': 'Samsung', 'contact': {'_id': 1}, 'others': [{'_id': 2}]},
+            {'name': 'Apple', 'contact': {'_id': 2}, 'others': [{'_id': 1}, {'_id': 2}]},
+        ])
+
+        pipeline, refs = compile_lookup_pipeline(self.db, self.db.schemas['test'],
+            {'name': {'$ne': 'Nokia'}, 'contact.region': 'X'}, 0, 10, [('contact.username', 1)], expand_tree(['others']))
+        self.assertEqual([x[0] for x in refs], ['contact', 'others'])
+        self.assertEqual(pipeline, [
+            {'$match': {'name': {'$ne': 'Nokia'}}},
+            {'$lookup': {'from': 'users', 'let': {'ref': '$contact'}, 'as': '_lookup.contact', 'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$_id', '$$ref']}}},
+                {'$project': {'username': 1, 'region': 1}},
+            ]}},
+            {'$lookup': {'from': 'users', 'localField': 'others', 'foreignField': '_id', 'as': '_lookup.others'}},
+            {'$match': {'_lookup.contact.region': 'X'}},
+            {'$sort': SON([('_lookup.contact.username', 1)])},
+            {'$limit': 10},
+        ])
+
+        # Paging comes first when nothing remote is queried; 'fields' still limit an expanded reference
+        pipeline, refs = compile_lookup_pipeline(self.db, self.db.schemas['test'], {'name': 'Apple'}, 1, 0, [('name', 1)], True)
+        self.assertEqual([x.keys()[0] for x in pipeline], ['$match', '$sort', '$skip', '$lookup', '$lookup'])
+        self.assertEqual(pipeline[3]['$lookup']['pipeline'][-1], {'$project': {'username': 1}})
+        self.assertNotIn('pipeline', pipeline[4]['$lookup'])
+
+        eager = self.db.test.find({}, sort=[('name', 1)]).all()
+        lookup = self.db.test.find({}, sort=[('name', 1)], lookup=True).all()
+        self.assertEqual([self.db.test.serialize(x) for x in lookup], [self.db.test.serialize(x) for x in eager])
+        self.assertEqual([x.name for x in self.db.test.find({'contact.region': 'X'}, lookup=True)], ['Samsung'])
+        self.assertRaises(NotImplementedError, self.db.test.find, {}, sort=[('contact.username', 1)], lookup=True)
+
+
+    def test_lookup_results(self):
+        self.db.register_schema('users', {
+            "username": {"type": "string"},
+            "region": {"type": "string"},
+        })
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "contact": {'type': 'reference', 'collection': 'users', 'fields': ['username']},
+            "others": {"type": "list", "schema": {'type': 'reference', 'collection': 'users'}},
+        })
+        self.db.users.insert([{'username': 'bob', 'region': 'X'}, {'username': 'fred', 'region': 'Y'}])
+        self.db.test.insert({'name': 'Apple', 'contact': {'_id': 2}, 'others': [{'_id': 1}, {'_id': 3}]})
+
+        # What the server returns for the pipeline, which projects contact to its 'fields'
+        refs = compile_lookup_pipeline(self.db, self.db.schemas['test'], {'name': 'Apple'})[1]
+        raw = {'_id': 1, 'name': 'Apple', 'contact': 2, 'others': [1, 3], LOOKUP_KEY: {
+            'contact': [{'_id': 2, 'username': 'fred'}],
+            'others': [{'_id': 1, 'username': 'bob', 'region': 'X'}],
+        }}
+        found = raw.pop(LOOKUP_KEY)
+        item = DBDoc(raw, None, project(raw, ['name', 'contact']))
+        apply_lookups(self.db, refs, item, found)
+        self.assertEqual(item, {
+            '_id': 1, 'name': 'Apple',
+            'contact': {'_id': 2, 'username': 'fred'},
+            'others': [{'_id': 1, 'username': 'bob', 'region': 'X'}, 'reference not found'],
+        })
+        self.assertEqual(item._projection, {'_id': 1, 'name': 'Apple', 'contact': 2})
+        self.assertEqual(json.loads(self.db.test.serialize(item)), {
+            '_id': 1, 'name': 'Apple', 'contact': {'_id': 2, 'username': 'fred'},
+        })
+
+        # Eager expansion keeps the whole referenced document; both serialize the same
+        eager = self.db.test.find_one(1, ['name', 'contact'])
+        self.assertEqual(eager.contact, {'_id': 2, 'username': 'fred', 'region': 'Y'})
+        self.assertEqual(json.loads(self.db.test.serialize(item)), json.loads(self.db.test.serialize(eager)))
+
+
+    def test_reference_field_query(self):
+        self.db.register_schema('regions', {
+            "name": {"type": "string"},
+        })
+        self.db.register_schema('customers', {
+            "name": {"type": "string"},
+            "region": {'type': 'reference', 'collection': 'regions'},
+            "active": {"type": "boolean"},
+        })
+        self.db.register_schema('orders', {
+            "number": {"type": "integer"},
+            "customer": {'type': 'reference', 'collection': 'customers'},
+            "shipping": {"type": "dict", "schema": {
+                "carriers": {"type": "list", "schema": {'type': 'reference', 'collection': 'customers'}},
+            }},
+        })
+        self.db.regions.insert([{'name': 'North'}, {'name': 'South'}])
+        self.db.customers.insert([
+            {'name': 'bob', 'region': {'_id': 1}, 'active': True},
+            {'name': 'fred', 'region': {'_id': 2}, 'active': True},
+            {'name': 'george', 'region': {'_id': 1}, 'active': False},
+        ])
+        self.db.orders.insert([
+            {'number': 1, 'customer': {'_id': 1}, 'shipping': {'carriers': [{'_id': 2}]}},
+            {'number': 2, 'customer': {'_id': 2}, 'shipping': {'carriers': [{'_id': 1}, {'_id': 3}]}},
+            {'number': 3, 'customer': {'_id': 3}, 'shipping': {'carriers': []}},
+        ])
+
+        self.assertEqual(self.db.orders.resolve_spec({'customer.active': True, 'number': {'$gt': 1}}), {
+            'customer': {'$in': [1, 2]}, 'number': {'$gt': 1}
+        })
+
+        with self.db.track_queries() as log:
+            items = self.db.orders.find({'customer.region.name': 'North', 'customer.active': True}, expand=False).all()
+        self.assertEqual([x.number for x in items], [1])
+        self.assertEqual(log.count, 3)
+
+        items = self.db.orders.find({'shipping.carriers.name': 'george'}).all()
+        self.assertEqual([x.number for x in items], [2])
+
+        items = self.db.orders.find({'$or': [{'customer.name': 'fred'}, {'number': 3}]}).all()
+        self.assertEqual([x.number for x in items], [2, 3])
+
+        self.assertEqual(self.db.orders.find_one({'customer.name': 'george'}).number, 3)
+
+
+    def test_session(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string", "required": True},
+            "count": {"type": "integer"},
+        })
+        self.db.test.insert([{"name": "Bob", "count": 1}, {"name": "Sue", "count": 2}])
+
+        with self.db.track_queries() as log:
+            with self.db.session('admin') as session:
+                self.assertEqual(session.test.insert({"count": 3})[0], [])
+                self.assertEqual(session.test.insert({"name": "Ann", "count": 3}), ([3], None))
+                self.assertTrue(session.test.update({"_id": 1, "count": "x"}))
+                self.assertIsNone(session.test.update({"_id": 1, "count": 5}))
+                self.assertIsNone(session.test.update({"_id": 1, "name": "Bobby"}))
+                session.test.remove(2)
+        self.assertEqual(len([x for x in log.queries if x[:2] == ('test', 'find_one')]), 1)
+
+        self.assertEqual([(x['_id'], x['name'], x['count']) for x in self.db.test.find()], [
+            (1, "Bobby", 5),
+            (3, "Ann", 3),
+        ])
+        changes = self.db.history_find({"id": 1, "username": "admin"})[0]['changes']
+        self.assertEqual(sorted(changes), [{'count': 1}, {'name': 'Bob'}])
+
+        with self.db.session() as session:
+            self.assertEqual(session.test.update({"_id": 9, "count": 5}), ["_id: '9' not found"])
+
+
+    def test_list_items(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "doclist": {"type": "list", "schema": {"type": "dict", "schema": {
+                "name": {"type": "string", "required": True},
+                "count": {"type": "integer", "default": 0},
+                "label": {"type": "string", "auto": lambda e: "%s (%s)" % (e.name, e.count), "depends": ["name", "count"]},
+            }}},
+        })
+        self.db.test.insert({"name": "Bob", "doclist": [{"name": "Fred"}]})
+
+        self.assertEqual(self.db.test.push_item(1, 'doclist', {"count": 4}), (None, ['name: value is required']))
+        self.assertEqual(self.db.test.push_item(1, 'doclist', {"name": "George", "count": "4"}), (2, None))
+        self.assertEqual(self.db.test.update_item(1, 'doclist', {"_id": 2, "count": "x"}), ["count: Could not convert 'x' to type 'integer'"])
+        self.assertEqual(self.db.test.update_item(1, 'doclist', {"_id": 7, "count": 1}), ["doclist: item 7 not found"])
+        self.assertIsNone(self.db.test.update_item(1, 'doclist', {"_id": 1, "count": 3}))
+        self.assertTrue(self.db.test.pull_item(1, 'doclist', 1))
+
+        data = self.db.test.find_one(1)
+        self.assertEqual(data.doclist, [{"_id": 2, "name": "George", "count": 4, "label": "George (4)"}])
+        self.assertEqual(json.loads(self.db.test.serialize(data)), {
+            "_id": 1,
+            "name": "Bob",
+            "doclist": [{"_id": 2, "name": "George", "count": 4, "label": "George (4)"}],
+        })
+
+        self.db.test.update({"_id": 1, "name": "Bobby"})
+        self.assertEqual(self.db.test.find_one(1)._seq, {'doclist': 2})
+        self.assertEqual(self.db.history_find({"id": 1})[-1]['changes'], [{'name': 'Bob'}])
+
+
+    def test_list_items_through_document(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "total": {"type": "integer", "auto": lambda e: sum(x.count for x in e.doclist), "depends": ["doclist"]},
+            "doclist": {"type": "list", "schema": {"type": "dict", "schema": {
+                "name": {"type": "string", "required": True},
+                "count": {"type": "integer", "default": 0},
+                "owner": {"type": "string", "auto_init": lambda e: e.get_root().name},
+            }}},
+        })
+        self.db.test.insert({"name": "Bob", "doclist": [{"name": "Fred", "count": 1}]})
+
+        self.assertEqual(self.db.test.push_item(1, 'doclist', {"count": 4}), (None, ['name: value is required']))
+        self.assertEqual(self.db.test.push_item(1, 'doclist', {"name": "George", "count": "4"}), (2, None))
+        self.assertEqual(self.db.test.push_item(7, 'doclist', {"name": "Ann"}), (None, None))
+        data = self.db.test.find_one(1)
+        self.assertEqual([(x.name, x.owner) for x in data.doclist], [("Fred", "Bob"), ("George", "Bob")])
+        self.assertEqual(data.total, 5)
+
+        self.assertEqual(self.db.test.update_item(1, 'doclist', {"_id": 7, "count": 1}), ["doclist: item 7 not found"])
+        self.assertIsNone(self.db.test.update_item(1, 'doclist', {"_id": 1, "count": 3}))
+        self.assertEqual(self.db.test.find_one(1).total, 7)
+
+        self.assertFalse(self.db.test.pull_item(1, 'doclist', 7))
+        self.assertTrue(self.db.test.pull_item(1, 'doclist', 2))
+        data = self.db.test.find_one(1)
+        self.assertEqual([x.name for x in data.doclist], ["Fred"])
+        self.assertEqual(data.total, 3)
+
+
+    def test_list_item_auto_reads_parent(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "doclist": {"type": "list", "schema": {"type": "dict", "schema": {
+                "name": {"type": "string"},
+                "label": {"type": "string", "auto": lambda e: "%s/%s" % (e.get_root().name, e.name)},
+            }}},
+        })
+        self.db.test.insert({"name": "Bob", "doclist": []})
+        self.assertEqual(self.db.test.push_item(1, 'doclist', {"name": "Fred"}), (1, None))
+        self.db.test.update({"_id": 1, "name": "Bobby"})
+        self.assertIsNone(self.db.test.update_item(1, 'doclist', {"_id": 1, "name": "George"}))
+        self.assertEqual(self.db.test.find_one(1).doclist, [{"_id": 1, "name": "George", "label": "Bobby/George"}])
+
+
+    def test_list_item_paging(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "doclist": {"type": "list", "schema": {"type": "dict", "schema": {
+                "name": {"type": "string"},
+                "count": {"type": "integer", "default": 0},
+                "owner": {"type": "reference", "collection": "owners"},
+            }}},
+        })
+        self.db.register_schema('owners', {"name": {"type": "string"}})
+        self.db.owners.insert({"name": "Ann"})
+        self.db.test.insert({"name": "Bob", "doclist": [{"name": "item%i" % x, "count": x, "owner": {"_id": 1}} for x in range(6)]})
+
+        page = self.db.test.find_items(1, 'doclist', 1, 2, {"count": {"$gte": 2}})
+        self.assertEqual([(x.name, x.owner.name) for x in page], [("item3", "Ann"), ("item4", "Ann")])
+        self.assertEqual((page.total, page.has_more), (4, True))
+        self.assertEqual(self.db.test.count_items(1, 'doclist'), 6)
+        self.assertRaises(AssertionError, self.db.test.find_items, 1, 'name')
+
+        data = self.db.test.find_one(1, slices={'doclist': (4, 10)})
+        self.assertEqual([x.name for x in data.doclist], ["item4", "item5"])
+        self.assertEqual(json.loads(self.db.test.serialize(data)), {"_id": 1, "name": "Bob"})
+        self.assertIsNone(self.db.test.update(json.loads(self.db.test.serialize(data))))
+        self.assertEqual(self.db.test.count_items(1, 'doclist'), 6)
+        data.doclist[1]['count'] = "50"
+        self.assertIsNone(self.db.test.update(data))
+        stored = self.db.test.find_one(1, expand=False)
+        self.assertEqual([x.count for x in stored.doclist], [0, 1, 2, 3, 4, 50])
+
+
+    def test_bucketed_list(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "total": {"type": "integer", "auto": lambda e: sum(x.count for x in e.doclist), "depends": ["doclist"]},
+            "doclist": {"type": "list", "bucket": 2, "schema": {"type": "dict", "schema": {
+                "name": {"type": "string"},
+                "count": {"type": "integer", "default": 1},
+            }}},
+        })
+        self.db.test.insert({"name": "Bob", "doclist": [{"name": "a"}, {"name": "b", "count": 2}, {"name": "c"}]})
+        self.assertEqual(self.db._db['test.doclist'].find().count(), 2)
+        self.assertEqual(self.db.test.push_item(1, 'doclist', {"name": "d", "count": "3"}), (4, None))
+
+        self.assertIsNone(self.db.test.update({"_id": 1, "doclist": [{"_id": 2, "count": "5"}]}))
+        data = self.db.test.find_one(1)
+        self.assertEqual([(x.name, x.count) for x in data.doclist], [("b", 5)])
+        self.assertEqual(data.total, 5)
+        self.assertEqual(json.loads(self.db.test.serialize(data))['doclist'], [{"_id": 2, "name": "b", "count": 5}])
+        self.assertEqual(self.db._db['test.doclist'].find().count(), 1)
+
+        del self.db.schemas['test']['doclist']['bucket']
+        self.db.register_schema('test', self.db.schemas['test'])
+        self.assertEqual(self.db.buckets, {})
+
+
+    def test_auto_depends(self):
+        calls = []
+        def total(e):
+            calls.append('total')
+            return sum(x.amount for x in e.lines)
+        def label(e):
+            calls.append('label')
+            return e.name.upper()
+        def line_label(e):
+            calls.append('line')
+            return '%s: %s' % (e.name, e.amount)
+        def summary(e):
+            calls.append('summary')
+            return '%s (%s)' % (e.name, e.total)
+
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "note": {"type": "string"},
+            "total": {"type": "integer", "auto": total, "depends": ["lines"]},
+            "label": {"type": "string", "auto": label, "depends": ["name"]},
+            "always": {"type": "string", "auto": lambda e: calls.append('always') or e.note},
+            "summary": {"type": "string", "serialize": summary, "depends": ["name", "total"]},
+            "lines": {"type": "list", "schema": {"type": "dict", "schema": {
+                "name": {"type": "string"},
+                "amount": {"type": "integer"},
+                "label": {"type": "string", "auto": line_label, "depends": ["name", "amount"]},
+            }}},
+        })
+
+        self.db.test.insert({"name": "bob", "lines": [{"name": "a", "amount": 1}, {"name": "b", "amount": 2}]})
+        self.assertEqual(sorted(calls), ['always', 'label', 'line', 'line', 'total'])
+        self.assertEqual(self.db.stats['auto computed'], 5)
+
+        del calls[:]
+        self.db.stats.clear()
+        self.db.test.update({"_id": 1, "note": "hi"})
+        self.assertEqual(calls, ['always'])
+        self.assertEqual(self.db.stats, {'auto computed': 1, 'auto skipped': 4})
+
+        del calls[:]
+        self.db.test.update({"_id": 1, "lines": [{"_id": 2, "amount": 5}, {"_id": 1}]})
+        self.assertEqual(sorted(calls), ['always', 'line', 'line', 'total'])
+        data = self.db.test.find_one(1)
+        self.assertEqual((data.total, data.label, data.note), (6, 'BOB', 'hi'))
+        self.assertEqual([x.label for x in data.lines], ['b: 5', 'a: 1'])
+
+        del calls[:]
+        self.db.test.update({"_id": 1, "name": "robert"})
+        self.assertEqual(sorted(calls), ['always', 'label'])
+        self.assertEqual(self.db.test.find_one(1).label, 'ROBERT')
+
+        del calls[:]
+        self.db.stats.clear()
+        data = self.db.test.find_one(1)
+        self.assertEqual(self.db.test.get_serial_dict(data)['summary'], 'robert (6)')
+        self.db.test.get_serial_dict(data)
+        data['name'] = 'rob'
+        self.assertEqual(self.db.test.get_serial_dict(data)['summary'], 'rob (6)')
+        self.assertEqual(calls, ['summary', 'summary'])
+        self.assertEqual(self.db.stats, {'serialize computed': 2, 'serialize skipped': 1})
+
+
+    def test_allowed_cache(self):
+        calls = []
+        def sizes(elem):
+            calls.append('sizes')
+            return ['S', 'M', 'L']
+        def colors(elem):
+            calls.append('colors')
+            return ['red', 'blue']
+        def shapes(elem):
+            calls.append('shapes')
+            return ['round', 'square']
+
+        self.db.register_schema('test', {
+            "size": {"type": "string", "allowed": sizes},
+            "color": {"type": "string", "allowed": colors, "allowed_cache": "batch"},
+            "shape": {"type": "string", "allowed": shapes, "allowed_cache": 60},
+            "tags": {"type": "list", "schema": {"type": "string", "allowed": sizes}},
+        })
+
+        ids, errs = self.db.test.insert([
+            {"size": "S", "color": "red", "shape": "round", "tags": ["S", "M", "L", "S"]},
+            {"size": "M", "color": "blue", "shape": "square", "tags": ["M", "XL"]},
+            {"size": "L", "color": "red", "shape": "round"},
+        ])
+        self.assertEqual(errs, [[], ["tags/1: 'XL' not one of the allowed values"], []])
+        self.assertEqual(calls.count('sizes'), 5)
+        self.assertEqual(calls.count('colors'), 1)
+        self.assertEqual(calls.count('shapes'), 1)
+
+        del calls[:]
+        ids, errs = self.db.test.insert({"size": "S", "color": "green", "shape": "square"})
+        self.assertEqual(errs, ["color: 'green' not one of the allowed values"])
+        self.assertEqual(sorted(calls), ['colors', 'sizes'])
+
+        self.db.allowed_store.clear()
+        self.assertEqual(self.db.test.insert({"size": "S", "color": "red", "shape": "oval"})[1], ["shape: 'oval' not one of the allowed values"])
+        self.assertEqual(calls.count('shapes'), 1)
+
+
+    def test_patch_update(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string", "required": True},
+            "size": {"type": "string", "allowed": lambda elem: ["S", "M"]},
+            "count": {"type": "integer"},
+            "double": {"type": "integer", "auto": lambda elem: elem.count * 2, "depends": ["count"]},
+            "notes": {"type": "dict", "schema": {"text": {"type": "string"}}},
+            "lines": {"type": "list", "schema": {"type": "dict", "schema": {"q": {"type": "integer"}}}},
+        })
+        self.db.test.insert({"name": "Bob", "size": "S", "count": 1, "notes": {"text": "hi"}, "lines": [{"q": 1}]})
+
+        with self.db.track_queries() as log:
+            self.assertIsNone(self.db.test.update({"_id": 1, "count": 4}, 'bob'))
+        self.assertEqual([x[1] for x in log.queries if x[0] == 'test'], ['find_one', 'update'])
+        data = self.db.test.find_one(1)
+        self.assertEqual((data.name, data.count, data.double, data.notes.text), ("Bob", 4, 8, "hi"))
+        changes = self.db.history_find({"id": 1, "username": "bob"})[0]['changes']
+        self.assertEqual(sorted(changes), [{'count': 1}, {'double': 2}])
+
+        # New list objects are numbered by the write
+        self.assertIsNone(self.db.test.update({"_id": 1, "lines": [{"_id": 1, "q": 5}, {"q": 8}]}))
+        data = self.db.test.find_one(1)
+        data.lines.append({"q": 9})
+        self.assertIsNone(self.db.test.update(data))
+        self.assertEqual(self.db.test.find_one(1).lines, [{"_id": 1, "q": 5}, {"_id": 2, "q": 8}, {"_id": 3, "q": 9}])
+
+        self.assertEqual(self.db.test.update({"_id": 1, "name": None}), ["name: value is required"])
+        self.assertEqual(self.db.test.update({"_id": 9, "count": 1}), ["_id: '9' not found"])
+
+        # A callable 'allowed' sees the whole element, so that needs the full document
+        with self.db.track_queries() as log:
+            self.assertEqual(self.db.test.update({"_id": 1, "size": "L"}), ["size: 'L' not one of the allowed values"])
+        self.assertEqual([x[1] for x in log.queries if x[0] == 'test'], ['find_one'])
+        self.assertEqual(self.db.test.find_one(1).size, "S")
+
+
+    def test_versioning(self):
+        race = []
+        def sizes(elem):
+            if race:
+                # Another writer gets in between this update's read and write
+                race.pop()
+                self.db.test.coll._collection.update({'_id': 1}, {'$set': {'name': 'Sue'}, '$inc': {'_v': 1}})
+            return ['S', 'M']
+
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "size": {"type": "string", "allowed": sizes},
+        })
+        self.db.versioning('test', RetryPolicy(backoff=0))
+        self.db.test.insert({"name": "Bob", "size": "S"})
+
+        race.append(True)
+        self.assertIsNone(self.db.test.update({"_id": 1, "size": "M"}))
+        data = self.db.test.find_one(1)
+        self.assertEqual((data.name, data.size, data._v), ("Sue", "M", 2))
+
+        self.assertIsNone(self.db.test.update({"_id": 1, "name": "Ann", "_v": 2}))
+        self.assertRaises(ConflictError, self.db.test.update, {"_id": 1, "name": "Joe", "_v": 2})
+        data = self.db.test.find_one(1)
+        self.assertEqual((data.name, data._v), ("Ann", 3))
+        self.assertNotIn('_v', json.loads(self.db.test.serialize(data)))
@@ -562,4 +562,65 @@ class TopAPITests(TestCase):
             "doclist2": [],
             "ref2": None,
             "reflist2": [],    
-        })
\ No newline at end of file
+        })
+
+    def test_schema_migration(self):
+        self.db.register_schema('test', {
+            "name": {"type": "string"},
+            "count": {"type": "string"},
+            "old": {"type": "string"},
+            "lines": {"type": "list", "schema": {"type": "dict", "schema": {
+                "qty": {"type": "string"},
+            }}},
+        })
+        ids, errs = self.db.test.insert([
+            {"name": "a", "count": "1", "old": "x", "lines": [{"qty": "2"}, {"qty": "z"}]},
+            {"name": "b", "count": "many"},
+            {"name": "c"},
+        ], direct=True)
+
+        with self.db.track_queries() as log:
+            summary = self.db.migrate('test', {
+                "name": {"type": "string"},
+                "count": {"type": "integer"},
+                "flag": {"type": "boolean", "default": True},
+                "upper": {"type": "string", "auto": lambda e: e.name.upper()},
+                "user": {"type": "dict", "schema": {"username": {"type": "string"}}},
+                "lines": {"type": "list", "schema": {"type": "dict", "schema": {
+                    "qty": {"type": "integer"},
+                    "unit": {"type": "string", "default": "ea"},
+                }}},
+            }, 'admin', batch_size=2)
+        # One read per step, however many documents it touches
+        self.assertEqual([x[1] for x in log.queries if x[0] == 'test'].count('find'), 6)
+        self.assertEqual(summary, {
+            'added': ['flag', 'upper', 'user'],
+            'removed': ['old'],
+            'converted': ['count'],
+            'lists': ['lines'],
+            'errors': [
+                "2 count: Could not convert 'many' to type 'integer'",
+                "1 lines/1/qty: Could not convert 'z' to type 'integer'",
+            ],
+        })
+
+        data = [json.loads(self.db.test.serialize(x)) for x in self.db.test.find()]
+        self.assertEqual(data[0], {
+            '_id': 1,
+            'name': 'a',
+            'count': 1,
+            'flag': True,
+            'upper': 'A',
+            'user': {'_id': 1, 'username': None},
+            'lines': [
+                {'_id': 1, 'qty': 2, 'unit': 'ea'},
+                {'_id': 2, 'qty': 'z', 'unit': 'ea'},
+            ],
+        })
+        self.assertEqual([(x['count'], x['upper'], x['lines']) for x in data[1:]], [('many', 'B', []), (None, 'C', [])])
+        self.assertNotIn('old', self.db.test.coll._collection.find_one(1))
+
+        markers = [x for x in self.db.history_find({'collection': 'test', 'username': 'admin'})]
+        self.assertEqual([x['action'] for x in markers], ['schema migrated'])
+        self.assertEqual(markers[0]['changes']['removed'], ['old'])
+        self.assertEqual(markers[0]['changes']['errors'], summary['errors'])